@@ -0,0 +1,79 @@
+"""Per-site activity of a sandpile run: maps of where avalanches toppled, and the shape of each avalanche"""
+
+from array import array
+import numpy as np
+
+
+class ActivityMaps:
+    """Accumulates maps over the sites of an M by N table while attached to it as table.activity: the odometer
+    (how many times each site toppled, in avalanches and in stabilise) and how many avalanches each site toppled
+    in. Their memory is fixed by the size of the table, however long the run.
+    Each avalanche's statistics gain its radius of gyration and the height and width of its bounding box, over
+    the distinct sites it toppled, worked out from sums of their coordinates rather than kept site lists.
+    The maps are laid out like Table's grid, edges (which never topple) included; see odometer and membership"""
+    def __init__(self, M, N):
+        self.M = M
+        self.N = N
+        self.topples = np.zeros([M + 2, N + 2], dtype=np.int64)  # topples of each site
+        self.avalanche_counts = np.zeros([M + 2, N + 2], dtype=np.int64)  # avalanches each site toppled in
+        self.avalanches = 0  # number of avalanches traced
+        self.sites = array("q")  # topples of the avalanche being traced, appended to by the table
+        self.sums = [0] * 5  # number of distinct sites of the avalanche being traced, sums of i, j, i^2 and j^2
+        self.bounds = None  # (first row, last row, first column, last column) of its distinct sites
+
+    @property
+    def odometer(self):
+        """M by N map of the number of times each site on the table toppled"""
+        return self.topples[1:self.M + 1, 1:self.N + 1]
+
+    @property
+    def membership(self):
+        """M by N map of the number of avalanches each site on the table toppled in"""
+        return self.avalanche_counts[1:self.M + 1, 1:self.N + 1]
+
+    def add_counts(self, r0, c0, topples):
+        """Adds the integer array of topples of the block with top left corner (r0,c0) to the odometer"""
+        h, w = topples.shape
+        self.topples[r0:r0 + h, c0:c0 + w] += topples
+
+    def add_sites(self, sites):
+        """Adds the array of flat grid sites toppling for the first time in the avalanche being traced (at most once
+        each per avalanche, e.g. a time-step's worth) to the membership map and to the sums giving its shape"""
+        if len(sites) == 0:
+            return
+        self.avalanche_counts.reshape(-1)[sites] += 1
+        rows, cols = np.divmod(sites, self.N + 2)
+        for n, total in enumerate((len(sites), rows.sum(), cols.sum(), np.dot(rows, rows), np.dot(cols, cols))):
+            self.sums[n] += int(total)
+        bounds = (int(rows.min()), int(rows.max()), int(cols.min()), int(cols.max()))
+        if self.bounds is not None:
+            bounds = (min(self.bounds[0], bounds[0]), max(self.bounds[1], bounds[1]),
+                      min(self.bounds[2], bounds[2]), max(self.bounds[3], bounds[3]))
+        self.bounds = bounds
+
+    def end_avalanche(self):
+        """Closes the avalanche whose topples were appended to sites (or already added to the odometer, if sites
+        is empty) and whose distinct sites were given to add_sites. Returns its shape statistics"""
+        if self.sites:
+            sites = np.frombuffer(self.sites, dtype=np.int64)
+            np.add.at(self.topples.reshape(-1), sites, 1)
+            del sites  # release the buffer's export so it can be cleared
+            self.sites = array("q")
+        self.avalanches += 1
+        stats = shape_stats(self.sums, self.bounds)
+        self.sums = [0] * 5
+        self.bounds = None
+        return stats
+
+
+def shape_stats(sums, bounds):
+    """Radius of gyration and bounding box height and width of a set of sites, from the number of sites and the
+    sums of their rows, columns, squared rows and squared columns, and their (first row, last row, first column,
+    last column) bounds: Rg^2 = <i^2> - <i>^2 + <j^2> - <j>^2"""
+    n, sum_i, sum_j, sum_ii, sum_jj = sums
+    if n == 0:
+        return {'gyration': 0.0, 'height': 0, 'width': 0}
+    # Exact in integers, so no precision is lost however far the sites are from the origin:
+    variance = (n * (sum_ii + sum_jj) - sum_i ** 2 - sum_j ** 2) / n ** 2
+    return {'gyration': float(np.sqrt(variance)), 'height': bounds[1] - bounds[0] + 1,
+            'width': bounds[3] - bounds[2] + 1}
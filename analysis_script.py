@@ -1,99 +1,191 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
-from plotting_helper import get_freq_data, plot_histogram, loglog_plot_stats, \
-    power_law_fit_plot, power_law_func, exp_func
-import sandpile
-
-
-def main():
-    legend = []
-    allDensities = []  # array for collecting grid densities of sand
-    plotOn = 1  # 0 for no plots, 1 for plots to be shown
-    for grid_config in [[11, 11]]:
-        legend.append(f"{grid_config[0]} x {grid_config[1]} grid")
-        sand_pile = sandpile.Table(grid_config[0], grid_config[1], 4)
-        # print(sand_pile.grid)
-        totalGrains = 1000  # Number of  grains to be dropped
-        size = []  # Statistics to be collected
-        lifetime = []
-        area = []
-        radius = []
-        density = []
-        # Loop over number of grains to be dropped:
-        for grain in range(totalGrains):
-            sand_pile.add_grain()
-            sandGrid = sand_pile.grid[1:sand_pile.M + 1, 1:sand_pile.N + 1]  # grid without edges
-            m, n = np.unravel_index(sandGrid.argmax(), sandGrid.shape)  # Find site with max grains:
-            m += 1
-            n += 1
-            # Check if avalanche will occur:
-            if sand_pile.is_critical_site(m, n):
-                stats = sand_pile.execute_avalanche_with_stats(m, n)  # Avalanche occurs at (m,n)
-                # store statistics for avalanche:
-                size.append(stats['size'])
-                lifetime.append(stats['lifetime'])
-                area.append(stats['area'])
-                radius.append(stats['radius'])
-                density.append(np.average(sand_pile.grid[1:sand_pile.M + 1, 1:sand_pile.N + 1]))
-                totalSteps = grain + 1 + stats['lifetime']
-        allDensities.append(density)
-
-        #####################
-        # Plots:
-        if plotOn:
-            obsLegend = ["Size", "Lifetime", "Area", "Radius"]
-            units_legend = ["number of sites", "time units", "number of sites", "number of sites"]
-            # Histogram plots and loglog plots for observables vs number avalanches:
-            for i, stat in enumerate([size, lifetime, area, radius]):
-                plot_histogram(grid_config, stat, obsLegend[i], units_legend[i])
-                loglog_plot_stats(grid_config, stat, obsLegend[i], units_legend[i])
-
-            # Power law fit of observables vs number of avalanches
-            for i, stat in enumerate([size, lifetime, area]):
-                [stats, freqs] = get_freq_data(stat)
-                power_law_fit_plot(stats, freqs, [obsLegend[i], "Number of avalanches"], [units_legend[i], "Number"])
-
-            # Consider radius separately:  remove zero term from radius in order to get power law fit
-            [radii, freqs] = get_freq_data(radius)
-            radii, freqs = radii[1:], freqs[1:]
-            power_law_fit_plot(radii, freqs, [obsLegend[3], "Number of avalanches"], [units_legend[i], "Number"])
-            # try exponential fit for radius instead:
-            params, p_cov = curve_fit(exp_func, radii, freqs)
-            plt.plot(radii, freqs, ".")
-            plt.plot(np.sort(radii), exp_func(np.sort(radii), *params), '-')
-            plt.legend(["Avalanche data", "Exponential fit: ~ exp(-%5.3fx)" % (params[1])])
-            plt.title(f"Scaling law between {obsLegend[3]} and Number of avalanches")
-            plt.xlabel(f"{obsLegend[3]} ({units_legend[3]})")
-            plt.ylabel("Number of avalanches")
-            plt.show()
-
-            # Power law fits of size vs other observables
-            [sizes, freqs] = get_freq_data(size)
-            for i, stat in enumerate([lifetime, area, radius], 1):
-                [stats, stat_freqs] = get_freq_data(stat)
-                # correlations between  each variable and avalanche size :
-                power_law_fit_plot(size, stat, [obsLegend[0], obsLegend[i]], [units_legend[0], units_legend[i]])
-            ##############
+from plotting_helper import get_freq_data, plot_histogram, loglog_plot_stats, show_or_save, \
+    power_law_fit_plot, power_law_mle_plot, exp_fit_plot, power_law_func, exp_func
+from avalanche_stats import HISTOGRAM_OBSERVABLES, Histogram
+from power_law import fit_power_law
+from ensemble import run_ensemble
+
+OBS_LEGEND = ["Size", "Lifetime", "Area", "Radius"]
+UNITS_LEGEND = ["number of sites", "time units", "number of sites", "number of sites"]
+REDUCTION_VERSION = 1  # part of the cache key, bump when reduce_results changes what it computes
+
+
+def run_key(params):
+    """Name of the cached reductions of a run with the given parameters (a dict of JSON values)"""
+    text = json.dumps({**params, "version": REDUCTION_VERSION}, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def reduce_results(results):
+    """Reduces the results of run_ensemble to what the plots need: for each config, the frequency tables of the
+    observables, the fits of their distributions, the avalanche sample and fits to it, and the final grid.
+    Returns a list of (arrays, fits) per config, arrays being numpy arrays and fits JSON values"""
+    reductions = []
+    for (M, N, k), (avalanche_stats, grids) in results.items():
+        sample = avalanche_stats.sample()
+        arrays = {f"counts_{observable}": avalanche_stats[observable].counts for observable in HISTOGRAM_OBSERVABLES}
+        arrays.update(sample=sample, grid=grids[-1])
+        fits = {"config": [M, N, k], "count": avalanche_stats.count}
+        # Maximum likelihood power law fits of the distributions of observables (zero radii are left out):
+        fits["distributions"] = {observable: distribution_fit(avalanche_stats[observable])
+                                 for observable in HISTOGRAM_OBSERVABLES}
+        # try exponential fit for radius instead:
+        radii, freqs = get_freq_data(avalanche_stats["radius"])
+        fits["radius_exp"] = fit_params(exp_func, radii[1:], freqs[1:])
+        # correlations between each variable and avalanche size, over the sampled avalanches:
+        fits["size_vs"] = {observable: fit_params(power_law_func, sample["size"], sample[observable])
+                           for observable in HISTOGRAM_OBSERVABLES[1:]}
+        reductions.append((arrays, fits))
+    return reductions
+
+
+def distribution_fit(histogram):
+    """Returns the power law fit of a histogram, or None if there are too few avalanches to fit"""
+    try:
+        return fit_power_law(histogram)
+    except ValueError:
+        return None
+
+
+def fit_params(func, x_data, y_data):
+    """Returns the parameters of a least squares fit of func to the data, as a list"""
+    return curve_fit(func, np.asarray(x_data, dtype=float), y_data)[0].tolist()
+
+
+def save_reductions(cache_dir, key, params, reductions):
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(os.path.join(cache_dir, f"{key}.npz"),
+             **{f"{n}/{name}": array for n, (arrays, _) in enumerate(reductions) for name, array in arrays.items()})
+    with open(os.path.join(cache_dir, f"{key}.json"), "w") as f:  # written last, marking the cache complete
+        json.dump({"params": params, "fits": [fits for _, fits in reductions]}, f, indent=1)
+
+
+def load_reductions(cache_dir, key):
+    """Returns the cached reductions with the given key, or None if there aren't any"""
+    path = os.path.join(cache_dir, key)
+    if not os.path.exists(path + ".json"):
+        return None
+    with open(path + ".json") as f:
+        all_fits = json.load(f)["fits"]
+    with np.load(path + ".npz") as npz:
+        arrays = [{name.split("/", 1)[1]: npz[name] for name in npz.files if name.split("/", 1)[0] == str(n)}
+                  for n in range(len(all_fits))]
+    return list(zip(arrays, all_fits))
+
+
+def histogram(counts):
+    histogram = Histogram()
+    histogram.counts = counts
+    return histogram
+
+
+def figure_path(output_dir, name, fmt):
+    return None if output_dir is None else os.path.join(output_dir, f"{name}.{fmt}")
+
+
+def plot_config(arrays, fits, output_dir=None, fmt="png"):
+    """Plots the reduced statistics of one config, shown or saved as files in output_dir"""
+    if output_dir is not None:
+        matplotlib.use("Agg")  # worker processes may not have inherited it
+    M, N, _ = fits["config"]
+    grid_config = [M, N]
+    stats = [histogram(arrays[f"counts_{observable}"]) for observable in HISTOGRAM_OBSERVABLES]
+    sample = arrays["sample"]
+    # Histogram plots and loglog plots for observables vs number avalanches:
+    for i, (observable, stat) in enumerate(zip(HISTOGRAM_OBSERVABLES, stats)):
+        name = f"{M}x{N}_{observable}"
+        plot_histogram(grid_config, stat, OBS_LEGEND[i], UNITS_LEGEND[i],
+                       path=figure_path(output_dir, f"{name}_histogram", fmt))
+        loglog_plot_stats(grid_config, stat, OBS_LEGEND[i], UNITS_LEGEND[i],
+                          path=figure_path(output_dir, f"{name}_loglog", fmt))
+        power_law_mle_plot(grid_config, stat, OBS_LEGEND[i], UNITS_LEGEND[i], fit=fits["distributions"][observable],
+                           path=figure_path(output_dir, f"{name}_power_law", fmt))
+
+    [radii, freqs] = get_freq_data(stats[3])
+    exp_fit_plot(radii[1:], freqs[1:], [OBS_LEGEND[3], "Number of avalanches"], [UNITS_LEGEND[3], "Number"],
+                 params=fits["radius_exp"], path=figure_path(output_dir, f"{M}x{N}_radius_exp", fmt))
+
+    # Power law fits of size vs other observables, over the sampled avalanches
+    for i, observable in enumerate(HISTOGRAM_OBSERVABLES[1:], 1):
+        power_law_fit_plot(sample["size"], sample[observable], [OBS_LEGEND[0], OBS_LEGEND[i]],
+                           [UNITS_LEGEND[0], UNITS_LEGEND[i]], params=fits["size_vs"][observable],
+                           path=figure_path(output_dir, f"{M}x{N}_size_vs_{observable}", fmt))
+
+
+def main(grid_configs=((11, 11),), k=4, totalGrains=1000, seeds=1, workers=None, output_dir=None, cache_dir=None,
+         root_seed=None, fmt="png"):
+    """Simulates totalGrains grains dropped in the centre of each grid config, with `seeds` runs per config
+    spread over `workers` processes, then plots the avalanche statistics.
+    With an output_dir the figures are saved there (headless, with the Agg backend) rather than shown, a config
+    per worker process. With a cache_dir the reduced statistics are cached there, keyed by the run parameters,
+    so the plots can be redone without simulating again"""
+    if output_dir is not None:
+        matplotlib.use("Agg")
+        os.makedirs(output_dir, exist_ok=True)
+    params = {"grid_configs": [list(config) for config in grid_configs], "k": k, "grains": totalGrains,
+              "seeds": seeds, "policy": "centre", "root_seed": root_seed}
+    key = run_key(params)
+    reductions = None if cache_dir is None else load_reductions(cache_dir, key)
+    if reductions is None:
+        results = run_ensemble([(M, N, k) for M, N in grid_configs], totalGrains, seeds, root_seed=root_seed,
+                               workers=workers)
+        reductions = reduce_results(results)
+        if cache_dir is not None:
+            save_reductions(cache_dir, key, params, reductions)
+
+    #####################
+    # Plots:
+    if output_dir is None or workers == 1:
+        for arrays, fits in reductions:
+            plot_config(arrays, fits, output_dir, fmt)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count(), len(reductions))) as executor:
+            list(executor.map(plot_config, *zip(*reductions), [output_dir] * len(reductions),
+                              [fmt] * len(reductions)))
 
     # Sand densities plots
-    if plotOn:
-        for d in allDensities:
-            plt.plot(d)
-        plt.title("Density of sand on board")
-        plt.xlabel("Time")
-        plt.ylabel("Sand Density")
-        plt.legend(legend)
-        plt.show()
-
-        # Grid surface plot of final configuration
-    sandGrid = sand_pile.grid[1:sand_pile.M + 1, 1:sand_pile.N + 1]  # grid without edges
+    legend = [f"{fits['config'][0]} x {fits['config'][1]} grid" for _, fits in reductions]
+    for arrays, _ in reductions:
+        plt.plot(arrays["sample"]["grain"], arrays["sample"]["density"])
+    plt.title("Density of sand on board")
+    plt.xlabel("Time")
+    plt.ylabel("Sand Density")
+    plt.legend(legend)
+    show_or_save(figure_path(output_dir, "density", fmt))
+
+    # Grid surface plot of final configuration
+    sandGrid = reductions[-1][0]["grid"]  # grid without edges
     plt.imshow(sandGrid, interpolation='nearest', cmap='Blues')
     plt.title(f"Surface Density of Sandpile (Number of Grains: {totalGrains})")
     plt.colorbar()
-    plt.show()
-    #############################
+    show_or_save(figure_path(output_dir, "final_grid", fmt))
+    return reductions
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Simulates sandpile ensembles and plots avalanche statistics")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[11], help="side lengths of square grids")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--grains", type=int, default=1000)
+    parser.add_argument("--seeds", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output-dir", help="saves the figures here instead of showing them")
+    parser.add_argument("--cache-dir", help="caches the reduced statistics here")
+    parser.add_argument("--root-seed", type=int, default=None)
+    parser.add_argument("--format", default="png")
+    args = parser.parse_args(argv)
+    main([(size, size) for size in args.sizes], args.k, args.grains, args.seeds, args.workers, args.output_dir,
+         args.cache_dir, args.root_seed, args.format)
 
 
 if __name__ == '__main__':
-    main()
+    cli(sys.argv[1:])
@@ -0,0 +1,147 @@
+"""Streaming avalanche statistics, using a fixed amount of memory however many avalanches are added"""
+
+import numpy as np
+
+# One row per avalanche: grain which caused it, its statistics, and the density of sand after it
+AVALANCHE_DTYPE = np.dtype([("grain", np.int64), ("size", np.int64), ("lifetime", np.int64), ("area", np.int64),
+                            ("radius", np.int64), ("density", np.float64)])
+OBSERVABLES = ("size", "lifetime", "area", "radius", "density")
+HISTOGRAM_OBSERVABLES = ("size", "lifetime", "area", "radius")  # integer observables kept as histograms
+
+
+class Histogram:
+    """Growable bincount histogram of a non-negative integer observable"""
+    def __init__(self):
+        self.counts = np.zeros(16, dtype=np.int64)  # counts[x] is the number of times x was seen
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.int64)
+        if len(values) == 0:
+            return
+        self.grow(values.max() + 1)
+        self.counts += np.bincount(values, minlength=len(self.counts))
+
+    def merge(self, other):
+        self.grow(len(other.counts))
+        self.counts[:len(other.counts)] += other.counts
+
+    def grow(self, length):
+        """Doubles the length of the histogram until it holds values up to length - 1"""
+        if length > len(self.counts):
+            new_length = len(self.counts)
+            while new_length < length:
+                new_length *= 2
+            self.counts = np.concatenate((self.counts, np.zeros(new_length - len(self.counts), dtype=np.int64)))
+
+    def freq_data(self):
+        """Returns the values seen and the number of each, as get_freq_data does"""
+        values = np.nonzero(self.counts)[0]
+        return [values, self.counts[values]]
+
+    def max(self):
+        values = np.nonzero(self.counts)[0]
+        return values[-1] if len(values) else 0
+
+
+class AvalancheStats:
+    """Accumulates avalanche statistics: a histogram of each integer observable, running moments of every
+    observable, and a uniform reservoir sample of sample_size avalanches for scatter plots and fits"""
+    def __init__(self, sample_size=10000, rng=None):
+        self.rng = np.random.default_rng(rng)
+        self.n = 0  # number of avalanches counted so far
+        self.histograms = {observable: Histogram() for observable in HISTOGRAM_OBSERVABLES}
+        self.means = np.zeros(len(OBSERVABLES))
+        self.m2 = np.zeros(len(OBSERVABLES))  # sums of squared deviations from the mean
+        self.reservoir = np.zeros(sample_size, dtype=AVALANCHE_DTYPE)
+        self.pending = np.zeros(1024, dtype=AVALANCHE_DTYPE)  # avalanches added one at a time, not yet counted
+        self.n_pending = 0
+
+    @property
+    def count(self):
+        """Number of avalanches added"""
+        self.flush()
+        return self.n
+
+    def __getitem__(self, observable):
+        """Histogram of an integer observable, which can be passed directly to the plotting helpers"""
+        self.flush()
+        return self.histograms[observable]
+
+    def add_avalanche(self, grain, stats, density):
+        """Adds a single avalanche, given the grain which caused it, its statistics dict and the sand density"""
+        self.pending[self.n_pending] = (grain, stats['size'], stats['lifetime'], stats['area'], stats['radius'],
+                                        density)
+        self.n_pending += 1
+        if self.n_pending == len(self.pending):
+            self.flush()
+
+    def add(self, avalanches):
+        """Adds an array of avalanches with AVALANCHE_DTYPE fields"""
+        self.flush()
+        self.add_array(avalanches)
+
+    def flush(self):
+        if self.n_pending:
+            self.add_array(self.pending[:self.n_pending])
+            self.n_pending = 0
+
+    def add_array(self, avalanches):
+        n = len(avalanches)
+        if n == 0:
+            return
+        for observable in HISTOGRAM_OBSERVABLES:
+            self.histograms[observable].add(avalanches[observable])
+        values = np.column_stack([avalanches[observable] for observable in OBSERVABLES]).astype(float)
+        means = values.mean(axis=0)
+        self.merge_moments(n, means, ((values - means) ** 2).sum(axis=0))
+        # Reservoir sampling: the t'th avalanche replaces a random sample with probability sample_size / (t + 1)
+        capacity = len(self.reservoir)
+        fill = max(0, min(capacity - self.n, n))
+        self.reservoir[self.n:self.n + fill] = avalanches[:fill]
+        slots = self.rng.integers(0, np.arange(self.n + fill, self.n + n) + 1)
+        replaced = slots < capacity
+        self.reservoir[slots[replaced]] = avalanches[fill:][replaced]
+        self.n += n
+
+    def merge_moments(self, n, means, m2):
+        """Combines running moments with those of n more avalanches (Chan et al's parallel algorithm)"""
+        total = self.n + n
+        delta = means - self.means
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.means += delta * n / total
+
+    def merge(self, other):
+        """Adds the avalanches accumulated by other, e.g. from an independent run"""
+        self.flush()
+        other.flush()
+        if other.n == 0:
+            return
+        for observable in HISTOGRAM_OBSERVABLES:
+            self.histograms[observable].merge(other.histograms[observable])
+        self.merge_moments(other.n, other.means, other.m2)
+        # Uniform sample of the union: draw which of all the avalanches are sampled, and take as many samples from
+        # each reservoir as fall among its own (hypergeometric, but without numpy's limit of 10^9 on its counts)
+        capacity = len(self.reservoir)
+        own, theirs = self.sample(), other.sample()
+        if len(own) + len(theirs) <= capacity:
+            merged = np.concatenate((own, theirs))
+        else:
+            n_own = np.count_nonzero(self.rng.choice(self.n + other.n, capacity, replace=False) < self.n)
+            merged = np.concatenate((self.rng.choice(own, n_own, replace=False),
+                                     self.rng.choice(theirs, capacity - n_own, replace=False)))
+        self.reservoir[:len(merged)] = merged
+        self.n += other.n
+
+    def sample(self):
+        """Returns the sampled avalanches, in the order they happened"""
+        self.flush()
+        sample = self.reservoir[:min(self.n, len(self.reservoir))]
+        return sample[np.argsort(sample["grain"], kind="stable")]
+
+    def mean(self, observable):
+        self.flush()
+        return self.means[OBSERVABLES.index(observable)]
+
+    def var(self, observable):
+        self.flush()
+        return self.m2[OBSERVABLES.index(observable)] / self.n if self.n else 0.0
@@ -0,0 +1,119 @@
+"""Records every topple of every avalanche to disk, for replaying avalanches without re-simulating them"""
+
+import os
+import json
+from array import array
+import numpy as np
+
+TRACE_FILE = "trace.json"  # metadata of the table a trace directory was recorded from
+# One row per avalanche: grain which caused it, flat grid index of its origin, and its events[start:stop]
+TRACE_INDEX_DTYPE = np.dtype([("grain", np.int64), ("origin", np.int64), ("start", np.int64), ("stop", np.int64)])
+# Columns of the events, one file each: flat grid index of the toppled site, and the time-step it toppled in
+TRACE_COLUMNS = {"sites": np.int64, "timesteps": np.int32}
+
+
+class TraceRecorder:
+    """Appends the topples of each avalanche on an M by N table to columnar files in directory, spilling its
+    buffers to disk every buffer_events topples. Attach it to a Table by setting table.recorder.
+    Sites are flat indices into the table's padded grid, time-steps count from 0 within each avalanche"""
+    def __init__(self, directory, M, N, k, buffer_events=1 << 20):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.buffer_events = buffer_events
+        self.sites = array("q")  # toppled sites, in order, appended to by the table
+        self.counts = array("q")  # number of topples in each time-step, appended to by the table
+        self.avalanches = []  # (grain, origin, lifetime) of each avalanche in the buffers
+        self.events = 0  # number of topples written to disk
+        with open(os.path.join(directory, TRACE_FILE), "w") as f:
+            json.dump({"M": M, "N": N, "k": k}, f)
+        self.files = {name: open(os.path.join(directory, f"{name}.bin"), "wb") for name in TRACE_COLUMNS}
+        self.files["index"] = open(os.path.join(directory, "index.bin"), "wb")
+
+    def end_avalanche(self, grain, origin, lifetime):
+        """Closes the avalanche whose lifetime time-steps were just appended to sites and counts"""
+        self.avalanches.append((grain, origin, lifetime))
+        if len(self.sites) >= self.buffer_events:
+            self.flush()
+
+    def flush(self):
+        if not self.avalanches:
+            return
+        sites = np.frombuffer(self.sites, dtype=np.int64)
+        counts = np.frombuffer(self.counts, dtype=np.int64)
+        grains, origins, lifetimes = np.array(self.avalanches, dtype=np.int64).reshape(-1, 3).T
+        # Number each time-step within its avalanche, and each topple with its time-step:
+        first_steps = np.cumsum(lifetimes) - lifetimes
+        steps = np.arange(len(counts)) - np.repeat(first_steps, lifetimes)
+        timesteps = np.repeat(steps.astype(np.int32), counts)
+        events = np.add.reduceat(counts, first_steps) if len(counts) else np.zeros(0, dtype=np.int64)
+        index = np.zeros(len(grains), dtype=TRACE_INDEX_DTYPE)
+        index["grain"] = grains
+        index["origin"] = origins
+        index["stop"] = self.events + np.cumsum(events)
+        index["start"] = index["stop"] - events
+        self.files["sites"].write(sites.tobytes())
+        self.files["timesteps"].write(timesteps.tobytes())
+        self.files["index"].write(index.tobytes())
+        self.events += len(sites)
+        del sites, counts  # release the buffers' exports so they can be cleared
+        self.sites = array("q")
+        self.counts = array("q")
+        self.avalanches = []
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+
+def read_column(path, dtype):
+    """Memory-maps a column file, which may be empty"""
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class AvalancheTrace:
+    """Reads a trace recorded by a TraceRecorder, memory-mapping its files so any avalanche can be looked up
+    through the index without reading the others"""
+    def __init__(self, directory):
+        with open(os.path.join(directory, TRACE_FILE)) as f:
+            metadata = json.load(f)
+        self.M, self.N, self.k = metadata["M"], metadata["N"], metadata["k"]
+        self.width = self.N + 2
+        self.index = read_column(os.path.join(directory, "index.bin"), TRACE_INDEX_DTYPE)
+        self.sites, self.timesteps = (read_column(os.path.join(directory, f"{name}.bin"), dtype)
+                                      for name, dtype in TRACE_COLUMNS.items())
+
+    def __len__(self):
+        return len(self.index)
+
+    def find(self, grain):
+        """Returns the number of the avalanche caused by grain, or None if it didn't cause one"""
+        n = int(np.searchsorted(self.index["grain"], grain))
+        return n if n < len(self.index) and self.index["grain"][n] == grain else None
+
+    def events(self, n):
+        """Returns the time-steps and flat grid indices of the topples of avalanche n"""
+        start, stop = self.index["start"][n], self.index["stop"][n]
+        return self.timesteps[start:stop], self.sites[start:stop]
+
+    def replay(self, n, grid, timesteps=None):
+        """Topples the sites of avalanche n (its first `timesteps` time-steps if given) on grid, the padded
+        (M + 2) by (N + 2) grid as it was when the avalanche started, in place. Returns grid"""
+        steps, sites = self.events(n)
+        if timesteps is not None:
+            sites = sites[:np.searchsorted(steps, timesteps)]
+        flat = grid.reshape(-1)  # a view, so grid must be contiguous
+        np.add.at(flat, sites, -4)
+        for offset in (self.width, -self.width, 1, -1):
+            np.add.at(flat, sites + offset, 1)
+        return grid
+
+    def stats(self, n):
+        """Recomputes the statistics execute_avalanche_with_stats returned for avalanche n"""
+        steps, sites = self.events(n)
+        rows, cols = np.divmod(np.unique(sites), self.width)
+        i_0, j_0 = divmod(int(self.index["origin"][n]), self.width)
+        return {'size': 4 * len(sites), 'lifetime': int(steps[-1]) + 1, 'area': len(rows),
+                'radius': int((np.abs(rows - i_0) + np.abs(cols - j_0)).max())}
@@ -0,0 +1,135 @@
+"""Times Table relaxation across grid sizes, k, drop policies and starting configurations.
+Run as a script to write the results to a JSON file, e.g. to compare commits or plot scaling curves"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+from math import ceil
+import numpy as np
+import sandpile
+
+SIZES = (16, 64, 256, 1024, 2048)  # side lengths of the square grids benchmarked by default
+OPERATIONS = ("add_grains", "execute_timestep", "execute_avalanche_with_stats")
+STARTS = ("empty", "critical")
+CRITICAL_TILE = 256  # critical starts bigger than this are tiled from one this size, as stabilising them is slow
+BATCH = 64  # grains dropped between checks of the time taken
+
+
+def critical_grid(M, N, k, seed=None):
+    """Returns an M by N array of heights at about the stationary density of the model, from random drops
+    stabilised on a table of at most CRITICAL_TILE by CRITICAL_TILE sites, tiled to cover the grid"""
+    tile = sandpile.Table(min(M, CRITICAL_TILE), min(N, CRITICAL_TILE), k, seed=seed)
+    tile.add_grains(int((k - 4 + 2.125) * tile.M * tile.N), "random")  # heights less k - 4 behave as for k = 4
+    heights = tile.interior
+    return np.tile(heights, (ceil(M / tile.M), ceil(N / tile.N)))[:M, :N]
+
+
+def make_table(M, N, k, start, engine=None, seed=None, workers=1):
+    sand_pile = sandpile.Table(M, N, k, engine=engine, seed=seed)
+    sand_pile.workers = workers
+    if start == "critical":
+        sand_pile.interior[...] = critical_grid(M, N, k, seed)
+    elif start != "empty":
+        raise ValueError(f"Unknown start '{start}', expected one of {STARTS}")
+    return sand_pile
+
+
+def drop_batch(sand_pile, operation, policy, grains):
+    """Drops grains onto the table and relaxes it using operation. Returns the number of topples"""
+    if operation == "add_grains":
+        return sand_pile.add_grains(grains, policy)
+    topples = 0
+    for i, j in sand_pile.drop_sites(grains, policy).tolist():
+        sand_pile.add_grain(i, j)
+        if not sand_pile.is_critical_site(i, j):
+            continue
+        if operation == "execute_avalanche_with_stats":
+            topples += sand_pile.execute_avalanche_with_stats(i, j)['size'] // 4
+        elif operation == "execute_timestep":
+            toppling_sites = {(i, j)}
+            while toppling_sites:
+                topples += len(toppling_sites)
+                toppling_sites = sand_pile.execute_timestep(toppling_sites)
+        else:
+            raise ValueError(f"Unknown operation '{operation}', expected one of {OPERATIONS}")
+    return topples
+
+
+def run_case(M, N, k, operation, policy, start, engine=None, duration=1.0, seed=0, workers=1):
+    """Drops grains in batches until duration seconds have passed (at least one batch), then measures the peak
+    memory of setting up and running one more batch. Returns a dict describing the case and its results"""
+    sand_pile = make_table(M, N, k, start, engine, seed, workers)
+    grains = topples = 0
+    started = time.perf_counter()
+    while True:
+        topples += drop_batch(sand_pile, operation, policy, BATCH)
+        grains += BATCH
+        seconds = time.perf_counter() - started
+        if seconds >= duration:
+            break
+    tracemalloc.start()  # numpy reports its allocations to tracemalloc
+    try:
+        drop_batch(make_table(M, N, k, start, engine, seed, workers), operation, policy, BATCH)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"operation": operation, "engine": sand_pile.engine, "M": M, "N": N, "k": k, "policy": policy,
+            "start": start, "workers": workers, "grains": grains, "topples": topples, "seconds": seconds,
+            "grains_per_s": grains / seconds, "topples_per_s": topples / seconds, "peak_bytes": peak_bytes}
+
+
+def run_benchmarks(sizes=SIZES, ks=(4,), operations=OPERATIONS, policies=sandpile.DROP_POLICIES, starts=STARTS,
+                   engines=(sandpile.DEFAULT_ENGINE,), duration=1.0, seed=0, log=None, workers=1):
+    """Runs every combination of the arguments on square grids, each operation with each engine; the workers
+    (processes stabilise uses) only apply to add_grains. Returns the results with details of the machine and
+    commit"""
+    results = []
+    for size in sizes:
+        for k in ks:
+            for operation in operations:
+                for engine in engines:
+                    for policy in policies:
+                        for start in starts:
+                            result = run_case(size, size, k, operation, policy, start, engine, duration, seed, workers)
+                            results.append(result)
+                            if log is not None:
+                                print(f"{size}x{size} k={k} {operation} ({result['engine']}) {policy} {start}: "
+                                      f"{result['grains_per_s']:.1f} grains/s, {result['topples_per_s']:.0f} "
+                                      f"topples/s, {result['peak_bytes'] / 2 ** 20:.1f} MiB", file=log)
+    return {"commit": git_commit(), "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "processor": platform.processor(), "results": results}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--k", type=int, nargs="+", default=[4])
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument("--policies", nargs="+", choices=sandpile.DROP_POLICIES, default=sandpile.DROP_POLICIES)
+    parser.add_argument("--starts", nargs="+", choices=STARTS, default=STARTS)
+    parser.add_argument("--engines", nargs="+", choices=sandpile.ENGINES, default=[sandpile.DEFAULT_ENGINE])
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds to time each case for")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="processes for add_grains to stabilise with")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args(argv)
+    report = run_benchmarks(args.sizes, args.k, args.operations, args.policies, args.starts, args.engines,
+                            args.duration, args.seed, log=sys.stdout, workers=args.workers)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
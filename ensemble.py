@@ -0,0 +1,72 @@
+"""Runs ensembles of independent sandpile simulations over a process pool"""
+
+import os
+from contextlib import nullcontext
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import sandpile
+from avalanche_stats import AvalancheStats
+
+
+def run_job(M, N, k, grains, policy, seed, sample_size=10000, checkpoint_dir=None, checkpoint_every=None,
+            start="empty", instruments=None):
+    """Drops grains onto an M by N table, following the drop policy with an rng seeded by seed. The table starts
+    empty, or in a random recurrent configuration (at criticality) if start is "recurrent".
+    With a checkpoint_dir the run is snapshotted every checkpoint_every grains, and resumes from the latest
+    snapshot there if it was stopped, raising ValueError if the snapshot is of a run with another M, N, k,
+    policy or start. instruments (an instrumentation.Instruments) are attached to the table, and also time the
+    "drive" loop and "checkpoint" saves. Returns the AvalancheStats of the run and the final grid without edges"""
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    drop_seed, sample_seed = seed.spawn(2)
+    params = {"M": M, "N": N, "k": k, "policy": policy, "start": start}
+    if checkpoint_dir is not None and os.path.exists(os.path.join(checkpoint_dir, sandpile.CHECKPOINT_FILE)):
+        sand_pile, stats = sandpile.Table.load_checkpoint(checkpoint_dir, params)
+    else:
+        sand_pile = sandpile.Table.random_recurrent(M, N, k, drop_seed) if start == "recurrent" \
+            else sandpile.Table(M, N, k, seed=drop_seed)
+        stats = AvalancheStats(sample_size, sample_seed)
+    sand_pile.instruments = instruments
+    while sand_pile.grains < grains:
+        end = min(sand_pile.grains + (checkpoint_every or grains), grains)
+        with nullcontext() if instruments is None else instruments.phase("drive"):
+            # Drop sites are drawn RUN_CHUNK grains at a time from the start of each checkpoint's worth, so a resumed
+            # run continues the same rng stream, and each chunk's avalanches are added to stats before the next
+            while sand_pile.grains < end:
+                chunk = min(sandpile.RUN_CHUNK, end - sand_pile.grains)
+                stats.add(sand_pile.run(chunk, policy, chunk=chunk))
+        if checkpoint_dir is not None:
+            with nullcontext() if instruments is None else instruments.phase("checkpoint"):
+                sand_pile.save_checkpoint(checkpoint_dir, stats, params)
+    sand_pile.instruments = None
+    return stats, sand_pile.interior.copy()
+
+
+def run_ensemble(configs, grains, seeds=1, policy="centre", root_seed=None, workers=None, sample_size=10000,
+                 checkpoint_dir=None, checkpoint_every=None, start="empty"):
+    """Runs every (M, N, k) config with `seeds` independent runs of `grains` grains each, over `workers`
+    processes (all cores by default, or in this process if 1). Each run gets its own rng stream spawned from
+    root_seed, so the ensemble is reproducible for any number of workers.
+    With a checkpoint_dir, each run is checkpointed in its own subdirectory; start is as for run_job.
+    Returns {(M, N, k): (stats, grids)}, the AvalancheStats of all runs merged and the final grids stacked"""
+    jobs = [(M, N, k) for M, N, k in configs for _ in range(seeds)]
+    job_seeds = np.random.SeedSequence(root_seed).spawn(len(jobs))
+    args = ([M for M, _, _ in jobs], [N for _, N, _ in jobs], [k for _, _, k in jobs], [grains] * len(jobs),
+            [policy] * len(jobs), job_seeds, [sample_size] * len(jobs),
+            [None if checkpoint_dir is None else os.path.join(checkpoint_dir, f"job_{job}")
+             for job in range(len(jobs))],
+            [checkpoint_every] * len(jobs), [start] * len(jobs))
+    workers = os.cpu_count() if workers is None else workers
+    if workers == 1:
+        job_results = list(map(run_job, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            job_results = list(executor.map(run_job, *args))
+
+    results = {}
+    for config in dict.fromkeys(jobs):  # configs in order, without repeats
+        runs = [result for job, result in zip(jobs, job_results) if job == config]
+        stats = runs[0][0]
+        for run_stats, _ in runs[1:]:
+            stats.merge(run_stats)
+        results[config] = (stats, np.stack([grid for _, grid in runs]))
+    return results
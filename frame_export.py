@@ -0,0 +1,252 @@
+"""Exports frames of a sandpile run as PNG sequences or animations, without a display. Frames are coloured like
+sandpile_vis with a lookup table of the Deep palette, and written by a background thread fed through a bounded
+queue, so encoding overlaps simulation and a slow encoder holds the simulation back rather than filling memory"""
+
+import os
+import sys
+import queue
+import shutil
+import argparse
+import threading
+import subprocess
+import numpy as np
+from PIL import Image
+import palettable.cmocean.sequential as pcolours
+
+import sandpile
+
+WHITE = (255, 255, 255)  # colour of empty sites
+QUEUE_FRAMES = 4  # frames captured but not yet written, at most
+VIDEO_FPS = 30
+
+
+def deep_lut(k):
+    """Returns a (k + 1, 3) uint8 table of the colour of each height from 0 to k (and over, see colour_indices):
+    white, then the Deep palette, the colours of sandpile_vis for k = 4"""
+    if k + 1 <= 20:
+        colours = getattr(pcolours, f"Deep_{max(k + 1, 2)}").colors[:k]
+    else:
+        colours = np.round(pcolours.Deep_20.mpl_colormap(np.linspace(0, 1, k + 1))[:k, :3] * 255)
+    return np.array([WHITE] + list(colours), dtype=np.uint8)
+
+
+def colour_indices(heights, k, out=None):
+    """Returns the index into a lookup table of each site's colour: its height, with any height over k as k.
+    out is a uint8 array the shape of heights to write them to"""
+    return np.clip(heights, 0, k, out=out, casting="unsafe") if out is not None \
+        else np.clip(heights, 0, k).astype(np.uint8)
+
+
+def colour_frame(indices, lut, scale=1):
+    """Returns the RGB image of an array of colour indices, each site a scale by scale square of pixels"""
+    image = lut[indices]
+    if scale > 1:
+        image = np.repeat(np.repeat(image, scale, axis=0), scale, axis=1)
+    return image
+
+
+class PNGWriter:
+    """Writes frames to directory as frame_000000.png, frame_000001.png etc., as palette images (a byte per
+    pixel). compress_level trades file size for speed, from 0 (none) to 9"""
+    def __init__(self, directory, lut, scale=1, compress_level=1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.palette = lut.reshape(-1).tolist()
+        self.scale = scale
+        self.compress_level = compress_level
+        self.frames = 0
+
+    def write(self, indices):
+        if self.scale > 1:
+            indices = np.repeat(np.repeat(indices, self.scale, axis=0), self.scale, axis=1)
+        image = Image.fromarray(indices)
+        image.putpalette(self.palette)  # makes it a palette image
+        image.save(os.path.join(self.directory, f"frame_{self.frames:06d}.png"), compress_level=self.compress_level)
+        self.frames += 1
+
+    def close(self):
+        pass
+
+
+class FFmpegWriter:
+    """Pipes raw RGB frames to an ffmpeg process encoding them into an animation at path, its format (e.g. MP4 or
+    GIF) following the file extension. Frames are padded to even sizes, which H.264 needs"""
+    def __init__(self, path, lut, scale=1, fps=VIDEO_FPS, ffmpeg="ffmpeg"):
+        self.path = path
+        self.lut = lut
+        self.scale = scale
+        self.fps = fps
+        self.ffmpeg = ffmpeg
+        self.process = None  # started by the first frame, which gives the size
+        self.frames = 0
+
+    def write(self, indices):
+        image = colour_frame(indices, self.lut, self.scale)
+        if self.process is None:
+            height, width = image.shape[:2]
+            command = [self.ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                       "-s", f"{width}x{height}", "-r", str(self.fps), "-i", "-"]
+            if not self.path.lower().endswith(".gif"):
+                command += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"]
+            self.process = subprocess.Popen(command + [self.path], stdin=subprocess.PIPE)
+        self.process.stdin.write(image.tobytes())
+        self.frames += 1
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        if self.process.wait():
+            raise RuntimeError(f"ffmpeg failed to encode {self.path}, exit code {self.process.returncode}")
+
+
+class GIFWriter:
+    """Writes an animated GIF with Pillow, for machines without ffmpeg. The palette frames (a byte per pixel) are
+    kept in memory until closed, so long runs of big grids should use FFmpegWriter or PNGWriter"""
+    def __init__(self, path, lut, scale=1, fps=VIDEO_FPS):
+        self.path = path
+        self.palette = lut.reshape(-1).tolist()
+        self.scale = scale
+        self.duration = int(round(1000 / fps))
+        self.images = []
+
+    @property
+    def frames(self):
+        return len(self.images)
+
+    def write(self, indices):
+        if self.scale > 1:
+            indices = np.repeat(np.repeat(indices, self.scale, axis=0), self.scale, axis=1)
+        image = Image.fromarray(indices.copy())  # the buffer is reused for later frames
+        image.putpalette(self.palette)
+        self.images.append(image)
+
+    def close(self):
+        if self.images:
+            self.images[0].save(self.path, save_all=True, append_images=self.images[1:], duration=self.duration,
+                                loop=0)
+
+
+def open_writer(path, lut, scale=1, fps=VIDEO_FPS):
+    """Writer for path: a PNG sequence if it is a directory (has no extension), otherwise an animation encoded by
+    ffmpeg if it is installed, or a GIF written by Pillow"""
+    if not os.path.splitext(path)[1]:
+        return PNGWriter(path, lut, scale)
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is not None:
+        return FFmpegWriter(path, lut, scale, fps, ffmpeg)
+    if path.lower().endswith(".gif"):
+        return GIFWriter(path, lut, scale, fps)
+    raise RuntimeError(f"Encoding {path} needs ffmpeg, which isn't installed; export a PNG sequence or a GIF")
+
+
+class FrameExporter:
+    """Captures frames of a table's heights and hands them to a writer in a background thread. Frames are kept
+    as colour indices (a byte per site) in a pool of queue_frames buffers: capture blocks while every buffer is
+    waiting to be written, so memory stays bounded however far the simulation runs ahead of the encoder.
+    Use as a context manager, or call close to write the remaining frames"""
+    def __init__(self, writer, k, queue_frames=QUEUE_FRAMES):
+        self.writer = writer
+        self.k = k
+        self.queue_frames = queue_frames
+        self.free = queue.Queue()  # buffers which can be captured into, allocated on first capture
+        self.pending = queue.Queue()  # captured buffers, in order, then None once closed
+        self.error = None  # raised by the writer thread
+        self.captured = 0
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def capture(self, heights):
+        """Queues a frame of the M by N array of heights (e.g. table.interior) to be written"""
+        if self.error is not None:
+            raise self.error
+        if self.captured < self.queue_frames:
+            buffer = np.empty(heights.shape, dtype=np.uint8)
+        else:
+            buffer = self.free.get()
+            if self.error is not None:
+                raise self.error
+        self.pending.put(colour_indices(heights, self.k, buffer))
+        self.captured += 1
+
+    def work(self):
+        while True:
+            buffer = self.pending.get()
+            if buffer is None:
+                return
+            try:
+                if self.error is None:
+                    self.writer.write(buffer)
+            except Exception as error:
+                self.error = error
+            self.free.put(buffer)  # also wakes a capture waiting for a buffer after an error
+
+    def close(self):
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.thread.join()
+            self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+
+def export_grains(table, n_grains, exporter, every=1, policy="centre", rng=None):
+    """Drops n_grains grains onto table following the drop policy, capturing a frame every `every` grains (and
+    at the start). The grains between frames are added at once with add_grains, the model being abelian"""
+    exporter.capture(table.interior)
+    for start in range(0, n_grains, every):
+        table.add_grains(min(every, n_grains - start), policy, rng)
+        exporter.capture(table.interior)
+
+
+def export_avalanche(table, i, j, exporter):
+    """Relaxes the avalanche starting at (i, j) one execute_timestep at a time, capturing a frame before it and
+    after every time-step. Returns the number of time-steps"""
+    exporter.capture(table.interior)
+    critical = {(i, j)} if table.is_critical_site(i, j) else set()
+    timesteps = 0
+    while critical:
+        critical = table.execute_timestep(critical)
+        timesteps += 1
+        exporter.capture(table.interior)
+    return timesteps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exports frames of a sandpile run without a display")
+    parser.add_argument("output", help="directory for a PNG sequence, or an animation file (.gif, .mp4, ...)")
+    parser.add_argument("--size", type=int, default=255, help="side length of the square grid")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--grains", type=int, default=100000)
+    parser.add_argument("--every", type=int, default=1000, help="grains between frames")
+    parser.add_argument("--avalanche", action="store_true",
+                        help="animate one avalanche, a time-step per frame, from a random recurrent grid")
+    parser.add_argument("--policy", choices=sandpile.DROP_POLICIES, default="centre")
+    parser.add_argument("--scale", type=int, default=1, help="pixels per site along each side")
+    parser.add_argument("--fps", type=int, default=VIDEO_FPS)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+    lut = deep_lut(args.k)
+    with FrameExporter(open_writer(args.output, lut, args.scale, args.fps), args.k) as exporter:
+        if args.avalanche:
+            table = sandpile.Table.random_recurrent(args.size, args.size, args.k, seed=args.seed)
+            # A grain on a site one short of toppling starts an avalanche, one elsewhere would do nothing
+            tall = np.argwhere(table.interior == args.k - 1) + 1
+            i, j = tall[table.rng.integers(len(tall))].tolist() if len(tall) else table.centre()
+            table.add_grain(i, j)
+            timesteps = export_avalanche(table, i, j, exporter)
+            print(f"Avalanche of {timesteps} time-steps")
+        else:
+            table = sandpile.Table(args.size, args.size, args.k, seed=args.seed)
+            export_grains(table, args.grains, exporter, args.every, args.policy)
+    print(f"Wrote {exporter.writer.frames} frames to {args.output}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
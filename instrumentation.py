@@ -0,0 +1,80 @@
+"""Opt-in counters and timers for finding where a sandpile run spends its time"""
+
+import time
+from contextlib import contextmanager
+import numpy as np
+from avalanche_stats import Histogram
+
+COUNTERS = ("topples", "timesteps", "avalanches", "sites_examined")
+
+
+class Instruments:
+    """Counts what a Table does while attached as table.instruments (tables without any skip all of this):
+    topples, time-steps (including rounds of stabilise), avalanches and sites examined for criticality,
+    a histogram of the number of sites toppled per time-step, the peak of that, and the seconds spent in each
+    phase. Tables time the "avalanche", "timestep" and "stabilise" phases; drivers can time their own with
+    phase. on_timestep(table, frontier size) and on_avalanche(table, stats) are called if set"""
+    def __init__(self, on_timestep=None, on_avalanche=None):
+        self.on_timestep = on_timestep
+        self.on_avalanche = on_avalanche
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.frontier_sizes = Histogram()
+        self.peak_frontier = 0
+        self.phase_seconds = {}
+
+    def timestep(self, table, topples, examined):
+        """Counts a time-step which toppled `topples` sites, having examined `examined` sites"""
+        self.counters["topples"] += topples
+        self.counters["timesteps"] += 1
+        self.counters["sites_examined"] += examined
+        self.frontier_sizes.grow(topples + 1)
+        self.frontier_sizes.counts[topples] += 1
+        self.peak_frontier = max(self.peak_frontier, topples)
+        if self.on_timestep is not None:
+            self.on_timestep(table, topples)
+
+    def avalanche(self, table, stats, seconds):
+        self.counters["avalanches"] += 1
+        self.add_time("avalanche", seconds)
+        if self.on_avalanche is not None:
+            self.on_avalanche(table, stats)
+
+    def add_time(self, phase, seconds):
+        self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        """Adds the time spent in the with block to the phase name"""
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def to_dict(self):
+        values, counts = self.frontier_sizes.freq_data()
+        return {**self.counters, "peak_frontier": self.peak_frontier,
+                "frontier_sizes": dict(zip(values.tolist(), counts.tolist())),
+                "phase_seconds": dict(self.phase_seconds)}
+
+    def to_prometheus(self, prefix="sandpile"):
+        """Returns a snapshot in the Prometheus text exposition format, with the frontier sizes as a histogram
+        with power of 2 buckets"""
+        lines = []
+        for name, value in self.counters.items():
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        lines += [f"# TYPE {prefix}_peak_frontier gauge", f"{prefix}_peak_frontier {self.peak_frontier}"]
+        lines.append(f"# TYPE {prefix}_phase_seconds_total counter")
+        lines += [f'{prefix}_phase_seconds_total{{phase="{phase}"}} {seconds}'
+                  for phase, seconds in self.phase_seconds.items()]
+        counts = self.frontier_sizes.counts
+        cumulative = np.cumsum(counts)
+        lines.append(f"# TYPE {prefix}_frontier_size histogram")
+        bound = 1
+        while bound < len(counts) - 1:
+            lines.append(f'{prefix}_frontier_size_bucket{{le="{bound}"}} {cumulative[bound]}')
+            bound *= 2
+        lines += [f'{prefix}_frontier_size_bucket{{le="+Inf"}} {cumulative[-1]}',
+                  f"{prefix}_frontier_size_sum {int(np.dot(np.arange(len(counts)), counts))}",
+                  f"{prefix}_frontier_size_count {cumulative[-1]}"]
+        return "\n".join(lines) + "\n"
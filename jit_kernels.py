@@ -0,0 +1,117 @@
+"""Avalanche tracer and stabiliser for Table's "jit" engine, compiled with Numba if it is installed.
+The kernels are plain Python over numpy arrays, so Numba compiles them to machine code (cached on disk next to
+this module, so only the first run pays for compiling); without Numba, Tables asking for the "jit" engine use
+the "scalar" one instead"""
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+COMPILED = njit is not None  # whether the kernels below are compiled
+
+
+def trace_avalanche(heights, sinks, offsets, visited, toppled, frontier, next_frontier, queued, stamp, site_0,
+                    width, k, drain, max_height, odometer, count):
+    """Relaxes the avalanche starting at site_0 of the flat grid heights, as Table.execute_avalanche_with_stats.
+    visited must be all zeros, and is left so; toppled, frontier and next_frontier are scratch space as big as the
+    grid, and queued holds the time-step stamp of the last time-step each site was queued in (stamp so far).
+    Each topple gives a grain to the site at each of the flat offsets, the site's degree in all. Sand falling onto
+    sinks is added to them, or only counted if drain. If count, each topple of a site is added to it in odometer,
+    as big as the grid.
+    Returns the size, lifetime, area and radius of the avalanche, the grains which fell off the table and the last
+    stamp used; lifetime is -1 if a height went over max_height"""
+    i_0, j_0 = site_0 // width, site_0 % width
+    degree = len(offsets)
+    size = lifetime = area = radius = fallen = 0
+    frontier[0] = site_0
+    n_frontier = 1
+    while n_frontier:
+        stamp += 1
+        n_next = 0
+        for t in range(n_frontier):
+            site = frontier[t]
+            heights[site] -= degree  # a grain for each neighbour topples
+            if count:
+                odometer[site] += 1
+            if not visited[site]:  # A unique site toppled in the avalanche
+                visited[site] = 1
+                toppled[area] = site
+                area += 1
+                radius = max(radius, abs(site // width - i_0) + abs(site % width - j_0))
+            for offset in offsets:
+                pt = site + offset
+                if sinks[pt]:  # Sand falling off the table can't topple
+                    fallen += 1
+                    if not drain:
+                        heights[pt] += 1
+                    continue
+                height = int(heights[pt]) + 1
+                if height > max_height:
+                    for rest in range(area):
+                        visited[toppled[rest]] = 0
+                    return size, -1, area, radius, fallen, stamp
+                heights[pt] = height
+                if height >= k and queued[pt] != stamp:  # Each site topples once per time-step
+                    queued[pt] = stamp
+                    next_frontier[n_next] = pt
+                    n_next += 1
+        size += degree * n_frontier
+        lifetime += 1
+        frontier, next_frontier = next_frontier, frontier
+        n_frontier = n_next
+    for t in range(area):
+        visited[toppled[t]] = 0
+    return size, lifetime, area, radius, fallen, stamp
+
+
+def stabilise_grid(heights, sinks, offsets, stack, in_stack, k, drain, max_height, odometer, count):
+    """Topples every critical site of the flat grid heights as many times as it can at once, then the sites this
+    makes critical, until none are: the same grid as Table.stabilise, the model being abelian. Topples give grains
+    to the sites at the flat offsets, as trace_avalanche.
+    stack and in_stack are scratch space as big as the grid, in_stack all zeros (and left so). If count, the
+    topples of each site are added to it in odometer, as trace_avalanche.
+    Returns the number of topples, the grains which fell off the table (added to the sinks, or only counted if
+    drain) and the first and last sites toppled; the number of topples is -1 if a height went over max_height"""
+    degree = len(offsets)
+    n_stack = 0
+    for site in range(len(heights)):
+        if not sinks[site] and heights[site] >= k:
+            stack[n_stack] = site
+            in_stack[site] = 1
+            n_stack += 1
+    topples = fallen = 0
+    first, last = len(heights), -1
+    while n_stack:
+        n_stack -= 1
+        site = stack[n_stack]
+        in_stack[site] = 0
+        times = (int(heights[site]) - (k - degree)) // degree  # times the site can topple
+        heights[site] -= degree * times
+        topples += times
+        if count:
+            odometer[site] += times
+        first, last = min(first, site), max(last, site)
+        for offset in offsets:
+            pt = site + offset
+            if sinks[pt]:
+                fallen += times
+                if not drain:
+                    heights[pt] += times
+                continue
+            height = int(heights[pt]) + times
+            if height > max_height:
+                for rest in range(n_stack):
+                    in_stack[stack[rest]] = 0
+                return -1, fallen, first, last
+            heights[pt] = height
+            if height >= k and not in_stack[pt]:
+                stack[n_stack] = pt
+                in_stack[pt] = 1
+                n_stack += 1
+    return topples, fallen, first, last
+
+
+if COMPILED:
+    trace_avalanche = njit(cache=True)(trace_avalanche)
+    stabilise_grid = njit(cache=True)(stabilise_grid)
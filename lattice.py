@@ -0,0 +1,127 @@
+"""Lattices and graphs a sandpile can be played on, as precomputed neighbour tables"""
+
+from math import ceil
+import numpy as np
+
+BOUNDARIES = ("open", "closed", "periodic")  # sand falls off the edges, stays on the lattice, or wraps around
+SQUARE = ((1, 0), (-1, 0), (0, 1), (0, -1))  # displacements of a site's neighbours on each lattice
+TRIANGULAR = SQUARE + ((1, -1), (-1, 1))  # in axial coordinates: rows are sheared by half a site
+CUBIC = ((1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1))
+
+
+class Lattice:
+    """Graph of the sites of a sandpile. Nodes are numbered 0 to n - 1 and laid out in an array of the given shape;
+    lattices with open boundaries have a ring of sink nodes around them, like Table's grid.
+    The neighbours of node v are indices[indptr[v]:indptr[v + 1]] (repeated for multiple edges), and its degree is
+    their number, the grains it gives away when it topples. Sand given to a sink is lost; sinks have no neighbours.
+    offsets, if not None, are flat offsets giving the neighbours of every node which isn't a sink, which relaxation
+    loops use instead of the neighbour table; the table is then only built when asked for (see csr)"""
+    def __init__(self, shape, sinks, centre, indptr=None, indices=None, offsets=None):
+        self.shape = tuple(int(length) for length in shape)
+        self.sinks = np.asarray(sinks, dtype=bool).reshape(-1)
+        self.centre = centre  # node in the middle of the lattice, where grains are dropped by default
+        self.offsets = offsets
+        self.adjacency = None if indptr is None else (np.asarray(indptr), np.asarray(indices))
+
+    @property
+    def size(self):
+        return len(self.sinks)
+
+    def csr(self):
+        """Returns the indptr and indices arrays of the neighbour table, and the degree of every node"""
+        if self.adjacency is None:
+            nodes = np.flatnonzero(~self.sinks)
+            indices = (nodes[:, None] + np.array(self.offsets)).reshape(-1)
+            degree = np.where(self.sinks, 0, len(self.offsets))
+            self.adjacency = (np.concatenate(([0], np.cumsum(degree))), indices)
+        indptr, indices = self.adjacency
+        return indptr, indices, np.diff(indptr)
+
+    def with_sinks(self, nodes):
+        """Copy of the lattice with the given nodes made sinks too, e.g. so sand can leave a closed or periodic
+        lattice. Their edges are kept, so neighbouring nodes lose the grains they give them"""
+        indptr, indices, degree = self.csr()
+        sinks = self.sinks.copy()
+        sinks[nodes] = True
+        keep = np.repeat(~sinks, degree)
+        return Lattice(self.shape, sinks, self.centre, np.concatenate(([0], np.cumsum(np.where(sinks, 0, degree)))),
+                       indices[keep])
+
+    @classmethod
+    def grid(cls, shape, displacements, boundary="open", neighbours=None):
+        """Lattice of the sites of an array of the given shape, each joined to the sites at the displacements
+        from it, for which neighbours(coordinates, displacement) is True if given.
+        Open lattices are laid out with a ring of sinks around the sites"""
+        if boundary not in BOUNDARIES:
+            raise ValueError(f"Unknown boundary '{boundary}', expected one of {BOUNDARIES}")
+        shape = np.array(shape)
+        layout = shape + 2 if boundary == "open" else shape
+        centre = int(np.ravel_multi_index([ceil((s + 1) / 2) - (boundary != "open") for s in shape], layout))
+        if boundary == "open" and neighbours is None:  # every site has the same neighbours, relative to it
+            sinks = np.ones(layout, dtype=bool)
+            sinks[tuple(slice(1, -1) for _ in shape)] = False
+            strides = np.cumprod(np.r_[layout[1:], 1][::-1])[::-1]
+            return cls(layout, sinks, centre,
+                       offsets=tuple(int(np.dot(displacement, strides)) for displacement in displacements))
+        coords = np.indices(shape).reshape(len(shape), -1)
+        nodes = np.ravel_multi_index(coords + (boundary == "open"), layout)
+        targets = []
+        for displacement in displacements:
+            target = coords + np.array(displacement)[:, None]
+            valid = np.ones(coords.shape[1], dtype=bool) if neighbours is None \
+                else neighbours(coords, displacement)
+            if boundary == "periodic":
+                target %= shape[:, None]
+            elif boundary == "closed":
+                valid &= ((target >= 0) & (target < shape[:, None])).all(axis=0)
+            else:
+                target += 1  # onto the ring of sinks if off the lattice
+            flat = np.full(coords.shape[1], -1)
+            flat[valid] = np.ravel_multi_index(target[:, valid], layout)
+            targets.append(flat)
+        table = np.full((np.prod(layout), len(displacements)), -1)
+        table[nodes] = np.column_stack(targets)
+        degree = (table >= 0).sum(axis=1)
+        sinks = np.ones(np.prod(layout), dtype=bool)
+        sinks[nodes] = False
+        return cls(layout, sinks, centre, np.concatenate(([0], np.cumsum(degree))), table[table >= 0])
+
+    @classmethod
+    def square(cls, M, N, boundary="open"):
+        """M by N square lattice; open ones have the same layout as Table's grid"""
+        return cls.grid((M, N), SQUARE, boundary)
+
+    @classmethod
+    def triangular(cls, M, N, boundary="open"):
+        """M by N triangular lattice, each site with 6 neighbours"""
+        return cls.grid((M, N), TRIANGULAR, boundary)
+
+    @classmethod
+    def hexagonal(cls, M, N, boundary="open"):
+        """M by N hexagonal (honeycomb) lattice in brick wall form, each site with 3 neighbours: left, right,
+        and the site below or above it, alternately"""
+        def neighbours(coords, displacement):
+            if displacement[0] == 0:
+                return np.ones(coords.shape[1], dtype=bool)
+            return (coords.sum(axis=0) % 2 == 0) == (displacement[0] == 1)
+        return cls.grid((M, N), SQUARE, boundary, neighbours)
+
+    @classmethod
+    def cubic(cls, L, M, N, boundary="open"):
+        """L by M by N simple cubic lattice, each site with 6 neighbours"""
+        return cls.grid((L, M, N), CUBIC, boundary)
+
+    @classmethod
+    def from_edges(cls, n, edges, sinks=(), centre=0):
+        """Lattice of the n nodes of an undirected graph with the given (u, v) edges, which may repeat.
+        Sand given to the sink nodes is lost"""
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        sources = np.concatenate((edges[:, 0], edges[:, 1]))
+        targets = np.concatenate((edges[:, 1], edges[:, 0]))
+        is_sink = np.zeros(n, dtype=bool)
+        is_sink[list(sinks)] = True
+        keep = ~is_sink[sources]  # sinks have no neighbours
+        sources, targets = sources[keep], targets[keep]
+        order = np.argsort(sources, kind="stable")
+        degree = np.bincount(sources, minlength=n)
+        return cls((n,), is_sink, centre, np.concatenate(([0], np.cumsum(degree))), targets[order])
@@ -0,0 +1,143 @@
+"""Stabilises very large tables over several processes. The grid is split into horizontal strips held in shared
+memory; in each round of toppling, each process topples its own strip, keeping the sand toppled over its top and
+bottom rows to one side, then passes that sand to the neighbouring strips (the halo exchange).
+The rounds are those of Table.stabilise, so it takes as many of them; relaxing each strip until stable between
+exchanges instead takes far more, as sand goes back and forth across the strips' ends.
+The model is abelian, so the grid and number of topples end up exactly as if stabilised in one process"""
+
+import numpy as np
+from multiprocessing import get_context, shared_memory
+from multiprocessing.connection import wait
+
+
+def strip_bounds(M, workers):
+    """Returns the (first row, last row) of each of up to `workers` strips of rows 1 to M, as even as possible"""
+    edges = np.linspace(1, M + 1, min(workers, M) + 1).astype(int)
+    return [(int(first), int(last) - 1) for first, last in zip(edges[:-1], edges[1:])]
+
+
+def topple_round(block, k, above, below, box):
+    """Topples every site of block (a strip of a grid, with its edge columns) in the (first row, last row,
+    first column, last column) box as many times as it can at once, as a round of Table.stabilise does.
+    Sand toppled over the top and bottom rows is added to the above and below rows instead; sand toppled over the
+    edge columns stays in them. Returns the number of topples and the box of sites which may be critical next,
+    or None if none"""
+    r0, r1, c0, c1 = box
+    height, width = block.shape
+    heights = block[r0:r1 + 1, c0:c1 + 1]
+    topples = (np.maximum(heights, k - 4) - (k - 4)) // 4
+    rows = np.flatnonzero(topples.any(axis=1))
+    if len(rows) == 0:
+        return 0, None
+    cols = np.flatnonzero(topples.any(axis=0))
+    heights -= 4 * topples
+    block[r0:r1 + 1, c0 - 1:c1] += topples
+    block[r0:r1 + 1, c0 + 1:c1 + 2] += topples
+    if r0 == 0:
+        above[c0:c1 + 1] += topples[0]
+        block[:r1, c0:c1 + 1] += topples[1:]
+    else:
+        block[r0 - 1:r1, c0:c1 + 1] += topples
+    if r1 == height - 1:
+        below[c0:c1 + 1] += topples[-1]
+        block[r0 + 1:, c0:c1 + 1] += topples[:-1]
+    else:
+        block[r0 + 1:r1 + 2, c0:c1 + 1] += topples
+    return int(topples.sum()), (max(r0 + rows[0] - 1, 0), min(r0 + rows[-1] + 1, height - 1),
+                                max(c0 + cols[0] - 1, 1), min(c0 + cols[-1] + 1, width - 2))
+
+
+def take_sand(block, row, sand, box):
+    """Adds the sand given to a row of block by a neighbouring strip, and empties it. Returns the box of sites which
+    may be critical, grown to take in the sites given sand"""
+    cols = np.flatnonzero(sand)
+    if len(cols) == 0:
+        return box
+    block[row] += sand
+    sand[...] = 0
+    if box is None:
+        return row, row, cols[0], cols[-1]
+    return min(box[0], row), max(box[1], row), min(box[2], cols[0]), max(box[3], cols[-1])
+
+
+def relax_strip(names, shape, bounds, strip, k, barrier):
+    """Worker process stabilising one strip of the grid in shared memory, see exchange_rounds"""
+    blocks = [shared_memory.SharedMemory(name) for name in names]
+    try:
+        grid, outflow, status = shared_arrays(blocks, shape, len(bounds))
+        exchange_rounds(grid, outflow, status, bounds, strip, k, barrier)
+        del grid, outflow, status  # views of the blocks have to go before they are closed
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def shared_arrays(blocks, shape, strips):
+    """Returns the grid, outflow and status arrays held in the shared memory blocks"""
+    return (np.ndarray(shape, dtype=np.int64, buffer=blocks[0].buf),
+            np.ndarray((strips, 2, shape[1]), dtype=np.int64, buffer=blocks[1].buf),
+            np.ndarray((strips, 2), dtype=np.int64, buffer=blocks[2].buf))
+
+
+def exchange_rounds(grid, outflow, status, bounds, strip, k, barrier):
+    """Stabilises one strip of the grid in lockstep with the other strips, one round at a time. outflow holds the
+    sand each strip toppled over its top and bottom rows in the last round, and status the topples of each strip
+    and whether it may still be critical after taking the sand given to it"""
+    last = len(bounds) - 1
+    first_row, last_row = bounds[strip]
+    block = grid[first_row:last_row + 1]
+    above = grid[first_row - 1] if strip == 0 else outflow[strip, 0]  # the edges of the table are nobody's
+    below = grid[last_row + 1] if strip == last else outflow[strip, 1]
+    box = (0, len(block) - 1, 1, block.shape[1] - 2)
+    while True:
+        if box is not None:
+            topples, box = topple_round(block, k, above, below, box)
+            status[strip, 0] += topples
+        barrier.wait()  # every strip has put the sand it toppled over its ends in outflow
+        if strip > 0:
+            box = take_sand(block, 0, outflow[strip - 1, 1], box)
+        if strip < last:
+            box = take_sand(block, len(block) - 1, outflow[strip + 1, 0], box)
+        status[strip, 1] = box is not None
+        barrier.wait()  # every strip has taken the sand given to it
+        if not status[:, 1].any():
+            return
+
+
+def stabilise_strips(grid, k, workers):
+    """Stabilises grid, an (M + 2) by (N + 2) array of heights with edges like a Table's, in place over up to
+    `workers` processes, one per strip of rows. Returns the number of topples"""
+    bounds = strip_bounds(grid.shape[0] - 2, workers)
+    sizes = (grid.size, 2 * len(bounds) * grid.shape[1], 2 * len(bounds))
+    blocks = [shared_memory.SharedMemory(create=True, size=8 * size) for size in sizes]
+    try:
+        shared, outflow, status = shared_arrays(blocks, grid.shape, len(bounds))
+        shared[...] = grid
+        outflow[...] = 0
+        status[...] = 0
+        context = get_context()
+        barrier = context.Barrier(len(bounds))
+        processes = [context.Process(target=relax_strip, daemon=True,
+                                     args=([block.name for block in blocks], grid.shape, bounds, strip, k, barrier))
+                     for strip in range(len(bounds))]
+        for process in processes:
+            process.start()
+        running = processes
+        while running:
+            wait([process.sentinel for process in running])
+            if any(process.exitcode for process in processes):
+                barrier.abort()  # so the others don't wait for it forever
+            running = [process for process in running if process.exitcode is None]
+        failed = any(process.exitcode for process in processes)
+        if not failed:
+            np.copyto(grid, shared, casting="unsafe")
+        topples = int(status[:, 0].sum())
+        del shared, outflow, status
+        if failed:
+            raise RuntimeError(f"A worker stabilising a strip failed, exit codes "
+                               f"{[process.exitcode for process in processes]}")
+        return topples
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -1,49 +1,113 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
+from scipy.special import zeta
 from math import ceil
+from avalanche_stats import Histogram
+from power_law import fit_power_law, log_bins
 
 
 def get_freq_data(data):
-    """Sorts data ( an array of statistics) into unique data points and the number of each data point"""
+    """Sorts data ( an array of statistics, or a Histogram) into unique data points and the number of each data point"""
+    if isinstance(data, Histogram):
+        return data.freq_data()
     freq = np.bincount(np.array(data))
     unique_val = np.nonzero(freq)[0]
     d1 = np.vstack((unique_val, freq[unique_val])).T
     return [d1[:, 0], d1[:, 1]]
 
 
-def plot_histogram(grid_config, data, observable, x_units):
-    """Plots a histogram of data (array of stats) of an ["observable", "units of observable"]"""
-    plt.hist(data, max(data))
+def show_or_save(path=None):
+    """Shows the current figure, or saves it to path and closes it (e.g. with the Agg backend, headless)"""
+    if path is None:
+        plt.show()
+    else:
+        plt.savefig(path)
+        plt.close()
+
+
+def plot_histogram(grid_config, data, observable, x_units, path=None):
+    """Plots a histogram of data (array of stats, or a Histogram) of an ["observable", "units of observable"].
+    Like the other plots here, it is shown, or saved to path if given"""
+    values, freqs = get_freq_data(data)
+    counts = np.bincount(values, weights=freqs)
+    plt.stairs(counts, np.arange(len(counts) + 1), fill=True)  # one artist, rather than a bar per value
     plt.title(f"Avalanche {observable} for grid size = {grid_config[0]} x {grid_config[1]}")
     plt.xlabel(f"{observable} ({x_units})")
     plt.ylabel("Number of avalanches")
-    plt.show()
+    show_or_save(path)
 
 
-def loglog_plot_stats(grid_config, data, observable, x_units):
+def loglog_plot_stats(grid_config, data, observable, x_units, path=None):
     """Produces loglog plot of the distribution of an observables data
     Data is an array of stats, observable and x_units are strings"""
     [x, freq] = get_freq_data(data)
-    plt.loglog(x, freq, '.', basex=10)
+    plt.loglog(x, freq, '.', base=10)
     plt.title(f"Avalanche distribution for {observable} (Grid size: {grid_config[0]}x{grid_config[1]} )")
     plt.ylabel("Number of avalanches")
     plt.xlabel(f"{observable} ({x_units})")
-    plt.show()
+    show_or_save(path)
 
 
-def power_law_fit_plot(x_data, y_data, xy_legend, units_legend):
-    """Power law fits between x_data and y_data
+def power_law_fit_plot(x_data, y_data, xy_legend, units_legend, params=None, path=None):
+    """Power law fits between x_data and y_data, unless the params of the fit are given. Returns them
     xy_legend = ["name of x_data","name of y_data"], #units legend=[units of x_data,units of y_data]"""
     xData = np.array(x_data)
-    params, p_cov = curve_fit(power_law_func, xData, y_data)
+    if params is None:
+        params, p_cov = curve_fit(power_law_func, xData, y_data)
     plt.plot(xData, y_data, ".")
     plt.plot(np.sort(xData), power_law_func(np.sort(xData), *params), '-')
     plt.legend(["Avalanche data", "Power-law fit: x^%5.3f" % (params[1])])
     plt.title(f"Relationship between {xy_legend[0]} and {xy_legend[1]}")
     plt.xlabel(f"{xy_legend[0]} ({units_legend[0]})")
     plt.ylabel(f"{xy_legend[1]} ({units_legend[1]})")
-    plt.show()
+    show_or_save(path)
+    return params
+
+
+def exp_fit_plot(x_data, y_data, xy_legend, units_legend, params=None, path=None):
+    """Exponential fit of y_data against x_data, as power_law_fit_plot"""
+    xData = np.array(x_data)
+    if params is None:
+        params, p_cov = curve_fit(exp_func, xData, y_data)
+    plt.plot(xData, y_data, ".")
+    plt.plot(np.sort(xData), exp_func(np.sort(xData), *params), '-')
+    plt.legend(["Avalanche data", "Exponential fit: ~ exp(-%5.3fx)" % (params[1])])
+    plt.title(f"Scaling law between {xy_legend[0]} and {xy_legend[1]}")
+    plt.xlabel(f"{xy_legend[0]} ({units_legend[0]})")
+    plt.ylabel(f"{xy_legend[1]} ({units_legend[1]})")
+    show_or_save(path)
+    return params
+
+
+def power_law_mle_plot(grid_config, data, observable, x_units, bins_per_decade=10, fit=None, path=None):
+    """Fits a power law to the distribution of an observable's data (array of stats, or a Histogram) by maximum
+    likelihood, unless the fit is given, and plots it over the log-binned data. With too few avalanches to fit,
+    only the data is plotted.
+    Returns the fit (see power_law.fit_power_law), or None if there wasn't one"""
+    [x, freq] = get_freq_data(data)
+    if fit is None:
+        try:
+            fit = fit_power_law(x, freq)
+        except ValueError:  # too few avalanches to choose x_min
+            fit = None
+    centres, density = log_bins(x, freq, bins_per_decade)
+    plt.loglog(centres, density, '.')
+    if fit is None:
+        plt.legend(["Avalanche data (too few avalanches for a power-law fit)"])
+    else:
+        tail_fraction = fit["n_tail"] / np.sum(freq[x > 0])
+        # Density of the fitted power law over the tail, as a fraction of all avalanches:
+        line_x = centres[centres >= fit["x_min"]]
+        line = tail_fraction * line_x ** -fit["alpha"] / zeta(fit["alpha"], fit["x_min"])
+        plt.loglog(line_x, line, '-')
+        plt.legend(["Avalanche data", "Power-law fit: x^-%5.3f ± %5.3f (x >= %d)" % (fit["alpha"], fit["sigma"],
+                                                                                     fit["x_min"])])
+    plt.title(f"Avalanche distribution for {observable} (Grid size: {grid_config[0]}x{grid_config[1]} )")
+    plt.ylabel("Fraction of avalanches per unit")
+    plt.xlabel(f"{observable} ({x_units})")
+    show_or_save(path)
+    return fit
 
 
 def power_law_func(x, a, b):
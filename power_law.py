@@ -0,0 +1,113 @@
+"""Maximum likelihood fits of discrete power laws P(x) ~ x^-alpha to avalanche histograms, after Clauset,
+Shalizi and Newman (2009). Everything works on (value, count) pairs, as given by get_freq_data or a Histogram,
+so the cost depends on the number of distinct values rather than the number of avalanches"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import minimize_scalar
+from scipy.special import zeta
+from avalanche_stats import Histogram
+
+ALPHA_BOUNDS = (1.0001, 6.0)  # exponents searched by the fits
+MIN_TAIL = 50  # fewest avalanches at or above x_min for it to be tried
+MAX_CANDIDATES = 100  # most values of x_min tried, spread evenly in log x
+
+
+def freq_arrays(values, counts=None):
+    """Returns the values and counts, as int64 arrays without zero or negative values (which a power law can't
+    have). values may instead be a Histogram, with counts None"""
+    if isinstance(values, Histogram):
+        values, counts = values.freq_data()
+    values, counts = np.asarray(values, dtype=np.int64), np.asarray(counts, dtype=np.int64)
+    keep = (values > 0) & (counts > 0)
+    return values[keep], counts[keep]
+
+
+def fit_exponent(n, log_sum, x_min):
+    """Returns the alpha maximising the likelihood of n avalanches at or above x_min, the logs of whose values
+    sum to log_sum: -alpha log_sum - n log zeta(alpha, x_min)"""
+    result = minimize_scalar(lambda alpha: alpha * log_sum + n * np.log(zeta(alpha, x_min)),
+                             bounds=ALPHA_BOUNDS, method="bounded", options={"xatol": 1e-6})
+    return result.x
+
+
+def ks_distance(values, counts, alpha, x_min):
+    """Kolmogorov-Smirnov distance between the tail from x_min of the histogram and the power law fitted to it"""
+    values, counts = values[values >= x_min], counts[values >= x_min]
+    empirical = np.cumsum(counts[::-1])[::-1] / counts.sum()  # fraction of avalanches at or above each value
+    model = zeta(alpha, values) / zeta(alpha, x_min)
+    # The empirical fraction is constant between values, so the distance is greatest just after one or at one:
+    above = np.r_[empirical[1:], 0.0]  # empirical fraction above each value
+    return max(np.abs(empirical - model).max(),
+               np.abs(above - zeta(alpha, values + 1) / zeta(alpha, x_min)).max())
+
+
+def fit_power_law(values, counts=None, x_min=None):
+    """Fits a discrete power law to the tail of a histogram from x_min, chosen as the candidate minimising the
+    Kolmogorov-Smirnov distance of the fit if None. Returns a dict of alpha, its standard error sigma,
+    x_min, the number of avalanches n_tail at or above it, and the KS distance of the fit"""
+    values, counts = freq_arrays(values, counts)
+    # Avalanches and sums of the logs of their values at or above each value:
+    tail_n = np.cumsum(counts[::-1])[::-1]
+    tail_log_sum = np.cumsum((counts * np.log(values))[::-1])[::-1]
+    if x_min is None:
+        candidates = np.flatnonzero(tail_n >= MIN_TAIL)
+        if len(candidates) == 0:
+            raise ValueError(f"At least {MIN_TAIL} avalanches are needed to choose x_min")
+        if len(candidates) > MAX_CANDIDATES:
+            candidates = np.unique(np.searchsorted(values, np.geomspace(values[0], values[candidates[-1]],
+                                                                        MAX_CANDIDATES)))
+        fits = [(ks_distance(values, counts, alpha, values[c]), values[c], alpha)
+                for c in candidates for alpha in [fit_exponent(tail_n[c], tail_log_sum[c], values[c])]]
+        ks, x_min, alpha = min(fits)
+    else:
+        c = np.searchsorted(values, x_min)
+        if c == len(values):
+            raise ValueError(f"No avalanches at or above x_min = {x_min}")
+        alpha = fit_exponent(tail_n[c], tail_log_sum[c], x_min)
+        ks = ks_distance(values, counts, alpha, x_min)
+    n_tail = int(tail_n[np.searchsorted(values, x_min)])
+    return {"alpha": float(alpha), "sigma": float((alpha - 1) / np.sqrt(n_tail)), "x_min": int(x_min),
+            "n_tail": n_tail, "ks": float(ks)}
+
+
+def log_bins(values, counts=None, bins_per_decade=10):
+    """Bins a histogram into bins of equal width in log x. Returns the geometric centre of each non-empty bin and
+    the density of avalanches in it (per unit x, normalised to sum to 1 over all avalanches), for loglog plots"""
+    values, counts = freq_arrays(values, counts)
+    decades = np.log10(values[-1] + 1)
+    edges = np.ceil(np.logspace(0, decades, max(int(np.ceil(decades * bins_per_decade)), 1) + 1))
+    edges = np.unique(np.r_[edges[:-1], values[-1] + 1])  # the last edge is just past the largest value
+    binned, _ = np.histogram(values, edges, weights=counts)
+    widths = np.diff(edges)  # number of integers in each bin, [edge, next edge)
+    full = binned > 0
+    centres = np.sqrt(edges[:-1] * (edges[1:] - 1))[full]
+    return centres, binned[full] / widths[full] / counts.sum()
+
+
+def bootstrap_fit(values, counts, x_min, seed):
+    """Fits a power law to a resampling of the histogram with replacement, with the same number of avalanches"""
+    rng = np.random.default_rng(seed)
+    resampled = rng.multinomial(counts.sum(), counts / counts.sum())
+    return fit_power_law(values, resampled, x_min)["alpha"]
+
+
+def bootstrap_exponent(values, counts=None, x_min=None, n_bootstrap=200, confidence=0.95, seed=None,
+                       workers=None):
+    """Fits a power law to the histogram, and finds a confidence interval for alpha from the fits of n_bootstrap
+    resamplings of it (each choosing its own x_min, unless given), spread over `workers` processes (all cores by
+    default, or in this process if 1). Each resampling gets its own rng stream spawned from seed, so the interval
+    is the same for any number of workers. Returns the fit with low and high bounds on alpha, and the alphas"""
+    values, counts = freq_arrays(values, counts)
+    fit = fit_power_law(values, counts, x_min)
+    seeds = np.random.SeedSequence(seed).spawn(n_bootstrap)
+    args = ([values] * n_bootstrap, [counts] * n_bootstrap, [x_min] * n_bootstrap, seeds)
+    workers = os.cpu_count() if workers is None else workers
+    if workers == 1:
+        alphas = np.array(list(map(bootstrap_fit, *args)))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, n_bootstrap)) as executor:
+            alphas = np.array(list(executor.map(bootstrap_fit, *args, chunksize=max(n_bootstrap // workers, 1))))
+    low, high = np.quantile(alphas, [(1 - confidence) / 2, (1 + confidence) / 2])
+    return {**fit, "low": float(low), "high": float(high), "alphas": alphas}
@@ -1,28 +1,337 @@
 """Bak-Tang-Wiesenfeld sandpile model"""
 
+import os
+import json
+import time
+import pickle
 import numpy as np
 from math import ceil
+from scipy.fft import dstn, idstn
+from lattice import Lattice, SQUARE
+from avalanche_stats import AVALANCHE_DTYPE
+import parallel
+import jit_kernels
 
+ENGINES = ("scalar", "vectorised", "jit")  # relaxation engines a Table can be driven by, jit needing Numba
+DEFAULT_ENGINE = "scalar"  # engine used by Tables that don't ask for one
+DROP_POLICIES = ("centre", "random")  # where add_grains drops a number of grains
+RUN_CHUNK = 4096  # grains whose drop sites run draws at once by default
+CHECKPOINT_FILE = "checkpoint.json"  # metadata of the latest snapshot in a checkpoint directory
 
-def surrounding_pts(i, j):
-    return [(i + 1, j), (i - 1, j), (i, j + 1), (i, j - 1)]
+
+def union_box(box, other):
+    """Smallest (first row, last row, first column, last column) box containing both boxes, either may be None"""
+    if box is None or other is None:
+        return other if box is None else box
+    return min(box[0], other[0]), max(box[1], other[1]), min(box[2], other[2]), max(box[3], other[3])
+
+
+def solve_laplacian(rhs):
+    """Solves L w = rhs on an M by N grid whose edges lose sand, where (L w)[i, j] is 4 w[i, j] less the
+    values of w at the neighbouring sites. The type I discrete sine transform diagonalises L"""
+    M, N = rhs.shape
+    eigenvalues = (4 - 2 * np.cos(np.pi * np.arange(1, M + 1) / (M + 1)))[:, None] \
+        - 2 * np.cos(np.pi * np.arange(1, N + 1) / (N + 1))[None, :]
+    return idstn(dstn(rhs, type=1) / eigenvalues, type=1)
 
 
 class Table:
-    def __init__(self, M, N, k):
+    """Sandpile on an M by N square grid whose edges lose sand. Every engine topples sites on the square lattice
+    only, giving 4 grains away; GraphTable plays on other lattices"""
+    def __init__(self, M, N, k, engine=None, seed=None, dtype=int):
         self.M = M  # number of rows
         self.N = N  # number of columns
         self.k = k  # critical parameter
-        # Initialise M by N grid of zeroes:  # TODO: Get rid of the zero padding?
-        self.grid = np.zeros([M + 2, N + 2], dtype=int)  # extra rows and columns around edges for overflow
+        self.engine = DEFAULT_ENGINE if engine is None else engine  # relaxation engine, see ENGINES
+        if self.engine not in ENGINES:
+            raise ValueError(f"Unknown relaxation engine '{self.engine}', expected one of {ENGINES}")
+        if self.engine == "jit" and not jit_kernels.COMPILED:
+            self.engine = "scalar"  # the kernels would be slower than the scalar engine without Numba
+        dtype = np.dtype(dtype)
+        if dtype.kind not in "iu" or np.iinfo(dtype).max < k + 3 or (dtype.kind == "u" and k < 4):
+            raise ValueError(f"Heights of a table with k = {k} can't be stored as {dtype}")
+        # Initialise M by N grid of zeroes. The edges cost O(M + N) sites, and let every site be toppled the same way
+        self.grid = np.zeros([M + 2, N + 2], dtype=dtype)  # extra rows and columns around edges for overflow
+        self.lattice = Lattice.square(M, N)  # neighbours of each site of the grid, flattened
+        self.degree = 4  # grains a site gives away when it topples, one per neighbour
+        self.offsets = np.array(self.lattice.offsets)  # for array code
+        self.interior_view = None  # see interior
+        self.lost = 0  # grains which fell off a compact table, see compact
+        self.grains = 0  # number of grains added to the table
+        self.rng = np.random.default_rng(seed)  # for random drop sites
+        self.tracer = None  # buffers reused by every avalanche, see tracer_buffers
+        self.tracer_stamp = 0
+        self.toppled_mask = None  # sites toppled in the avalanche by the vectorised engine, all False between them
+        self.reached_order = None  # scratch of the vectorised engine, see topple_front
+        self.jit_scratch = None  # buffers of the jit engine, see jit_buffers
+        self.jit_stamp = 0
+        self.track_changes = False  # whether to record which sites change, from the first pop_changed_sites on
+        self.changed = None  # sites changed since pop_changed_sites, allocated once tracked
+        self.changed_flags = None  # flat view of changed, to mark single sites
+        self.changed_box = None  # (first row, last row, first column, last column) bounding the changed sites
+        self.recorder = None  # avalanche_trace.TraceRecorder to record every topple of every avalanche to
+        self.instruments = None  # instrumentation.Instruments to count topples, time-steps etc. with
+        self.activity = None  # activity.ActivityMaps to accumulate where avalanches topple in
+        self.workers = 1  # processes stabilise splits the grid between, see parallel
+
+    @property
+    def interior(self):
+        """View of the grid without its edges, i.e. the heights of the M by N sites on the table"""
+        if self.interior_view is None or self.interior_view.base is not self.grid:
+            self.interior_view = self.grid[1:self.M + 1, 1:self.N + 1]
+        return self.interior_view
+
+    @property
+    def compact(self):
+        """Whether the grid is stored in a dtype smaller than int64, e.g. uint8 or int16 to save memory.
+        The edges of a compact table can't hold all the sand falling off it, so it is counted in self.lost instead,
+        and adding sand or relaxing raises OverflowError rather than letting a height wrap around"""
+        return self.grid.dtype.itemsize < 8
+
+    def check_heights(self, highest, lowest=0):
+        """Raises OverflowError if heights from lowest to highest can't be stored in the grid"""
+        info = np.iinfo(self.grid.dtype)
+        if highest > info.max or lowest < info.min:
+            raise OverflowError(f"Heights from {lowest} to {highest} don't fit in a {self.grid.dtype} grid")
+
+    def centre(self):
+        """Returns the grid point in the centre of the table"""
+        return int(ceil((self.M + 1) / 2)), int(ceil((self.N + 1) / 2))
 
     def add_grain(self, *args):
         """Function to add a single grain of sand to the table.
         Optional args for position of grain"""
-        if len(args) == 0:  # Drop grain in the centre of the grid:
-            self.grid[int(ceil((self.M + 1) / 2)), int(ceil((self.N + 1) / 2))] += 1
+        i, j = args if args else self.centre()  # Drop grain in the centre of the grid by default
+        if self.compact:
+            self.check_heights(int(self.grid[i, j]) + 1)
+        self.grid[i, j] += 1
+        self.mark_changed(i, i, j, j)
+        self.grains += 1
+
+    def drop_sites(self, n, policy="centre", rng=None):
+        """Returns an (n, 2) array of grid points to drop n grains on, following the drop policy.
+        rng is a numpy Generator or seed for random drops, the table's own rng by default. Each site's row and
+        column are drawn together, so drawing n sites and then m more gives the same sites as drawing n + m"""
+        if policy == "centre":
+            return np.tile(self.centre(), (n, 1))
+        elif policy == "random":
+            rng = self.rng if rng is None else np.random.default_rng(rng)
+            return rng.integers((1, 1), (self.M + 1, self.N + 1), size=(n, 2))
+        raise ValueError(f"Unknown drop policy '{policy}', expected one of {DROP_POLICIES}")
+
+    def add_grains(self, grains, policy="centre", rng=None):
+        """Adds many grains to the table at once, then stabilises it. grains is either an (n, 2) array of grid
+        points or a number of grains to drop following the drop policy. Returns the number of topples"""
+        sites = self.drop_sites(grains, policy, rng) if np.ndim(grains) == 0 else np.asarray(grains)
+        if self.compact and len(sites):
+            flat_sites, counts = np.unique(np.ravel_multi_index((sites[:, 0], sites[:, 1]), self.grid.shape),
+                                           return_counts=True)
+            self.check_heights(int((self.grid.flat[flat_sites] + counts).max()))
+        np.add.at(self.grid, (sites[:, 0], sites[:, 1]), 1)
+        self.mark_changed_sites(sites[:, 0], sites[:, 1])
+        self.grains += len(sites)
+        return self.stabilise()
+
+    def add_grains_with_stats(self, grains, policy="centre", rng=None):
+        """Adds grains to the table as add_grains does, but as if dropped one at a time onto a stable table.
+        Runs of grains which don't cause an avalanche are added at once; only a grain pushing a site over k
+        starts an avalanche. Returns a list of (grain number, avalanche statistics)"""
+        sites = self.drop_sites(grains, policy, rng) if np.ndim(grains) == 0 else np.asarray(grains)
+        flat_sites = np.ravel_multi_index((sites[:, 0], sites[:, 1]), self.grid.shape)
+        avalanches = []
+        start, chunk = 0, 16
+        while start < len(flat_sites):
+            run = flat_sites[start:start + chunk]
+            # Height of each site just after its grain lands, if no avalanche happens first:
+            order = np.argsort(run, kind="stable")
+            sorted_run = run[order]
+            first_of_site = np.flatnonzero(np.r_[True, sorted_run[1:] != sorted_run[:-1]])
+            earlier_grains = np.arange(len(run)) - np.repeat(first_of_site, np.diff(np.r_[first_of_site, len(run)]))
+            landed = np.empty(len(run), dtype=np.int64)
+            landed[order] = self.grid.flat[sorted_run] + earlier_grains + 1
+            critical = np.flatnonzero(landed >= self.k)
+            if len(critical) == 0:  # Quiet run of grains
+                np.add.at(self.grid, np.unravel_index(run, self.grid.shape), 1)
+                start += len(run)
+                chunk *= 2
+                continue
+            quiet = critical[0]
+            np.add.at(self.grid, np.unravel_index(run[:quiet + 1], self.grid.shape), 1)
+            i, j = np.unravel_index(run[quiet], self.grid.shape)
+            avalanches.append((start + quiet, self.execute_avalanche_with_stats(int(i), int(j),
+                                                                                self.grains + start + quiet)))
+            start += quiet + 1
+            chunk = max(2 * (quiet + 1), 16)
+        self.mark_changed_sites(sites[:, 0], sites[:, 1])
+        self.grains += len(flat_sites)
+        return avalanches
+
+    def add_pile(self, n, *args):
+        """Adds n grains of sand to a single site at once, then stabilises the table.
+        Optional args for position of pile (centre by default). Returns the number of topples"""
+        i, j = self.centre() if len(args) == 0 else args
+        self.check_heights(int(self.grid[i, j]) + n)
+        self.grid[i, j] += n
+        self.mark_changed(i, i, j, j)
+        self.grains += n
+        return self.stabilise()
+
+    def run(self, n_grains, drop_policy="centre", seed=None, chunk=RUN_CHUNK):
+        """Drops n_grains grains one at a time following the drop policy, each avalanche relaxing before the next
+        grain. seed is an rng or seed for random drops, the table's own rng by default.
+        Returns a structured array of AVALANCHE_DTYPE with a row per avalanche: the number of the grain which
+        caused it, its statistics and the density of sand after it. Drop sites are drawn chunk grains at a time,
+        the array (room for a chunk's avalanches at first) grows by doubling, and the sand on the table is kept as
+        a running total, so nothing scans the whole grid. The avalanches don't depend on chunk"""
+        rng = self.rng if seed is None else np.random.default_rng(seed)
+        avalanches = np.zeros(min(n_grains, chunk), dtype=AVALANCHE_DTYPE)
+        n_avalanches = 0
+        sand = int(self.interior.sum())
+        fallen = self.sand_off_table()
+        for start in range(0, n_grains, chunk):
+            for i, j in self.drop_sites(min(chunk, n_grains - start), drop_policy, rng).tolist():
+                self.add_grain(i, j)
+                sand += 1
+                if not self.is_critical_site(i, j):
+                    continue
+                stats = self.execute_avalanche_with_stats(i, j)
+                sand += fallen
+                fallen = self.sand_off_table()
+                sand -= fallen
+                if n_avalanches == len(avalanches):
+                    avalanches = np.concatenate((avalanches, np.zeros_like(avalanches)))
+                avalanches[n_avalanches] = (self.grains - 1, stats['size'], stats['lifetime'], stats['area'],
+                                            stats['radius'], sand / (self.M * self.N))
+                n_avalanches += 1
+        return avalanches[:n_avalanches]
+
+    def sand_off_table(self):
+        """Returns the number of grains which have fallen off the table, onto its edges or counted in self.lost"""
+        grid = self.grid
+        return (self.lost + int(grid[0].sum()) + int(grid[-1].sum()) + int(grid[1:-1, 0].sum())
+                + int(grid[1:-1, -1].sum()))
+
+    def mark_changed(self, r0, r1, c0, c1, mask=None):
+        """Records that the sites in rows r0 to r1 and columns c0 to c1 (those flagged in the boolean mask,
+        if given) have changed, if tracked"""
+        if not self.track_changes:
+            return
+        if mask is None:
+            self.changed[r0:r1 + 1, c0:c1 + 1] = True
         else:
-            self.grid[args[0], args[1]] += 1
+            self.changed[r0:r1 + 1, c0:c1 + 1] |= mask
+        self.changed_box = union_box(self.changed_box, (r0, r1, c0, c1))
+
+    def mark_changed_sites(self, rows, cols):
+        """Records that the sites at the arrays of rows and columns have changed, if tracked"""
+        if self.track_changes and len(rows):
+            self.changed[rows, cols] = True
+            self.changed_box = union_box(self.changed_box, (rows.min(), rows.max(), cols.min(), cols.max()))
+
+    def mark_toppled(self, sites):
+        """Records that the array of flat sites toppled, changing them and their neighbours"""
+        sites = (sites[:, None] + np.array((0,) + self.lattice.offsets)).reshape(-1)
+        self.mark_changed_sites(*np.divmod(sites, self.N + 2))
+
+    def pop_changed_sites(self):
+        """Returns arrays of the rows and columns of sites on the table which changed since the last call
+        (e.g. to redraw them), and forgets them. Tables only track them once this is first called, which returns
+        every site, so relaxing costs nothing extra for tables nobody asks"""
+        if not self.track_changes:
+            self.track_changes = True
+            self.changed = np.zeros(self.grid.shape, dtype=bool)
+            self.changed_flags = memoryview(self.changed.reshape(-1))
+            rows, cols = np.indices([self.M, self.N]).reshape(2, -1)
+            return rows + 1, cols + 1
+        if self.changed_box is None:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        r0, r1, c0, c1 = self.changed_box
+        box = self.changed[r0:r1 + 1, c0:c1 + 1]
+        rows, cols = np.nonzero(box)
+        box[...] = False
+        self.changed_box = None
+        on_table = (rows + r0 >= 1) & (rows + r0 <= self.M) & (cols + c0 >= 1) & (cols + c0 <= self.N)
+        return rows[on_table] + r0, cols[on_table] + c0
+
+    def flat_grid(self):
+        """Returns a flat memoryview of the grid, whose items are plain ints for fast scalar access"""
+        if not self.grid.flags.c_contiguous:
+            self.grid = np.ascontiguousarray(self.grid)
+        return memoryview(self.grid.reshape(-1))
+
+    def tracer_buffers(self):
+        """Returns the buffers for execute_avalanche_with_stats, allocated once per grid size:
+        flags for sites off the table, visited flags, toppled sites, two frontiers and queued time-step stamps"""
+        size = (self.M + 2) * (self.N + 2)
+        if self.tracer is None or len(self.tracer[0]) != size:
+            self.tracer = (bytearray(self.lattice.sinks.tobytes()), bytearray(size), [0] * size, [0] * size,
+                           [0] * size, [0] * size)
+            self.tracer_stamp = 0
+        return self.tracer
+
+    def jit_buffers(self):
+        """Returns the buffers for the jit engine's kernels, allocated once per grid size: visited flags (also the
+        stabiliser's flags for sites on its stack), toppled sites (also its stack), two frontiers and queued
+        time-step stamps"""
+        size = (self.M + 2) * (self.N + 2)
+        if self.jit_scratch is None or len(self.jit_scratch[0]) != size:
+            self.jit_scratch = (np.zeros(size, dtype=np.uint8), np.zeros(size, dtype=np.int64),
+                                np.zeros(size, dtype=np.int64), np.zeros(size, dtype=np.int64),
+                                np.zeros(size, dtype=np.int64))
+            self.jit_stamp = 0
+        return self.jit_scratch
+
+    def save_checkpoint(self, directory, stats=None, params=None):
+        """Snapshots the table, and optionally statistics accumulated so far, to directory. params (a dict of JSON
+        values) describe the run, so it can only be resumed by the same run, see load_checkpoint.
+        Snapshots alternate between two grid .npy files, and the metadata naming the latest is replaced last,
+        so a run which dies while writing resumes from the previous snapshot"""
+        os.makedirs(directory, exist_ok=True)
+        metadata_path = os.path.join(directory, CHECKPOINT_FILE)
+        slot = 0
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                slot = 1 - json.load(f)["slot"]
+        grid_path = os.path.join(directory, f"grid_{slot}.npy")
+        try:  # Reuse the slot's file if it holds a grid of the same shape
+            saved_grid = np.load(grid_path, mmap_mode="r+")
+            if saved_grid.shape != self.grid.shape or saved_grid.dtype != self.grid.dtype:
+                raise ValueError
+        except (OSError, ValueError):
+            saved_grid = np.lib.format.open_memmap(grid_path, mode="w+", dtype=self.grid.dtype,
+                                                   shape=self.grid.shape)
+        saved_grid[...] = self.grid
+        del saved_grid  # unmapping leaves the write in the page cache, which outlives this process
+        if stats is not None:
+            with open(os.path.join(directory, f"stats_{slot}.pkl"), "wb") as f:
+                pickle.dump(stats, f)
+        metadata = {"M": self.M, "N": self.N, "k": self.k, "engine": self.engine, "dtype": self.grid.dtype.str,
+                    "lost": self.lost, "grains": self.grains,
+                    "rng": self.rng.bit_generator.state, "slot": slot, "stats": stats is not None, "params": params}
+        with open(metadata_path + ".tmp", "w") as f:
+            json.dump(metadata, f)
+        os.replace(metadata_path + ".tmp", metadata_path)
+
+    @classmethod
+    def load_checkpoint(cls, directory, params=None):
+        """Resumes a table from the latest snapshot in directory. Returns the table and the statistics saved
+        with it (None if there weren't any). Raises ValueError if params are given and aren't those the snapshot
+        was saved with"""
+        with open(os.path.join(directory, CHECKPOINT_FILE)) as f:
+            metadata = json.load(f)
+        if params is not None and metadata.get("params") != params:
+            raise ValueError(f"The checkpoint in {directory} is of a run with {metadata.get('params')}, "
+                             f"not {params}")
+        table = cls(metadata["M"], metadata["N"], metadata["k"], engine=metadata["engine"], dtype=metadata["dtype"])
+        table.grid = np.array(np.load(os.path.join(directory, f"grid_{metadata['slot']}.npy"), mmap_mode="r"))
+        table.lost = metadata["lost"]
+        table.grains = metadata["grains"]
+        table.rng.bit_generator.state = metadata["rng"]
+        stats = None
+        if metadata["stats"]:
+            with open(os.path.join(directory, f"stats_{metadata['slot']}.pkl"), "rb") as f:
+                stats = pickle.load(f)
+        return table, stats
 
     def is_critical_site(self, i_check, j_check):
         """Checks if any avalanches will occur at (m,n)"""
@@ -30,9 +339,211 @@ class Table:
 
     def topple(self, i_topple, j_topple):
         """Perform a toppling process at the grid point (m,n)"""
-        self.grid[i_topple, j_topple] -= 4  # 4 grains topple
-        for pt in surrounding_pts(i_topple, j_topple):
-            self.grid[pt[0], pt[1]] += 1  # surroundings gain a grain
+        heights = self.flat_grid()
+        site = i_topple * (self.N + 2) + j_topple
+        heights[site] -= self.degree  # a grain for each neighbour topples
+        for offset in self.lattice.offsets:
+            heights[site + offset] += 1  # surroundings gain a grain
+        if not self.track_changes:
+            return
+        changed = self.changed_flags
+        changed[site] = True
+        for offset in self.lattice.offsets:
+            changed[site + offset] = True
+        # Grow the changed box by the site and its surroundings, in plain ints as this runs for every topple:
+        box = self.changed_box
+        if box is None:
+            self.changed_box = (i_topple - 1, i_topple + 1, j_topple - 1, j_topple + 1)
+        elif i_topple <= box[0] or i_topple >= box[1] or j_topple <= box[2] or j_topple >= box[3]:
+            self.changed_box = (min(box[0], i_topple - 1), max(box[1], i_topple + 1), min(box[2], j_topple - 1),
+                                max(box[3], j_topple + 1))
+
+    def topple_counts(self, r0, c0, topples):
+        """Topples each site in the block with top left corner (r0,c0) the number of times given by the
+        integer array topples, all at once"""
+        h, w = topples.shape
+        block = self.grid[r0 - 1:r0 + h + 1, c0 - 1:c0 + w + 1]  # view, one site bigger on each side
+        # A compact grid's heights wrap around as topples are added, but end up right if they end up in range:
+        counts = topples.astype(block.dtype, copy=False)
+        block[1:-1, 1:-1] -= 4 * counts
+        block[2:, 1:-1] += counts  # surroundings gain a grain per topple
+        block[:-2, 1:-1] += counts
+        block[1:-1, 2:] += counts
+        block[1:-1, :-2] += counts
+        if self.compact:
+            self.drain_edges(r0, c0, topples, block)
+
+    def drain_edges(self, r0, c0, topples, block):
+        """Counts the grains which the topples of the block with top left corner (r0,c0) sent off a compact table
+        in self.lost, and empties the edges of the table in block (the grid around it) that they landed on"""
+        h, w = topples.shape
+        if r0 == 1:
+            self.lost += int(topples[0].sum())
+            block[0] = 0
+        if r0 + h == self.M + 1:
+            self.lost += int(topples[-1].sum())
+            block[-1] = 0
+        if c0 == 1:
+            self.lost += int(topples[:, 0].sum())
+            block[:, 0] = 0
+        if c0 + w == self.N + 1:
+            self.lost += int(topples[:, -1].sum())
+            block[:, -1] = 0
+
+    def drain_ring(self):
+        """Counts the grains on the edges of a compact table in self.lost, and empties them"""
+        if self.compact:
+            for edge in (self.grid[0], self.grid[-1], self.grid[1:-1, 0], self.grid[1:-1, -1]):
+                self.lost += int(edge.sum())
+                edge[...] = 0
+
+    def stabilise(self, least_action=False):
+        """Topples until no site on the table is critical, returning the total number of topples.
+        Each round topples every site as many times as it can at once and passes the matching multiple
+        of grains to its neighbours. The model is abelian, so the grid ends up as if toppled one at a time.
+        least_action first topples every site as often as it is certain to (see least_action_topples), which
+        pays off when most of the table is far above critical.
+        With more than one worker, the rounds are run over strips of the grid in that many processes instead
+        (see parallel), which only pays off for very large tables; not while activity maps are attached, as the
+        workers don't count the topples of each site. Each call starts its processes and shared memory afresh,
+        which costs tens of milliseconds (50 to 70 ms with 2 workers, 130 ms with 4, on a single core), so
+        strips only pay off for stabilisations which take far longer than that"""
+        started = time.perf_counter() if self.instruments is not None else None
+        a_topples = self.least_action_topples() if least_action else 0
+        if self.workers > 1 and self.activity is None:
+            return a_topples + self.stabilise_strips(started)
+        if self.engine == "jit" and self.instruments is None:
+            return a_topples + self.stabilise_jit()
+        r0, r1, c0, c1 = 1, self.M, 1, self.N  # block of sites which may be critical
+        toppled_box = None  # bounds all sites toppled
+        while r0 <= r1 and c0 <= c1:
+            heights = self.grid[r0:r1 + 1, c0:c1 + 1]
+            topples = (np.maximum(heights, self.k - 4) - (self.k - 4)) // 4  # times each site can topple
+            rows = np.flatnonzero(topples.any(axis=1))
+            if len(rows) == 0:
+                break
+            cols = np.flatnonzero(topples.any(axis=0))
+            round_topples = int(topples.sum())
+            a_topples += round_topples
+            if self.compact:  # sites are left with under k grains, then gain one per topple of each neighbour
+                self.check_heights(self.k - 1 + 4 * int(topples.max()))
+            if self.instruments is not None:
+                self.instruments.timestep(self, round_topples, heights.size)
+            if self.activity is not None:
+                self.activity.add_counts(r0, c0, topples)
+            self.topple_counts(r0, c0, topples)
+            toppled_box = union_box(toppled_box, (r0 + rows[0], r0 + rows[-1], c0 + cols[0], c0 + cols[-1]))
+            # Only sites next to a toppled site can become critical:
+            r0, r1 = max(r0 + rows[0] - 1, 1), min(r0 + rows[-1] + 1, self.M)
+            c0, c1 = max(c0 + cols[0] - 1, 1), min(c0 + cols[-1] + 1, self.N)
+        if toppled_box is not None:  # every site in the box, and one site around it, may have changed
+            self.mark_changed(toppled_box[0] - 1, toppled_box[1] + 1, toppled_box[2] - 1, toppled_box[3] + 1)
+        if self.instruments is not None:
+            self.instruments.add_time("stabilise", time.perf_counter() - started)
+        return a_topples
+
+    def stabilise_jit(self):
+        """Stabilises the table with the compiled kernel, returning the number of topples"""
+        heights = self.grid.reshape(-1)
+        in_stack, stack = self.jit_buffers()[:2]
+        topples, fallen, first, last = jit_kernels.stabilise_grid(
+            heights, self.lattice.sinks, np.array(self.lattice.offsets), stack, in_stack, self.k, self.compact,
+            np.iinfo(self.grid.dtype).max, *self.jit_odometer())
+        if topples < 0:
+            raise OverflowError(f"A height doesn't fit in a {self.grid.dtype} grid")
+        if self.compact:
+            self.lost += fallen
+        if topples:
+            self.mark_changed(first // (self.N + 2) - 1, last // (self.N + 2) + 1, 0, self.N + 1)
+        return topples
+
+    def jit_odometer(self):
+        """Returns the odometer for the jit engine's kernels to count topples in, and whether to"""
+        if self.activity is None:
+            return np.zeros(0, dtype=np.int64), False
+        return self.activity.topples.reshape(-1), True
+
+    def stabilise_strips(self, started):
+        """Stabilises the table over self.workers processes, returning the number of topples"""
+        grid = self.grid.astype(np.int64) if self.compact else self.grid  # the edges have to hold the lost sand
+        topples = parallel.stabilise_strips(grid, self.k, self.workers)
+        if self.compact:
+            self.interior[...] = grid[1:-1, 1:-1]
+            self.lost += int(grid.sum() - grid[1:-1, 1:-1].sum())
+        if topples:
+            self.mark_changed(0, self.M + 1, 0, self.N + 1)
+        if self.instruments is not None:
+            self.instruments.add_time("stabilise", time.perf_counter() - started)
+        return topples
+
+    def least_action_topples(self):
+        """Topples every site, all at once, the number of times it is certain to topple while stabilising.
+        If w solves L w = heights - (k - 1), with L the Laplacian (4 w less its neighbours, sand falling off the
+        table), then the final heights are at most k - 1 so the odometer u of stabilisation has L (u - w) >= 0,
+        which means u >= w. Toppling floor(w) first leaves the same final grid (least action principle).
+        Returns the number of topples"""
+        w = solve_laplacian(self.interior - (self.k - 1.0))
+        w -= 1e-9 * np.abs(w).max() + 1e-6  # guard against rounding up past the true odometer
+        topples = np.maximum(np.floor(w), 0).astype(np.int64)
+        if self.activity is not None:
+            self.activity.add_counts(1, 1, topples)
+        self.topple_counts(1, 1, topples)
+        if topples.any():
+            self.mark_changed(0, self.M + 1, 0, self.N + 1)
+        return int(topples.sum())
+
+    def add_configuration(self, heights):
+        """Adds an M by N array of heights (or another Table's grid without edges) to the table and stabilises,
+        the sandpile group operation. Returns the number of topples"""
+        total = self.interior + np.asarray(heights, dtype=np.int64)
+        self.check_heights(int(total.max()), int(total.min()))
+        self.interior[...] = total
+        self.mark_changed(1, self.M, 1, self.N)
+        return self.stabilise(least_action=True)
+
+    @classmethod
+    def max_stable(cls, M, N, k, dtype=int, engine=None, workers=1):
+        """Table with k - 1 grains on every site, the largest stable configuration.
+        engine and workers are the table's, see ENGINES and stabilise"""
+        table = cls(M, N, k, engine=engine, dtype=dtype)
+        table.workers = workers
+        table.interior[...] = k - 1
+        return table
+
+    @classmethod
+    def identity(cls, M, N, k, dtype=int, engine=None, workers=1):
+        """Table holding the identity of the sandpile group, e = (2 m - (2 m)°)° for m the maximal stable
+        configuration and ° meaning stabilised. Both stabilisations use the engine and workers given, after
+        least_action_topples. That does most of the topples, but leaves some to topple one site at a time, 2 10^8 at
+        256 by 256, and their number grows as the fourth power of the side, so even the "jit" engine, by far the
+        fastest, takes 5 s for a 256 by 256 table, 80 s for 512 by 512 and 24 minutes for 1024 by 1024 (on one core)"""
+        double_max = cls.max_stable(M, N, k, dtype, engine, workers)
+        double_max.add_configuration(k - 1)
+        table = cls(M, N, k, engine=engine, dtype=dtype)
+        table.workers = workers
+        table.add_configuration(2 * (k - 1) - double_max.interior.astype(np.int64))
+        return table
+
+    @classmethod
+    def random_recurrent(cls, M, N, k, seed=None, dtype=int, engine=None, workers=1):
+        """Table holding a random recurrent configuration, the maximal stable configuration plus a uniformly
+        random one of up to k - 1 grains per site, stabilised. Anything reached from the maximal stable
+        configuration by adding grains is recurrent, so runs can start at criticality"""
+        table = cls.max_stable(M, N, k, dtype, engine, workers)
+        table.rng = np.random.default_rng(seed)
+        table.add_configuration(table.rng.integers(0, k, [M, N]))
+        return table
+
+    def is_recurrent(self):
+        """Burning test: a stable configuration is recurrent iff adding a grain for every edge to the
+        sink (falling off the table) makes every site topple exactly once and gives back the same grid"""
+        burnt = Table(self.M, self.N, self.k, dtype=self.grid.dtype)
+        heights = self.interior
+        burnt.interior[...] = heights
+        burnt.grid[[1, self.M], 1:self.N + 1] += 1
+        burnt.grid[1:self.M + 1, [1, self.N]] += 1
+        return (heights.max(initial=0) < self.k and burnt.stabilise() == self.M * self.N
+                and np.array_equal(burnt.interior, heights))
 
     # TODO: Subclass for Avalanche; new instance can be made when new grain is added (by gui module)
     #       methods: execute_timestep.
@@ -45,51 +556,643 @@ class Table:
         new_critical_sites = set()
         if self.is_critical_site(i, j):  # if the point is in the critical point, topple it and check surrounds
             self.topple(i, j)
-
-            for site in surrounding_pts(i, j):  # Now check all cells surrounding, to see if avalanches will occur
-                r, c = site
-                if not (r == 0 or r == self.M + 1 or c == 0 or c == self.N + 1):
-                    if self.is_critical_site(r, c):
-                        new_critical_sites.add((r, c))  # Re-Adding a point shouldn't cause issue, as it is checked
+            heights = self.flat_grid()
+            site = i * (self.N + 2) + j
+            for offset in self.lattice.offsets:  # Now check all cells surrounding, to see if avalanches will occur
+                pt = site + offset
+                if not self.lattice.sinks[pt] and heights[pt] >= self.k:
+                    # Re-Adding a point shouldn't cause issue, as it is checked
+                    new_critical_sites.add(divmod(pt, self.N + 2))
         return new_critical_sites
 
     def execute_timestep(self, sites_to_be_toppled):
         """Topples sites within a single timestep, and returns new critical sites
         which will be need to be toppled in the next timestep."""
+        if self.engine == "vectorised":
+            return self.execute_timestep_vectorised(sites_to_be_toppled)
+        if self.instruments is not None:
+            started = time.perf_counter()
+            topples = sum(self.is_critical_site(i, j) for i, j in sites_to_be_toppled)
         next_timestep_critical_sites = set()
         for site in sites_to_be_toppled:  # order doesn't matter
             new_critical_sites = self.execute_topple(site[0], site[1])
             next_timestep_critical_sites = next_timestep_critical_sites.union(new_critical_sites)
+        self.drain_ring()
+        if self.instruments is not None:
+            self.instruments.timestep(self, topples, len(sites_to_be_toppled) + self.degree * topples)
+            self.instruments.add_time("timestep", time.perf_counter() - started)
         return next_timestep_critical_sites
 
-    def execute_avalanche_with_stats(self, i_0, j_0):
-        """Execute the avalanche starting at the point (m,n)"""
+    def execute_avalanche_with_stats(self, i_0, j_0, grain=None):
+        """Execute the avalanche starting at the point (m,n).
+        grain is the number of the grain which caused it for the recorder, the last one added by default"""
+        if self.engine == "vectorised":
+            return self.execute_avalanche_vectorised(i_0, j_0, grain)
+        if self.engine == "jit" and self.recorder is None and self.instruments is None:
+            return self.execute_avalanche_jit(i_0, j_0)
+        started = time.perf_counter() if self.instruments is not None else None
+        heights = self.flat_grid()
+        sinks, visited, toppled_sites, frontier, next_frontier, queued = self.tracer_buffers()
+        width = self.N + 2
+        k = self.k
+        offsets = self.lattice.offsets
+        degree = self.degree
+        fallen = []  # sites off the table which sand fell onto, once per grain
         a_size = 0  # Avalanche size - number of grains displaced during avalanche
         a_time = 0  # Avalanche lifetime- number of time-steps taken to relax to critical state
-        origin_pt = [i_0, j_0]  # Avalanche starts a t (i_0, j_0)
-        site_distances = []  # A list of the distances of toppling sites from origin
-        topple_pts = [[i_0, j_0]]  # A list for storing surrounding pts which need to be toppled
-        topple_sites = [[i_0, j_0]]  # Sites to be toppled
-        while topple_pts:
-            for pt in topple_pts:
-                i, j = pt
+        a_area = 0  # Avalanche area- number of unique sites toppled
+        a_radius = 0  # Avalanche radius- max number of sites away from initial point that the avalanche reaches
+        frontier[0] = i_0 * width + j_0  # Avalanche starts at (i_0, j_0)
+        n_frontier = 1  # Sites to be toppled this time-step are frontier[:n_frontier]
+        try:
+            while n_frontier:
+                self.tracer_stamp += 1  # marks sites queued for the next time-step
+                n_next = 0
+                for t in range(n_frontier):
+                    site = frontier[t]
+                    heights[site] -= degree  # a grain for each neighbour topples
+                    if not visited[site]:  # A unique site toppled in the avalanche
+                        visited[site] = 1
+                        toppled_sites[a_area] = site
+                        a_area += 1
+                        i, j = divmod(site, width)
+                        a_radius = max(a_radius, abs(i - i_0) + abs(j - j_0))  # x+y distance from origin
+                    for offset in offsets:
+                        pt = site + offset
+                        if sinks[pt]:  # Sand falling off the table can't topple
+                            fallen.append(pt)
+                            continue
+                        height = heights[pt] + 1  # surroundings gain a grain
+                        heights[pt] = height
+                        # Each site topples once per time-step:
+                        if height >= k and queued[pt] != self.tracer_stamp:
+                            queued[pt] = self.tracer_stamp
+                            next_frontier[n_next] = pt
+                            n_next += 1
+                a_size += degree * n_frontier  # a grain per neighbour displaced per topple
+                a_time += 1  # Count a time-step
+                if self.recorder is not None:
+                    self.recorder.sites.extend(frontier[:n_frontier])
+                    self.recorder.counts.append(n_frontier)
+                if self.activity is not None:
+                    self.activity.sites.extend(frontier[:n_frontier])
+                if self.instruments is not None:
+                    self.instruments.timestep(self, n_frontier, degree * n_frontier)
+                frontier, next_frontier, n_frontier = next_frontier, frontier, n_next
+        except ValueError:  # a height outside the range of a compact grid's memoryview
+            raise OverflowError(f"A height doesn't fit in a {self.grid.dtype} grid") from None
+        for site in toppled_sites[:a_area]:  # Only clear the visited sites
+            visited[site] = 0
+        if self.compact:
+            self.lost += len(fallen)
+        elif fallen:
+            np.add.at(self.grid.reshape(-1), fallen, 1)
+        if self.track_changes or self.activity is not None:
+            toppled = np.array(toppled_sites[:a_area], dtype=np.int64)
+        if self.track_changes:
+            self.mark_toppled(toppled)
+        if self.recorder is not None:
+            self.recorder.end_avalanche(self.grains - 1 if grain is None else grain, i_0 * width + j_0, a_time)
+        stats = {'size': a_size, 'lifetime': a_time, 'area': a_area, 'radius': a_radius}
+        if self.activity is not None:
+            self.activity.add_sites(toppled)
+            stats.update(self.activity.end_avalanche())
+        if self.instruments is not None:
+            self.instruments.avalanche(self, stats, time.perf_counter() - started)
+        return stats
+
+    def execute_avalanche_jit(self, i_0, j_0):
+        """execute_avalanche_with_stats, with the compiled tracer"""
+        width = self.N + 2
+        visited, toppled, frontier, next_frontier, queued = self.jit_buffers()
+        a_size, a_time, a_area, a_radius, fallen, self.jit_stamp = jit_kernels.trace_avalanche(
+            self.grid.reshape(-1), self.lattice.sinks, np.array(self.lattice.offsets), visited, toppled, frontier,
+            next_frontier, queued, self.jit_stamp, i_0 * width + j_0, width, self.k, self.compact,
+            np.iinfo(self.grid.dtype).max, *self.jit_odometer())
+        if a_time < 0:
+            raise OverflowError(f"A height doesn't fit in a {self.grid.dtype} grid")
+        if self.compact:
+            self.lost += fallen
+        toppled = toppled[:a_area]
+        if self.track_changes:
+            self.mark_toppled(toppled)
+        stats = {'size': a_size, 'lifetime': a_time, 'area': a_area, 'radius': a_radius}
+        if self.activity is not None:
+            self.activity.add_sites(toppled)
+            stats.update(self.activity.end_avalanche())
+        return stats
+
+    def topple_front(self, front):
+        """Topples each of the distinct flat sites in the array front once, all at once.
+        Returns the flat sites which gained grains and are now critical, once each"""
+        heights = self.grid.reshape(-1)
+        heights[front] -= self.degree  # a grain for each neighbour topples
+        reached = (front[:, None] + self.offsets).reshape(-1)
+        np.add.at(heights, reached, 1)  # surroundings gain a grain per toppled neighbour
+        if self.compact:
+            fallen = reached[self.lattice.sinks[reached]]
+            self.lost += len(fallen)
+            heights[fallen] = 0
+        # Each site reached once, without sorting: the last of its grains to be stamped on it
+        if self.reached_order is None or len(self.reached_order) != heights.size:
+            self.reached_order = np.zeros(heights.size, dtype=np.int64)
+        order = np.arange(len(reached))
+        self.reached_order[reached] = order
+        reached = reached[self.reached_order[reached] == order]
+        return reached[(heights[reached] >= self.k) & ~self.lattice.sinks[reached]]
+
+    def execute_timestep_vectorised(self, sites_to_be_toppled):
+        """Array version of execute_timestep: topples all critical sites within the timestep at once"""
+        started = time.perf_counter() if self.instruments is not None else None
+        sites = np.array(list(sites_to_be_toppled), dtype=np.int64).reshape(-1, 2)
+        front = sites[:, 0] * (self.N + 2) + sites[:, 1]
+        front = front[self.grid.reshape(-1)[front] >= self.k]
+        if self.instruments is not None:
+            self.instruments.timestep(self, len(front), len(sites) + self.degree * len(front))
+        critical = self.topple_front(front) if len(front) else front
+        if self.track_changes:
+            self.mark_toppled(front)
+        rows, cols = np.divmod(critical, self.N + 2)
+        if self.instruments is not None:
+            self.instruments.add_time("timestep", time.perf_counter() - started)
+        return set(zip(rows.tolist(), cols.tolist()))
+
+    def execute_avalanche_vectorised(self, i_0, j_0, grain=None):
+        """Array version of execute_avalanche_with_stats: each time-step topples every critical site at once,
+        as an array of the sites of the avalanche front. Only pays off for avalanches whose fronts are long,
+        as each time-step costs a few numpy calls however few sites topple; see benchmark"""
+        started = time.perf_counter() if self.instruments is not None else None
+        width = self.N + 2
+        a_size = 0
+        a_time = 0
+        a_area = 0
+        a_radius = 0
+        if self.toppled_mask is None or len(self.toppled_mask) != self.grid.size:
+            self.toppled_mask = np.zeros(self.grid.size, dtype=bool)
+        toppled = self.toppled_mask  # unique sites toppled in the avalanche
+        first_topples = []  # sites toppling for the first time, per time-step
+        front = np.array([i_0 * width + j_0], dtype=np.int64)
+        try:
+            while len(front):
+                first = front[~toppled[front]]
+                toppled[first] = True
+                first_topples.append(first)
+                a_area += len(first)
+                a_size += self.degree * len(front)  # a grain per neighbour displaced per topple
+                rows, cols = np.divmod(first, width)
+                if len(first):
+                    a_radius = max(a_radius, int((np.abs(rows - i_0) + np.abs(cols - j_0)).max()))
+                a_time += 1
+                if self.recorder is not None:
+                    self.recorder.sites.frombytes(front.tobytes())
+                    self.recorder.counts.append(len(front))
+                if self.activity is not None:
+                    self.activity.sites.frombytes(front.tobytes())
+                    self.activity.add_sites(first)
+                if self.instruments is not None:
+                    self.instruments.timestep(self, len(front), self.degree * len(front))
+                front = self.topple_front(front)
+        finally:  # Only clear the toppled sites, so the mask is ready for the next avalanche
+            toppled[np.concatenate(first_topples)] = False
+        if self.track_changes:
+            self.mark_toppled(np.concatenate(first_topples))
+        if self.recorder is not None:
+            self.recorder.end_avalanche(self.grains - 1 if grain is None else grain, i_0 * width + j_0, a_time)
+        stats = {'size': a_size, 'lifetime': a_time, 'area': a_area, 'radius': a_radius}
+        if self.activity is not None:
+            stats.update(self.activity.end_avalanche())
+        if self.instruments is not None:
+            self.instruments.avalanche(self, stats, time.perf_counter() - started)
+        return stats
+
+
+class TiledTable:
+    """Sandpile on an unbounded square lattice, stored as tile_size by tile_size tiles which are only allocated
+    once sand reaches them, so memory follows the pile instead of a fixed M by N table. Sites are (i, j) for
+    any integers, with the origin (0, 0) in the middle of the pile by default.
+    Tiles are relaxed by copying them into Tables (see window): avalanches are traced by the given engine (see
+    ENGINES), while stabilise topples whole tiles at once with array code whatever the engine"""
+    def __init__(self, k, tile_size=64, seed=None, engine=None):
+        self.k = k  # critical parameter
+        self.tile_size = tile_size
+        self.engine = engine
+        self.tiles = {}  # (tile row, tile column): heights of the tile's sites
+        self.blocks = {}  # side in tiles: Table the tiles are copied into, the single tile one and the last bigger one
+        self.grains = 0  # number of grains added to the table
+        self.rng = np.random.default_rng(seed)
+
+    def tile(self, key):
+        """Returns the tile with the given key, allocating an empty tile if sand hasn't reached it yet"""
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = np.zeros([self.tile_size, self.tile_size], dtype=int)
+        return tile
+
+    def locate(self, i, j):
+        """Returns the tile holding site (i,j), and the site's row and column within it"""
+        ti, r = divmod(i, self.tile_size)
+        tj, c = divmod(j, self.tile_size)
+        return self.tile((ti, tj)), r, c
+
+    def window(self, ti, tj, margin=0):
+        """Returns a Table holding the tiles up to margin tiles away from tile (ti, tj), with no sand on its
+        edges, and a list of the keys of those tiles with the views of them in its grid"""
+        side = 2 * margin + 1
+        table = self.blocks.get(side)
+        if table is None:
+            if side > 1:  # Only keep the last bigger window, which the next big avalanche will likely need again
+                self.blocks = {size: block for size, block in self.blocks.items() if size == 1}
+            length = side * self.tile_size
+            table = self.blocks[side] = Table(length, length, self.k, engine=self.engine)
+        table.grid[[0, -1], :] = 0
+        table.grid[:, [0, -1]] = 0
+        views = []
+        for r in range(side):
+            for c in range(side):
+                key = (ti - margin + r, tj - margin + c)
+                view = table.grid[1 + r * self.tile_size:1 + (r + 1) * self.tile_size,
+                                  1 + c * self.tile_size:1 + (c + 1) * self.tile_size]
+                tile = self.tiles.get(key)
+                view[...] = 0 if tile is None else tile
+                views.append((key, view))
+        return table, views
+
+    def height(self, i, j):
+        tile = self.tiles.get((i // self.tile_size, j // self.tile_size))
+        return 0 if tile is None else int(tile[i % self.tile_size, j % self.tile_size])
+
+    def add_grain(self, *args):
+        """Function to add a single grain of sand to the table.
+        Optional args for position of grain (the origin by default)"""
+        tile, r, c = self.locate(*(args if args else (0, 0)))
+        tile[r, c] += 1
+        self.grains += 1
+
+    def add_pile(self, n, *args):
+        """Adds n grains of sand to a single site (the origin by default) at once, then stabilises the table.
+        Returns the number of topples"""
+        tile, r, c = self.locate(*(args if args else (0, 0)))
+        tile[r, c] += n
+        self.grains += n
+        return self.stabilise()
+
+    def is_critical_site(self, i_check, j_check):
+        """Checks if any avalanches will occur at (m,n)"""
+        return self.height(i_check, j_check) >= self.k  # avalanche
+
+    def topple(self, i_topple, j_topple):
+        """Perform a toppling process at the grid point (m,n)"""
+        tile, r, c = self.locate(i_topple, j_topple)
+        tile[r, c] -= 4  # 4 grains topple
+        for di, dj in SQUARE:
+            tile, r, c = self.locate(i_topple + di, j_topple + dj)
+            tile[r, c] += 1  # surroundings gain a grain
+
+    def stabilise(self):
+        """Topples until no site is critical, returning the total number of topples. As Table.stabilise, each
+        round topples every site of every unstable tile as many times as it can at once, with Table.topple_counts
+        on a window of the tile; grains toppled onto the window's edges land on the neighbouring tiles"""
+        a_topples = 0
+        unstable = {key for key, tile in self.tiles.items() if tile.max() >= self.k}
+        while unstable:
+            reached = set()
+            for ti, tj in unstable:
+                block, ((_, tile),) = self.window(ti, tj)
+                topples = np.maximum(tile - (self.k - block.degree), 0) // block.degree
+                a_topples += int(topples.sum())
+                block.topple_counts(1, 1, topples)
+                self.tiles[(ti, tj)][...] = tile
+                reached.add((ti, tj))
+                for key, edge, spill in [((ti - 1, tj), block.grid[0, 1:-1], (-1, slice(None))),
+                                         ((ti + 1, tj), block.grid[-1, 1:-1], (0, slice(None))),
+                                         ((ti, tj - 1), block.grid[1:-1, 0], (slice(None), -1)),
+                                         ((ti, tj + 1), block.grid[1:-1, -1], (slice(None), 0))]:
+                    if edge.any():
+                        self.tile(key)[spill] += edge
+                        reached.add(key)
+            unstable = {key for key in reached if self.tiles[key].max() >= self.k}
+        return a_topples
+
+    def execute_timestep(self, sites_to_be_toppled):
+        """Topples sites within a single timestep, and returns new critical sites
+        which will be need to be toppled in the next timestep."""
+        next_timestep_critical_sites = set()
+        for i, j in sites_to_be_toppled:  # order doesn't matter
+            if self.is_critical_site(i, j):
                 self.topple(i, j)
-                if pt not in topple_sites:  # A list of unique pts toppled in the avalanche
-                    topple_sites.append([i, j])
-                distance = abs(origin_pt[0] - i) + abs(origin_pt[1] - j)  # x+y distance from origin to topple pt.
-                site_distances.append(distance)
-                topple_pts = topple_pts[1:]  # remove point just toppled
-                a_size += 4  # 2d=4 grains displaced per topple
-                surrounding_pts = [[i + 1, j], [i - 1, j], [i, j + 1], [i, j - 1]]
-                for site in surrounding_pts:  # Now check all cells surrounding, to see if avalanches will occur
-                    r, c = site
-                    if r == 0 or r == self.M + 1 or c == 0 or c == self.N + 1:  # If sand fell off table
-                        pass
-                    elif self.is_critical_site(r, c):
-                        topple_pts.append([r, c])
-            a_time += 1  # Count a time-step
-        # End of avalanche. Return statistics
-        a_area = len(topple_sites)  # Avalanche area- number of unique sites toppled
-        a_radius = max(
-            site_distances)  # Avalanche radius- max number of sites away from initial point that the avalanche reaches
-        return {'size': a_size, 'lifetime': a_time, 'area': a_area, 'radius': a_radius}
+                next_timestep_critical_sites.update((i + di, j + dj) for di, dj in SQUARE
+                                                    if self.is_critical_site(i + di, j + dj))
+        return next_timestep_critical_sites
+
+    def execute_avalanche_with_stats(self, i_0, j_0):
+        """Execute the avalanche starting at the point (m,n), returning the same statistics as
+        Table.execute_avalanche_with_stats. It is traced by a window of the tile holding (m,n); if sand falls off
+        the window, the avalanche is traced again from the tiles as they were over a window of more tiles"""
+        ti, tj = i_0 // self.tile_size, j_0 // self.tile_size
+        margin = 0
+        while True:
+            window, views = self.window(ti, tj, margin)
+            top, left = (ti - margin) * self.tile_size - 1, (tj - margin) * self.tile_size - 1  # site of grid[0, 0]
+            stats = window.execute_avalanche_with_stats(i_0 - top, j_0 - left)
+            if not window.sand_off_table():
+                break
+            margin = 2 * margin + 1
+        for key, view in views:
+            if key in self.tiles or view.any():
+                self.tile(key)[...] = view
+        return stats
+
+    def bounds(self):
+        """Returns the smallest and largest site row and column covered by allocated tiles"""
+        rows = [ti for ti, _ in self.tiles]
+        cols = [tj for _, tj in self.tiles]
+        return (min(rows) * self.tile_size, (max(rows) + 1) * self.tile_size - 1,
+                min(cols) * self.tile_size, (max(cols) + 1) * self.tile_size - 1)
+
+    def to_array(self):
+        """Returns the allocated part of the lattice as a dense array, and the site at its top left corner"""
+        if not self.tiles:
+            return np.zeros([0, 0], dtype=int), (0, 0)
+        i_min, i_max, j_min, j_max = self.bounds()
+        heights = np.zeros([i_max - i_min + 1, j_max - j_min + 1], dtype=int)
+        for (ti, tj), tile in self.tiles.items():
+            r, c = ti * self.tile_size - i_min, tj * self.tile_size - j_min
+            heights[r:r + self.tile_size, c:c + self.tile_size] = tile
+        return heights, (i_min, j_min)
+
+    @property
+    def nbytes(self):
+        """Memory used by the allocated tiles"""
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+
+class GraphTable:
+    """Sandpile on any lattice.Lattice, e.g. triangular, hexagonal, periodic or cubic lattices or a user's graph.
+    A node topples once it holds k grains (its degree by default, as k = 4 on the square lattice), giving a grain
+    to each neighbour; grains given to a sink are counted in self.lost. Heights are a flat array over the nodes,
+    see grid for them laid out in the lattice's shape"""
+    def __init__(self, lattice, k=None, seed=None):
+        self.lattice = lattice
+        self.indptr, self.indices, self.degree = lattice.csr()
+        if not lattice.sinks.any():
+            raise ValueError("Sand can't leave a lattice without sinks, see Lattice.with_sinks")
+        if k is not None and k < self.degree.max():
+            raise ValueError(f"k = {k} is less than the degree of some nodes, {self.degree.max()}")
+        self.k = k
+        self.thresholds = np.where(lattice.sinks, np.iinfo(np.int64).max, self.degree if k is None else k)
+        self.heights = np.zeros(lattice.size, dtype=np.int64)
+        self.lost = 0  # grains given to sinks
+        self.grains = 0  # number of grains added to the table
+        self.rng = np.random.default_rng(seed)  # for random drop sites
+        self.nodes = np.flatnonzero(~lattice.sinks)  # nodes grains can be dropped on
+
+    @property
+    def grid(self):
+        """View of the heights laid out in the lattice's shape"""
+        return self.heights.reshape(self.lattice.shape)
+
+    def add_grain(self, node=None):
+        """Adds a single grain of sand to the node, the centre of the lattice by default"""
+        self.heights[self.lattice.centre if node is None else node] += 1
+        self.grains += 1
+
+    def drop_sites(self, n, policy="centre", rng=None):
+        """Returns an array of n nodes to drop n grains on, following the drop policy as Table.drop_sites"""
+        if policy == "centre":
+            return np.full(n, self.lattice.centre)
+        elif policy == "random":
+            rng = self.rng if rng is None else np.random.default_rng(rng)
+            return self.nodes[rng.integers(0, len(self.nodes), n)]
+        raise ValueError(f"Unknown drop policy '{policy}', expected one of {DROP_POLICIES}")
+
+    def add_grains(self, grains, policy="centre", rng=None):
+        """Adds many grains at once then stabilises, as Table.add_grains. Returns the number of topples"""
+        nodes = self.drop_sites(grains, policy, rng) if np.ndim(grains) == 0 else np.asarray(grains)
+        np.add.at(self.heights, nodes, 1)
+        self.grains += len(nodes)
+        return self.stabilise()
+
+    def is_critical_site(self, node):
+        return self.heights[node] >= self.thresholds[node]
+
+    def topple(self, node):
+        self.heights[node] -= self.degree[node]
+        np.add.at(self.heights, self.indices[self.indptr[node]:self.indptr[node + 1]], 1)
+        self.drain_sinks()
+
+    def drain_sinks(self):
+        """Counts the grains given to sinks in self.lost, and empties them"""
+        sinks = self.lattice.sinks
+        self.lost += int(self.heights[sinks].sum())
+        self.heights[sinks] = 0
+
+    def stabilise(self):
+        """Topples until no node is critical, returning the total number of topples. As Table.stabilise, each
+        round topples every node as many times as it can at once"""
+        a_topples = 0
+        nodes = self.nodes
+        degree = self.degree[nodes]
+        while True:
+            excess = self.heights[nodes] - self.thresholds[nodes]
+            critical = excess >= 0
+            if not critical.any():
+                return a_topples
+            topples = np.zeros(self.lattice.size, dtype=np.int64)
+            topples[nodes[critical]] = excess[critical] // degree[critical] + 1
+            a_topples += int(topples.sum())
+            self.heights -= topples * self.degree
+            # Each node gains a grain per topple of each neighbour:
+            self.heights += np.bincount(self.indices, weights=np.repeat(topples, self.degree),
+                                        minlength=self.lattice.size).astype(np.int64)
+            self.drain_sinks()
+
+    def execute_timestep(self, sites_to_be_toppled):
+        """Topples the critical nodes of sites_to_be_toppled at once, and returns the nodes which are critical
+        for the next time-step"""
+        nodes = np.array([node for node in sites_to_be_toppled if self.is_critical_site(node)], dtype=np.int64)
+        if len(nodes) == 0:
+            return set()
+        self.heights[nodes] -= self.degree[nodes]
+        starts, degree = self.indptr[nodes], self.degree[nodes]
+        neighbours = self.indices[np.repeat(starts - np.cumsum(degree) + degree, degree) + np.arange(degree.sum())]
+        np.add.at(self.heights, neighbours, 1)
+        self.drain_sinks()
+        reached = np.unique(neighbours)
+        return set(reached[self.heights[reached] >= self.thresholds[reached]].tolist())
+
+    def execute_avalanche_with_stats(self, node_0=None):
+        """Execute the avalanche starting at node_0 (the centre by default), returning the same statistics as
+        Table.execute_avalanche_with_stats. Size counts the grains displaced, and radius is the largest
+        distance of a toppled node from node_0: along each axis added up for lattices laid out in arrays, or in
+        steps between toppled nodes for graphs"""
+        node_0 = self.lattice.centre if node_0 is None else node_0
+        heights = memoryview(self.heights)
+        indptr, indices = memoryview(self.indptr), memoryview(self.indices)
+        degree, thresholds = memoryview(self.degree), memoryview(self.thresholds)
+        sinks = memoryview(self.lattice.sinks)
+        toppled_sites = {}  # unique nodes toppled in the avalanche, in order
+        a_size = 0
+        a_time = 0
+        lost = 0
+        frontier = [node_0]
+        while frontier:
+            reached = set()  # nodes which may be critical after this time-step, once each
+            for node in frontier:
+                heights[node] -= degree[node]
+                a_size += degree[node]
+                toppled_sites[node] = None
+                for n in range(indptr[node], indptr[node + 1]):
+                    pt = indices[n]
+                    if sinks[pt]:  # Sand falling off the lattice can't topple
+                        lost += 1
+                        continue
+                    height = heights[pt] + 1
+                    heights[pt] = height
+                    if height >= thresholds[pt]:
+                        reached.add(pt)
+            a_time += 1
+            # A node reached before toppling in the same time-step (lattices with odd cycles) may be stable again:
+            frontier = [node for node in reached if heights[node] >= thresholds[node]]
+        self.lost += lost
+        return {'size': a_size, 'lifetime': a_time, 'area': len(toppled_sites),
+                'radius': self.radius(node_0, np.fromiter(toppled_sites, dtype=np.int64, count=len(toppled_sites)))}
+
+    def radius(self, node_0, nodes):
+        """Largest distance from node_0 to any of nodes, see execute_avalanche_with_stats"""
+        if len(self.lattice.shape) > 1:
+            coords = np.array(np.unravel_index(nodes, self.lattice.shape))
+            origin = np.array(np.unravel_index(node_0, self.lattice.shape))
+            return int(np.abs(coords - origin[:, None]).sum(axis=0).max())
+        reachable = set(nodes.tolist())
+        distance = 0
+        frontier = [node_0]
+        reachable.discard(node_0)
+        while frontier:  # Breadth first search through the toppled nodes
+            next_frontier = []
+            for node in frontier:
+                for pt in self.indices[self.indptr[node]:self.indptr[node + 1]].tolist():
+                    if pt in reachable:
+                        reachable.discard(pt)
+                        next_frontier.append(pt)
+            if next_frontier:
+                distance += 1
+            frontier = next_frontier
+        return distance
+
+
+class ReplicaTable:
+    """R independent M by N sandpiles stored as one (R, M + 2, N + 2) array and driven together: each grain is
+    dropped onto every replica at once, and the replicas it makes avalanche relax in the same vectorised
+    time-steps, replicas dropping out as their avalanches finish. Replica r has its own rng, self.rngs[r]
+    (spawned from seed), and behaves as a Table of its own with that rng would"""
+    def __init__(self, R, M, N, k, seed=None):
+        self.R = R  # number of replicas
+        self.M = M  # number of rows
+        self.N = N  # number of columns
+        self.k = k  # critical parameter
+        self.grid = np.zeros([R, M + 2, N + 2], dtype=int)  # with edges, as Table's grid
+        self.grains = 0  # number of grains added to each replica
+        seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.rngs = [np.random.default_rng(replica_seed) for replica_seed in seed.spawn(R)]
+        self.lattice = Lattice.square(M, N)  # of each replica
+        self.stamps = None  # scratch space for execute_avalanches, as big as the grid
+
+    @property
+    def interior(self):
+        """View of the grids without their edges"""
+        return self.grid[:, 1:self.M + 1, 1:self.N + 1]
+
+    def centre(self):
+        return int(ceil((self.M + 1) / 2)), int(ceil((self.N + 1) / 2))
+
+    def drop_sites(self, n, policy="centre"):
+        """Returns an (R, n, 2) array of grid points to drop n grains on each replica, following the drop policy
+        with each replica's own rng, as Table.drop_sites"""
+        if policy == "centre":
+            return np.tile(self.centre(), (self.R, n, 1))
+        elif policy == "random":
+            return np.stack([rng.integers((1, 1), (self.M + 1, self.N + 1), size=(n, 2)) for rng in self.rngs])
+        raise ValueError(f"Unknown drop policy '{policy}', expected one of {DROP_POLICIES}")
+
+    def execute_avalanches(self, replicas, i_0, j_0):
+        """Relaxes the avalanches starting at (i_0[n], j_0[n]) on replicas[n] (all different), all at once,
+        as execute_avalanche_with_stats would on each replica. Each time-step topples the sites in every
+        avalanche's front together, as flat indices into the stacked grids, so its cost follows the number of
+        topples rather than the size of the grids. Returns arrays of the size, lifetime, area and radius of each"""
+        heights = self.grid.reshape(-1)
+        width = self.N + 2
+        sites = (self.M + 2) * width  # per replica
+        offsets = np.array(self.lattice.offsets)
+        if self.stamps is None:
+            self.stamps = np.zeros(heights.size, dtype=np.int64)
+        stamps = self.stamps
+        avalanche_of = np.zeros(self.R, dtype=np.int64)
+        avalanche_of[replicas] = np.arange(len(replicas))
+        frontier = replicas * sites + i_0 * width + j_0
+        toppled = []  # fronts of every time-step
+        lifetime = np.zeros(len(replicas), dtype=np.int64)
+        while len(frontier):
+            heights[frontier] -= 4  # 4 grains topple, each site at most once per time-step
+            toppled.append(frontier)
+            lifetime += np.bincount(avalanche_of[frontier // sites], minlength=len(replicas)) > 0
+            # Surroundings gain a grain per toppled neighbour. On the square lattice they are never in the front
+            # themselves (the front alternates between the two colours of a chessboard):
+            reached = (frontier[:, None] + offsets).reshape(-1)
+            np.add.at(heights, reached, 1)
+            # Each site reached once, without sorting: the last of its grains to be stamped on it
+            order = np.arange(len(reached))
+            stamps[reached] = order
+            reached = reached[stamps[reached] == order]
+            frontier = reached[(heights[reached] >= self.k) & ~self.lattice.sinks[reached % sites]]
+        toppled = np.concatenate(toppled)
+        size = 4 * np.bincount(avalanche_of[toppled // sites], minlength=len(replicas))  # 2d=4 grains per topple
+        toppled = np.unique(toppled)
+        avalanche = avalanche_of[toppled // sites]
+        area = np.bincount(avalanche, minlength=len(replicas))
+        rows, cols = np.divmod(toppled % sites, width)
+        radius = np.zeros(len(replicas), dtype=np.int64)
+        np.maximum.at(radius, avalanche, np.abs(rows - i_0[avalanche]) + np.abs(cols - j_0[avalanche]))
+        return size, lifetime, area, radius
+
+    def run(self, n_grains, drop_policy="centre", chunk=RUN_CHUNK):
+        """Drops n_grains grains onto every replica, one at a time, each avalanche relaxing before the next grain.
+        Returns a list of R arrays of AVALANCHE_DTYPE, one per replica, as Table.run with the replica's rng"""
+        avalanches = np.zeros(min(n_grains, chunk), dtype=AVALANCHE_DTYPE)
+        avalanche_replicas = np.zeros(len(avalanches), dtype=np.int64)  # replica of each row of avalanches
+        n_avalanches = 0
+        replicas = np.arange(self.R)
+        sand = self.interior.sum(axis=(1, 2))
+        fallen = self.sand_off_table(replicas)
+        for start in range(0, n_grains, chunk):
+            sites = self.drop_sites(min(chunk, n_grains - start), drop_policy)
+            for t in range(sites.shape[1]):
+                i, j = sites[:, t, 0], sites[:, t, 1]
+                self.grid[replicas, i, j] += 1
+                self.grains += 1
+                sand += 1
+                avalanching = np.flatnonzero(self.grid[replicas, i, j] >= self.k)
+                if len(avalanching) == 0:
+                    continue
+                stats = self.execute_avalanches(avalanching, i[avalanching], j[avalanching])
+                now_fallen = self.sand_off_table(avalanching)
+                sand[avalanching] -= now_fallen - fallen[avalanching]
+                fallen[avalanching] = now_fallen
+                end = n_avalanches + len(avalanching)
+                while end > len(avalanches):
+                    avalanches = np.concatenate((avalanches, np.zeros_like(avalanches)))
+                    avalanche_replicas = np.concatenate((avalanche_replicas, np.zeros_like(avalanche_replicas)))
+                rows = avalanches[n_avalanches:end]
+                rows["grain"] = self.grains - 1
+                rows["size"], rows["lifetime"], rows["area"], rows["radius"] = stats
+                rows["density"] = sand[avalanching] / (self.M * self.N)
+                avalanche_replicas[n_avalanches:end] = avalanching
+                n_avalanches = end
+        order = np.argsort(avalanche_replicas[:n_avalanches], kind="stable")
+        counts = np.bincount(avalanche_replicas[:n_avalanches], minlength=self.R)
+        return np.split(avalanches[:n_avalanches][order], np.cumsum(counts)[:-1])
+
+    def sand_off_table(self, replicas):
+        """Returns the number of grains which have fallen off each of the replicas, onto their edges"""
+        grid = self.grid
+        return (grid[replicas, 0].sum(axis=1) + grid[replicas, -1].sum(axis=1) + grid[replicas, 1:-1, 0].sum(axis=1)
+                + grid[replicas, 1:-1, -1].sum(axis=1))
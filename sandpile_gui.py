@@ -5,28 +5,81 @@ import numpy as np
 import matplotlib.pyplot as plt
 from functools import partial
 from PyQt5 import QtCore
+from PyQt5.QtGui import QColor, QImage, QPainter
 from PyQt5.QtWidgets import QApplication, QHBoxLayout, QVBoxLayout, QGroupBox, QGridLayout, \
-    QPushButton, QRadioButton, QLineEdit, QDialog, QWidget
+    QPushButton, QRadioButton, QLineEdit, QDialog, QWidget, QSlider
 import sandpile
+from simulation import Simulation
+
+RASTER_SITES = 50 * 50  # grids with more sites than this are drawn as a single image by default
+FRAME_RATE = 30  # snapshots of the simulation drawn per second
+MAX_SPEED = 6  # at the top of the speed slider grains are dropped as fast as possible, otherwise 10**speed a second
+
+
+class RasterGrid(QWidget):
+    """Draws the table as one image, scaled to fit the widget: each site's height is mapped through a colour
+    lookup table into an RGB buffer, which the QImage shares without copying"""
+    def __init__(self, M, N, colours, on_click):
+        super().__init__()
+        self.M = M
+        self.N = N
+        self.on_click = on_click  # called with the (row, column) of a clicked site, counting from 0
+        # Heights beyond the last colour are drawn in the last colour:
+        self.lut = np.array([QColor(colours[height]).rgb() for height in sorted(colours)], dtype=np.uint32)
+        self.pixels = np.full([M, N], self.lut[0], dtype=np.uint32)
+        self.image = QImage(self.pixels.data, N, M, 4 * N, QImage.Format_RGB32)
+        self.setMinimumSize(N, M)
+
+    def refresh(self, heights, rows=None, cols=None):
+        """Recolours the pixels of the sites at the given rows and columns of the M by N array of heights,
+        or of every site, then repaints"""
+        if rows is None:
+            np.take(self.lut, np.clip(heights, 0, len(self.lut) - 1), out=self.pixels)
+        else:
+            self.pixels[rows, cols] = self.lut[np.clip(heights[rows, cols], 0, len(self.lut) - 1)]
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.drawImage(self.rect(), self.image)
+        painter.end()
+
+    def mousePressEvent(self, event):
+        i = event.y() * self.M // max(self.height(), 1)
+        j = event.x() * self.N // max(self.width(), 1)
+        if 0 <= i < self.M and 0 <= j < self.N:
+            self.on_click(i, j)
 
 
 class Window(QWidget):
-    def __init__(self):
+    def __init__(self, M=25, N=25, k=4, raster=None):
         super().__init__()
-        self.M = 25
-        self.N = 25
-        self.k = 4
+        self.M = M
+        self.N = N
+        self.k = k
+        self.raster = M * N > RASTER_SITES if raster is None else raster  # one image instead of a button per site
         self.sandPile = sandpile.Table(self.M, self.N, self.k)
+        self.simulation = Simulation(self.sandPile)  # owns the table from here on
+        self.heights = np.zeros([M, N], dtype=int)  # latest snapshot of the simulation
+        self.shown = np.zeros([M, N], dtype=int)  # heights currently drawn
+        self.frame = 0  # snapshot currently drawn
         self.init_ui()
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.update_button_colours)
+        self.timer.start(1000 // FRAME_RATE)
 
     def init_ui(self):
         self.setWindowTitle("Abelian Sandpile")
         self.setGeometry(100, 100, 300, 300)  # x,y pos, width,height
         self.window_layout = QVBoxLayout()
-        self.gui_grid: QGridLayout = self.create_grid_layout()
         self.create_horizontal_layout()
-
-        self.window_layout.addItem(self.gui_grid)
+        if self.raster:
+            self.set_colours()
+            self.gui_grid = RasterGrid(self.M, self.N, self.colours, self.update_grid)
+            self.window_layout.addWidget(self.gui_grid, 1)
+        else:
+            self.gui_grid: QGridLayout = self.create_grid_layout()
+            self.window_layout.addItem(self.gui_grid)
         self.window_layout.addWidget(self.horizontal_group_box)
         self.setLayout(self.window_layout)
         self.show()
@@ -69,6 +122,22 @@ class Window(QWidget):
         start_button.clicked.connect(partial(self.start_click))
         layout.addWidget(start_button)
 
+        self.pause_button = QPushButton("Pause", self)
+        self.pause_button.setCheckable(True)
+        self.pause_button.toggled.connect(self.pause_click)
+        layout.addWidget(self.pause_button)
+
+        step_button = QPushButton("Step", self)
+        step_button.clicked.connect(partial(self.simulation.step, 1))
+        layout.addWidget(step_button)
+
+        self.speed_slider = QSlider(QtCore.Qt.Horizontal, self)
+        self.speed_slider.setRange(0, MAX_SPEED)
+        self.speed_slider.setValue(MAX_SPEED)
+        self.speed_slider.setToolTip("Grains per second")
+        self.speed_slider.valueChanged.connect(self.speed_change)
+        layout.addWidget(self.speed_slider)
+
         reset_button = QPushButton("Clear", self)
         reset_button.clicked.connect(self.clear_grid)
         layout.addWidget(reset_button)
@@ -76,13 +145,7 @@ class Window(QWidget):
         self.horizontal_group_box.setLayout(layout)
 
     def update_grid(self, i, j):
-        self.sandPile.add_grain(i + 1, j + 1)
-        if self.sandPile.is_critical_site(i + 1, j + 1):
-            self.execute_avalanche(i + 1, j + 1)
-        else:  # no avalanche
-            self.gui_grid.itemAtPosition(i, j).widget().setStyleSheet(
-                f"background-color:{self.colours[self.sandPile.grid[i + 1][j + 1]]}")
-        self.update_button_colours()
+        self.simulation.drop(i + 1, j + 1)
 
     def execute_avalanche(self, i_c, j_c):
         """Initiates avalanche at (i_c, j_c).
@@ -91,49 +154,63 @@ class Window(QWidget):
         while toppling_sites:
             new_critical_sites = self.sandPile.execute_timestep(toppling_sites)
             toppling_sites = new_critical_sites
-            # self.update_button_colours()
+
+    def pause_click(self, paused):
+        if paused:
+            self.simulation.pause()
+        else:
+            self.simulation.resume()
+        self.pause_button.setText("Resume" if paused else "Pause")
+
+    def speed_change(self, speed):
+        self.simulation.set_rate(None if speed == MAX_SPEED else 10 ** speed)
 
     def update_button_colours(self):
-        for x in range(self.M):  # TODO: this is time expensive...
-            for y in range(self.N):  # This is quite time expensive... hopefully can optimise
-                # self.gui_grid.itemAtPosition(x, y).widget().setText(f'{self.sandPile.grid[x+1][y+1]}')
-                # TODO: what colour for supercritical (>4) cells?
-                self.gui_grid.itemAtPosition(x, y).widget().setStyleSheet(f"background-color:{self.colours[self.sandPile.grid[x + 1][y + 1]]}")
+        """Recolours the sites which changed between the snapshot drawn and the latest one, if there is one"""
+        if self.simulation.frame == self.frame:
+            return
+        self.frame = self.simulation.snapshot(self.heights)
+        rows, cols = np.nonzero(self.heights != self.shown)
+        self.shown[rows, cols] = self.heights[rows, cols]
+        if self.raster:
+            self.gui_grid.refresh(self.shown, rows, cols)
+            return
+        for x, y in zip(rows.tolist(), cols.tolist()):
+            # self.gui_grid.itemAtPosition(x, y).widget().setText(f'{self.shown[x][y]}')
+            # TODO: what colour for supercritical (>4) cells?
+            colour = self.colours[min(self.shown[x][y], max(self.colours))]
+            self.gui_grid.itemAtPosition(x, y).widget().setStyleSheet(f"background-color:{colour}")
 
     def start_click(self):
         total_grains = self.number_grains_text.text()
         random_pos = self.random_radio_button.isChecked()
+        self.simulation.snapshot(self.heights)
         if total_grains == "Number of grains":
             total_grains = 100  # default
             print(f"Default number of grains: {total_grains}")
         else:
             total_grains = int(total_grains)
         if random_pos:
-            pos_i = np.random.randint(self.M, size=total_grains)
-            pos_j = np.random.randint(self.N, size=total_grains)
-        elif np.sum(self.sandPile.grid) == 1:  # start on initial point
+            self.simulation.start(total_grains, "random")
+        elif np.sum(self.heights) == 1:  # start on initial point
             print("Starting on initial seed")
-            [i_index, j_index] = np.where(self.sandPile.grid == 1)
-            pos_i = (i_index - 1) * np.ones(total_grains, dtype=int)
-            pos_j = (j_index - 1) * np.ones(total_grains, dtype=int)
-        else:  # np.sum(self.sandPile.grid) == 0:
+            [i_index, j_index] = np.where(self.heights == 1)
+            self.simulation.start(total_grains, (i_index[0] + 1, j_index[0] + 1))
+        else:  # np.sum(self.heights) == 0:
             print("Simulating grains dropped in center")
-            pos_i = self.M // 2 * np.ones(total_grains, dtype=int)
-            pos_j = self.N // 2 * np.ones(total_grains, dtype=int)
-        for grain in range(total_grains):
-            self.update_grid(pos_i[grain], pos_j[grain])
-        self.update_button_colours()
-        self.gui_grid.update() # repaint()
+            self.simulation.start(total_grains, "centre")
+        self.pause_button.setChecked(False)
 
     def clear_grid(self):
-        plt.imshow(self.sandPile.grid[1:self.M + 1, 1:self.N + 1], cmap='Blues',
-                   interpolation='nearest')  # ,shading='gouraud')
+        self.simulation.snapshot(self.heights)
+        plt.imshow(self.heights, cmap='Blues', interpolation='nearest')  # ,shading='gouraud')
         plt.show()
-        self.sandPile.grid = np.zeros([self.M + 2, self.N + 2], dtype=int)
-        for i in range(self.M):
-            for j in range(self.N):
-                # self.buttons[i*self.N+j].setText(f'{self.sandPile.grid[i+1][j+1]}')
-                self.gui_grid.itemAtPosition(i, j).widget().setStyleSheet(f"background-color: white")
+        self.simulation.clear()  # the cleared grid is drawn from the next snapshot
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        self.simulation.close()
+        super().closeEvent(event)
 
 
 def main():
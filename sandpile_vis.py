@@ -1,10 +1,14 @@
 import time
 import random as random
 import numpy as np
-from tkinter import Tk, Entry
+from tkinter import Tk, Entry, Frame, Button, Scale, HORIZONTAL
 import palettable.cmocean.sequential as pcolours
 
 import sandpile
+from simulation import Simulation
+
+FRAME_RATE = 30  # snapshots of the simulation drawn per second
+MAX_SPEED = 6  # at the top of the speed scale grains are dropped as fast as possible, otherwise 10**speed a second
 
 
 class Window:
@@ -16,13 +20,20 @@ class Window:
         self.colours = ['white'] + pcolours.Deep_5.hex_colors
         self.total_grains = 1000
         self.sandPile = sandpile.Table(self.M, self.N, self.k)
+        self.simulation = Simulation(self.sandPile)  # owns the table from here on
+        self.heights = np.zeros([self.M, self.N], dtype=int)  # latest snapshot of the simulation
+        self.shown = np.zeros([self.M, self.N], dtype=int)  # heights currently drawn
+        self.frame = 0  # snapshot currently drawn
         self.init_ui()
         self.start_click()
+        self.root.after(1000 // FRAME_RATE, self.update_button_colours)
         self.root.mainloop()
+        self.simulation.close()
 
     def init_ui(self):
         self.root.title("Abelian Sandpile")
         self.create_grid_layout()
+        self.create_controls()
 
     def create_grid_layout(self):
         self.entries = []
@@ -31,34 +42,47 @@ class Window:
                 self.entries.append(Entry(self.root, text="", width=2, bd=0))
                 self.entries[r*self.N + c].grid(row=r, column=c, padx=0, pady=0, ipadx=0, ipady=0),
 
+    def create_controls(self):
+        controls = Frame(self.root)
+        controls.grid(row=self.M, column=0, columnspan=self.N)
+        Button(controls, text="Start", command=self.start_click).pack(side="left")
+        self.pause_button = Button(controls, text="Pause", command=self.pause_click)
+        self.pause_button.pack(side="left")
+        Button(controls, text="Step", command=lambda: self.simulation.step(1)).pack(side="left")
+        self.speed_scale = Scale(controls, from_=0, to=MAX_SPEED, orient=HORIZONTAL, label="Speed",
+                                 command=self.speed_change)
+        self.speed_scale.set(MAX_SPEED)
+        self.speed_scale.pack(side="left")
+
     def update_grid(self, i, j):
-        self.sandPile.add_grain(i + 1, j + 1)
-        if self.sandPile.is_critical_site(i + 1, j + 1):
-            self.execute_avalanche(i + 1, j + 1)
-        else:  # no avalanche
-            self.entries[i * self.N + j].configure(background=self.colours[min(self.k, self.sandPile.grid[i + 1][j + 1])])
-        self.update_button_colours()
-        self.root.update()
-
-    def execute_avalanche(self, i_c, j_c):
-        """Initiates avalanche at (i_c, j_c).
-        Loops over the toppling of piles until grid hits a 'steady' state"""
-        toppling_sites = {(i_c, j_c)}
-        while toppling_sites:
-            new_critical_sites = self.sandPile.execute_timestep(toppling_sites)
-            toppling_sites = new_critical_sites
-            self.update_button_colours()
+        self.simulation.drop(i + 1, j + 1)
+
+    def pause_click(self):
+        if self.simulation.paused:
+            self.simulation.resume()
+        else:
+            self.simulation.pause()
+        self.pause_button.configure(text="Resume" if self.simulation.paused else "Pause")
+
+    def speed_change(self, speed):
+        speed = int(speed)
+        self.simulation.set_rate(None if speed == MAX_SPEED else 10 ** speed)
 
     def update_button_colours(self):
-        for i in range(self.M):
-            for j in range(self.N):
-                self.entries[i * self.N + j].configure(bg=self.colours[min(self.k, self.sandPile.grid[i + 1][j + 1])])
-        self.root.update()
+        """Recolours the entries of the sites which changed between the snapshot drawn and the latest one,
+        then polls again a frame later"""
+        if self.simulation.frame != self.frame:
+            self.frame = self.simulation.snapshot(self.heights)
+            rows, cols = np.nonzero(self.heights != self.shown)
+            self.shown[rows, cols] = self.heights[rows, cols]
+            for i, j in zip(rows.tolist(), cols.tolist()):
+                self.entries[i * self.N + j].configure(bg=self.colours[min(self.k, self.shown[i][j])])
+        self.root.after(1000 // FRAME_RATE, self.update_button_colours)
 
     def start_click(self):
         print("Simulating grains dropped in center")
-        for _ in range(self.total_grains):
-            self.update_grid(self.M // 2, self.N // 2)
+        self.simulation.start(self.total_grains, "centre")
+        self.pause_button.configure(text="Pause")
 
 
 def main():
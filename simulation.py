@@ -0,0 +1,153 @@
+"""Runs a sandpile in a background thread, publishing snapshots of the grid for a GUI to draw at its own pace"""
+
+import time
+import threading
+from collections import deque
+import numpy as np
+
+FRAME_INTERVAL = 1 / 30  # seconds between published snapshots while grains are being dropped
+
+
+class Simulation:
+    """Drops grains onto a sandpile.Table in a worker thread. Snapshots of the grid (without edges) are published
+    into a double buffer at most once per frame_interval, so the thread spends its time simulating rather than
+    drawing; the GUI polls the latest one with snapshot on a timer, and finds the sites to redraw by comparing it
+    with the one it drew, so the table needn't track the sites avalanches change (see Table.pop_changed_sites).
+    Only the worker touches the table once started: grains, clicks and clears are requested through the methods
+    below. rate limits the grains dropped per second (unlimited if None)"""
+    def __init__(self, sand_pile, frame_interval=FRAME_INTERVAL, rate=None):
+        self.sandPile = sand_pile
+        self.frame_interval = frame_interval
+        self.rate = rate
+        self.buffers = [self.sandPile.interior.copy(), self.sandPile.interior.copy()]
+        self.front = 0  # index of the buffer holding the latest snapshot
+        self.frame = 0  # number of snapshots published
+        self.condition = threading.Condition()  # guards everything below, and the front buffer
+        self.policy = "centre"  # drop policy of the current run
+        self.remaining = 0  # grains left to drop in the current run
+        self.steps = 0  # grains to drop next, even if paused
+        self.sites = deque()  # grid points to drop a grain on next, e.g. clicked by the user
+        self.clear_requested = False
+        self.paused = False
+        self.busy = False  # the worker is dropping grains
+        self.closed = False
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def start(self, grains, policy="centre"):
+        """Drops grains more grains following the drop policy, or onto one grid point if policy is (i, j).
+        Replaces whatever is left of the current run, and unpauses"""
+        with self.condition:
+            self.policy = policy
+            self.remaining = grains
+            self.paused = False
+            self.condition.notify_all()
+
+    def pause(self):
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def step(self, grains=1):
+        """Drops grains more grains of the current run, or following its drop policy once it has finished"""
+        with self.condition:
+            self.steps += grains
+            self.condition.notify_all()
+
+    def drop(self, i, j):
+        """Drops a grain at the grid point (i, j) as soon as possible, even if paused"""
+        with self.condition:
+            self.sites.append((i, j))
+            self.condition.notify_all()
+
+    def clear(self):
+        """Empties the table and ends the current run"""
+        with self.condition:
+            self.clear_requested = True
+            self.sites.clear()
+            self.remaining = self.steps = 0
+            self.condition.notify_all()
+
+    def set_rate(self, rate):
+        with self.condition:
+            self.rate = rate
+
+    def snapshot(self, out):
+        """Copies the latest snapshot into out, an M by N array, and returns its frame number"""
+        with self.condition:
+            np.copyto(out, self.buffers[self.front])
+            return self.frame
+
+    def wait(self, timeout=None):
+        """Waits until there are no more grains to drop, unless paused. Returns False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not (self.busy or self.pending()), timeout)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def pending(self):
+        return self.clear_requested or self.sites or self.steps or (self.remaining and not self.paused)
+
+    def take_work(self):
+        """Takes the next batch of grains off the queue: clicked sites, then steps, then a chunk of the run.
+        Chunks are sized to keep to the rate, or to check for new requests a few hundred grains at a time"""
+        chunk = 256 if self.rate is None else max(1, int(self.rate * self.frame_interval))
+        sites = list(self.sites)
+        self.sites.clear()
+        grains = min(self.steps, chunk)
+        self.steps -= grains
+        if not self.paused:
+            run = min(self.remaining, chunk - grains)
+            grains += run
+            self.remaining -= run
+        elif self.remaining:
+            self.remaining = max(self.remaining - grains, 0)
+        if grains:
+            sites.extend(map(tuple, self.sandPile.drop_sites(grains, self.policy)) if isinstance(self.policy, str)
+                         else [self.policy] * grains)
+        return sites
+
+    def work(self):
+        last_frame = time.perf_counter()
+        while True:
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: self.closed or self.pending())
+                if self.closed:
+                    return
+                self.busy = True
+                clear, self.clear_requested = self.clear_requested, False
+                sites = self.take_work()
+                rate = self.rate
+            started = time.perf_counter()
+            if clear:
+                self.sandPile.grid[...] = 0
+                self.sandPile.lost = 0
+            for i, j in sites:
+                self.sandPile.add_grain(i, j)
+                if self.sandPile.is_critical_site(i, j):
+                    self.sandPile.execute_avalanche_with_stats(i, j)
+            now = time.perf_counter()
+            with self.condition:
+                finished = not self.pending()
+            if clear or finished or now - last_frame >= self.frame_interval:
+                self.publish()
+                last_frame = now
+            if rate is not None and sites:
+                time.sleep(max(0.0, len(sites) / rate - (time.perf_counter() - started)))
+
+    def publish(self):
+        """Copies the grid into the back buffer, then makes it the front one"""
+        np.copyto(self.buffers[1 - self.front], self.sandPile.interior)
+        with self.condition:
+            self.front = 1 - self.front
+            self.frame += 1
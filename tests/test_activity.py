@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from sandpile import Table
+from activity import ActivityMaps
+from avalanche_trace import TraceRecorder, AvalancheTrace
+import jit_kernels
+
+
+def test_shape_should_come_from_sums_over_timesteps():
+    activity = ActivityMaps(4, 4)
+    sites = np.array([2, 1, 2, 3, 2]) * 6 + np.array([1, 2, 2, 2, 3])  # a cross, on the padded grid
+    activity.add_sites(sites[:1])
+    activity.add_sites(sites[1:])
+    stats = activity.end_avalanche()
+    assert stats['gyration'] == pytest.approx(np.sqrt(0.8))
+    assert (stats['height'], stats['width']) == (3, 3)
+    assert activity.membership.sum() == 5
+    assert activity.end_avalanche() == {'gyration': 0.0, 'height': 0, 'width': 0}  # the sums start again
+
+
+@pytest.mark.parametrize("engine", ["scalar", "vectorised", "jit"])
+def test_activity_maps_should_match_traced_topples(tmp_path, monkeypatch, engine):
+    monkeypatch.setattr(jit_kernels, "COMPILED", True)  # the kernels run as plain Python without Numba
+    traced, sand_pile = Table(8, 7, 4, seed=1), Table(8, 7, 4, engine=engine, seed=1)
+    traced.recorder = TraceRecorder(tmp_path, 8, 7, 4)
+    sand_pile.activity = ActivityMaps(8, 7)
+    avalanches = []
+    for i, j in traced.drop_sites(600, "random").tolist():
+        for table in (traced, sand_pile):
+            table.add_grain(i, j)
+        if traced.is_critical_site(i, j):
+            traced.execute_avalanche_with_stats(i, j)
+            avalanches.append(sand_pile.execute_avalanche_with_stats(i, j))
+    traced.recorder.close()
+
+    trace = AvalancheTrace(tmp_path)
+    odometer = np.zeros(traced.grid.size, dtype=np.int64)
+    membership = np.zeros(traced.grid.size, dtype=np.int64)
+    for n, stats in enumerate(avalanches):
+        sites = trace.events(n)[1]
+        np.add.at(odometer, sites, 1)
+        rows, cols = np.divmod(np.unique(sites), 9)
+        membership[rows * 9 + cols] += 1
+        assert stats['gyration'] == pytest.approx(np.sqrt(rows.var() + cols.var()))
+        assert stats['height'] == rows.max() - rows.min() + 1 and stats['width'] == cols.max() - cols.min() + 1
+    assert np.array_equal(sand_pile.activity.odometer, odometer.reshape(10, 9)[1:-1, 1:-1])
+    assert np.array_equal(sand_pile.activity.membership, membership.reshape(10, 9)[1:-1, 1:-1])
+    assert sand_pile.activity.avalanches == len(avalanches)
+
+
+@pytest.mark.parametrize("engine", ["scalar", "jit"])
+@pytest.mark.parametrize("least_action", [False, True])
+def test_odometer_should_account_for_stabilised_sand(monkeypatch, engine, least_action):
+    monkeypatch.setattr(jit_kernels, "COMPILED", True)
+    sand_pile = Table(9, 8, 4, engine=engine)
+    sand_pile.activity = ActivityMaps(9, 8)
+    added = np.random.default_rng(4).integers(0, 12, [9, 8])
+    sand_pile.interior[...] = added
+    sand_pile.stabilise(least_action)
+    # Each topple takes 4 grains from a site and gives one to each neighbour:
+    u = np.pad(sand_pile.activity.odometer, 1)
+    gained = u[2:, 1:-1] + u[:-2, 1:-1] + u[1:-1, 2:] + u[1:-1, :-2] - 4 * u[1:-1, 1:-1]
+    assert np.array_equal(sand_pile.interior, added + gained)
+    assert sand_pile.activity.odometer.sum() > 0
@@ -0,0 +1,31 @@
+import os
+import numpy as np
+import analysis_script
+
+
+def test_should_save_figures_and_reuse_cached_reductions(tmp_path, monkeypatch):
+    figures, cache = tmp_path / "figures", tmp_path / "cache"
+    reductions = analysis_script.main(((5, 5),), totalGrains=2000, workers=1, output_dir=str(figures),
+                                      cache_dir=str(cache), root_seed=1)
+    names = os.listdir(figures)
+    assert {"density.png", "final_grid.png", "5x5_size_histogram.png", "5x5_radius_power_law.png"} <= set(names)
+
+    def run_ensemble(*args, **kwargs):
+        raise AssertionError("cached reductions should be used")
+    monkeypatch.setattr(analysis_script, "run_ensemble", run_ensemble)
+    for name in names:
+        os.remove(figures / name)
+    cached = analysis_script.main(((5, 5),), totalGrains=2000, workers=1, output_dir=str(figures),
+                                  cache_dir=str(cache), root_seed=1)
+    assert sorted(os.listdir(figures)) == sorted(names)
+    (arrays, fits), (cached_arrays, cached_fits) = reductions[0], cached[0]
+    assert fits == cached_fits
+    assert all(np.array_equal(arrays[name], cached_arrays[name]) for name in arrays)
+
+
+def test_short_run_should_plot_without_power_law_fits(tmp_path):
+    reductions = analysis_script.main(((11, 11),), totalGrains=300, workers=1, output_dir=str(tmp_path),
+                                      root_seed=1)
+    fits = reductions[0][1]["distributions"]
+    assert fits["radius"] is None and fits["size"] is not None  # too few radii over 0 to choose x_min
+    assert {"11x11_radius_power_law.png", "11x11_size_power_law.png"} <= set(os.listdir(tmp_path))
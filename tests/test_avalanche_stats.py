@@ -0,0 +1,56 @@
+import numpy as np
+from pytest import fixture
+from avalanche_stats import AvalancheStats, AVALANCHE_DTYPE, OBSERVABLES
+from plotting_helper import get_freq_data
+
+
+@fixture
+def avalanches():
+    rng = np.random.default_rng(3)
+    avalanches = np.zeros(5000, dtype=AVALANCHE_DTYPE)
+    avalanches["grain"] = np.arange(5000)
+    for observable in OBSERVABLES[:-1]:
+        avalanches[observable] = rng.geometric(0.05, 5000)
+    avalanches["density"] = rng.uniform(1.5, 2.5, 5000)
+    return avalanches
+
+
+def test_stats_should_match_full_arrays(avalanches):
+    stats = AvalancheStats(sample_size=100, rng=0)
+    for avalanche in avalanches[:3000]:
+        stats.add_avalanche(avalanche["grain"], avalanche, avalanche["density"])
+    stats.add(avalanches[3000:])
+    assert stats.count == 5000
+    for observable in OBSERVABLES[:-1]:
+        values, freqs = get_freq_data(stats[observable])
+        expected_values, expected_freqs = get_freq_data(avalanches[observable])
+        assert np.array_equal(values, expected_values) and np.array_equal(freqs, expected_freqs)
+    for observable in OBSERVABLES:
+        assert np.isclose(stats.mean(observable), avalanches[observable].mean())
+        assert np.isclose(stats.var(observable), avalanches[observable].var())
+    sample = stats.sample()
+    assert len(sample) == 100 and np.all(np.diff(sample["grain"]) > 0)
+    assert np.array_equal(sample, avalanches[sample["grain"]])
+
+
+def test_merged_stats_should_match_single_stream(avalanches):
+    first, second, whole = AvalancheStats(100, 0), AvalancheStats(100, 1), AvalancheStats(100, 2)
+    first.add(avalanches[:1000])
+    second.add(avalanches[1000:])
+    whole.add(avalanches)
+    first.merge(second)
+    assert first.count == whole.count
+    assert np.array_equal(first["area"].counts[:len(whole["area"].counts)], whole["area"].counts)
+    assert np.isclose(first.var("density"), whole.var("density"))
+    assert len(first.sample()) == 100
+
+
+def test_merge_should_sample_runs_of_billions_of_avalanches(avalanches):
+    first, second = AvalancheStats(100, 0), AvalancheStats(100, 1)
+    first.add(avalanches[:1000])
+    second.add(avalanches[1000:2000])
+    first.n, second.n = 3 * 10 ** 9, 2 * 10 ** 9  # as if each run had gone on for billions of avalanches
+    first.merge(second)
+    assert first.count == 5 * 10 ** 9
+    sample = first.sample()
+    assert len(sample) == 100 and 0 < np.count_nonzero(sample["grain"] < 1000) < 100
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from sandpile import Table
+from avalanche_trace import TraceRecorder, AvalancheTrace
+
+
+@pytest.mark.parametrize("engine", ["scalar", "vectorised"])
+def test_trace_should_replay_and_recompute_avalanches(tmp_path, engine):
+    sand_pile = Table(8, 7, 4, engine=engine, seed=1)
+    sand_pile.recorder = TraceRecorder(tmp_path, 8, 7, 4, buffer_events=50)
+    avalanches = []
+    for i, j in sand_pile.drop_sites(500, "random"):
+        sand_pile.add_grain(i, j)
+        if sand_pile.is_critical_site(i, j):
+            before = sand_pile.grid.copy()
+            stats = sand_pile.execute_avalanche_with_stats(i, j)
+            avalanches.append((sand_pile.grains - 1, stats, before, sand_pile.grid.copy()))
+    sand_pile.recorder.close()
+
+    trace = AvalancheTrace(tmp_path)
+    assert len(trace) == len(avalanches)
+    for n, (grain, stats, before, after) in enumerate(avalanches):
+        assert trace.find(grain) == n
+        assert trace.stats(n) == stats
+        assert np.array_equal(trace.replay(n, before), after)
+    assert trace.find(avalanches[0][0] - 1) is None
+
+
+def test_trace_should_number_grains_added_at_once(tmp_path):
+    sand_pile = Table(6, 6, 4, seed=2)
+    sand_pile.add_grains(50, "random")
+    sand_pile.recorder = TraceRecorder(tmp_path, 6, 6, 4)
+    avalanches = sand_pile.add_grains_with_stats(200, "random")
+    sand_pile.recorder.close()
+    trace = AvalancheTrace(tmp_path)
+    assert list(trace.index["grain"]) == [50 + grain for grain, _ in avalanches]
+    assert [trace.stats(n) for n in range(len(trace))] == [stats for _, stats in avalanches]
@@ -0,0 +1,26 @@
+import json
+from benchmark import OPERATIONS, STARTS, critical_grid, main, run_benchmarks
+
+
+def test_benchmarks_should_cover_every_case():
+    report = run_benchmarks(sizes=(16,), engines=("scalar", "vectorised"), duration=0.01)
+    cases = {(result["operation"], result["engine"], result["policy"], result["start"])
+             for result in report["results"]}
+    assert len(cases) == len(report["results"]) == len(OPERATIONS) * 2 * 2 * len(STARTS)
+    for result in report["results"]:
+        assert result["grains"] > 0 and result["grains_per_s"] > 0 and result["peak_bytes"] > 0
+
+
+def test_critical_start_should_be_stable_at_the_stationary_density():
+    heights = critical_grid(300, 40, 5, seed=1)
+    assert heights.shape == (300, 40)
+    assert heights.max() < 5
+    assert 2.9 < heights.mean() < 3.3
+
+
+def test_benchmarks_should_write_json(tmp_path):
+    output = tmp_path / "benchmark.json"
+    main(["--sizes", "8", "--operations", "add_grains", "--duration", "0", "--output", str(output)])
+    with open(output) as f:
+        report = json.load(f)
+    assert [result["start"] for result in report["results"]] == ["empty", "critical"] * 2
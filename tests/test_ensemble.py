@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import sandpile
+from ensemble import run_ensemble, run_job
+from avalanche_stats import HISTOGRAM_OBSERVABLES
+
+
+def test_ensemble_should_be_reproducible_across_worker_counts():
+    configs = [(5, 5, 4), (6, 4, 4)]
+    serial = run_ensemble(configs, 200, seeds=2, policy="random", root_seed=7, workers=1)
+    pooled = run_ensemble(configs, 200, seeds=2, policy="random", root_seed=7, workers=2)
+    assert list(serial) == configs
+    for config in configs:
+        (serial_stats, serial_grids), (pooled_stats, pooled_grids) = serial[config], pooled[config]
+        for observable in HISTOGRAM_OBSERVABLES:
+            assert np.array_equal(serial_stats[observable].counts, pooled_stats[observable].counts)
+        assert np.array_equal(serial_stats.sample(), pooled_stats.sample())
+        assert np.array_equal(serial_grids, pooled_grids)
+        assert serial_grids.shape == (2, config[0], config[1])
+
+
+def test_ensemble_should_merge_runs_per_config():
+    stats, _ = run_ensemble([(5, 5, 4)], 200, seeds=3, policy="random", root_seed=7, workers=1)[(5, 5, 4)]
+    runs = [run_job(5, 5, 4, 200, "random", seed)[0] for seed in np.random.SeedSequence(7).spawn(3)]
+    assert stats.count == sum(run.count for run in runs)
+    assert np.array_equal(stats["size"].counts, sum(run["size"].counts for run in runs))
+
+
+def test_job_should_resume_from_checkpoint(tmp_path):
+    uninterrupted_stats, uninterrupted_grid = run_job(6, 6, 4, 600, "random", 5, checkpoint_every=100)
+    run_job(6, 6, 4, 300, "random", 5, checkpoint_dir=tmp_path, checkpoint_every=100)  # stopped half way
+    stats, grid = run_job(6, 6, 4, 600, "random", 5, checkpoint_dir=tmp_path, checkpoint_every=100)
+    assert np.array_equal(grid, uninterrupted_grid)
+    assert stats.count == uninterrupted_stats.count
+    assert np.array_equal(stats.sample(), uninterrupted_stats.sample())
+
+
+def test_job_should_stream_bounded_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(sandpile, "RUN_CHUNK", 64)
+    chunks = []
+    run = sandpile.Table.run
+    monkeypatch.setattr(sandpile.Table, "run", lambda table, n, *args, **kwargs:
+                        chunks.append(n) or run(table, n, *args, **kwargs))
+    uninterrupted_stats, _ = run_job(6, 6, 4, 640, "random", 5)
+    assert max(chunks) == 64 and sum(chunks) == 640
+    run_job(6, 6, 4, 320, "random", 5, checkpoint_dir=tmp_path, checkpoint_every=320)
+    stats, _ = run_job(6, 6, 4, 640, "random", 5, checkpoint_dir=tmp_path, checkpoint_every=320)
+    assert np.array_equal(stats.sample(), uninterrupted_stats.sample())
+
+
+def test_job_should_not_resume_another_runs_checkpoint(tmp_path):
+    run_job(6, 6, 4, 100, "random", 5, checkpoint_dir=tmp_path, checkpoint_every=100)
+    with pytest.raises(ValueError, match="checkpoint"):
+        run_job(7, 6, 4, 200, "random", 5, checkpoint_dir=tmp_path, checkpoint_every=100)
+    with pytest.raises(ValueError, match="checkpoint"):
+        run_job(6, 6, 4, 200, "centre", 5, checkpoint_dir=tmp_path, checkpoint_every=100)
+
+
+def test_job_should_start_at_criticality():
+    stats, grid = run_job(8, 8, 4, 50, "random", 1, start="recurrent")
+    assert stats.count > 0  # an empty table would need far more grains to avalanche
+    assert grid.max() < 4
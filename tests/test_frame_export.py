@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+import palettable.cmocean.sequential as pcolours
+from sandpile import Table
+from frame_export import deep_lut, colour_frame, FrameExporter, PNGWriter, GIFWriter, export_grains, \
+    export_avalanche, main
+
+
+def test_deep_lut_should_colour_heights_like_sandpile_vis():
+    assert deep_lut(4).tolist() == [[255, 255, 255]] + pcolours.Deep_5.colors[:4]
+    assert deep_lut(30).shape == (31, 3)
+    image = colour_frame(np.array([[0, 4], [2, 1]], dtype=np.uint8), deep_lut(4), scale=2)
+    assert image.shape == (4, 4, 3) and image[3, 3].tolist() == pcolours.Deep_5.colors[0]
+
+
+def test_avalanche_should_be_exported_a_timestep_per_frame(tmp_path):
+    table = Table.random_recurrent(15, 15, 4, seed=2)
+    i, j = table.centre()
+    before = table.grid.copy()
+    table.add_grain(i, j)
+    with FrameExporter(PNGWriter(tmp_path, deep_lut(4)), 4, queue_frames=2) as exporter:
+        timesteps = export_avalanche(table, i, j, exporter)
+    assert sorted(os.listdir(tmp_path)) == [f"frame_{n:06d}.png" for n in range(timesteps + 1)]
+    reference = Table(15, 15, 4)
+    reference.grid[...] = before
+    reference.add_grain(i, j)
+    assert reference.execute_avalanche_with_stats(i, j)['lifetime'] == timesteps
+    with Image.open(tmp_path / f"frame_{timesteps:06d}.png") as image:
+        assert np.array_equal(np.asarray(image), reference.interior)
+        assert np.array_equal(np.asarray(image.convert("RGB")), deep_lut(4)[reference.interior])
+
+
+def test_grains_should_be_exported_every_n_grains(tmp_path):
+    path = str(tmp_path / "run.gif")
+    table = Table(9, 9, 4, seed=1)
+    with FrameExporter(GIFWriter(path, deep_lut(4), scale=3), 4) as exporter:
+        export_grains(table, 250, exporter, every=50, policy="random")
+    with Image.open(path) as image:
+        assert image.n_frames == 6 and image.size == (27, 27)
+        image.seek(5)
+        assert np.array_equal(np.asarray(image.convert("RGB"))[::3, ::3], deep_lut(4)[table.interior])
+
+
+def test_writer_errors_should_reach_the_simulation():
+    class FailingWriter:
+        frames = 0
+
+        def write(self, indices):
+            raise IOError("disk full")
+
+        def close(self):
+            pass
+
+    exporter = FrameExporter(FailingWriter(), 4, queue_frames=1)
+    with pytest.raises(IOError, match="disk full"):
+        for _ in range(10):
+            exporter.capture(np.zeros([5, 5], dtype=int))
+        exporter.close()
+
+
+def test_cli_should_export_png_sequence(tmp_path):
+    main([str(tmp_path / "frames"), "--size", "11", "--grains", "100", "--every", "25", "--seed", "3"])
+    assert len(os.listdir(tmp_path / "frames")) == 5
+
+
+def test_cli_should_export_an_avalanche_which_topples(tmp_path):
+    main([str(tmp_path / "frames"), "--size", "11", "--avalanche", "--seed", "3"])
+    assert len(os.listdir(tmp_path / "frames")) > 1  # a frame before the avalanche, and one per time-step
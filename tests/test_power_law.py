@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from avalanche_stats import Histogram
+from power_law import fit_power_law, log_bins, bootstrap_exponent
+
+
+@pytest.fixture
+def tail():
+    """Histogram of avalanches with a power law tail x^-2.5 from x = 20, and uniform values below it"""
+    rng = np.random.default_rng(5)
+    values = rng.zipf(2.5, 200000)
+    values = np.concatenate((values[values >= 20], rng.integers(1, 20, 50000)))
+    histogram = Histogram()
+    histogram.add(values)
+    return histogram
+
+
+def test_should_fit_power_law_tail(tail):
+    fit = fit_power_law(tail)
+    assert 10 <= fit["x_min"] <= 40
+    assert abs(fit["alpha"] - 2.5) < 3 * fit["sigma"] + 0.02
+    values, counts = tail.freq_data()
+    assert fit_power_law(values, counts, x_min=20)["n_tail"] == counts[values >= 20].sum()
+    with pytest.raises(ValueError):
+        fit_power_law([1, 2], [3, 4])
+
+
+def test_log_bins_should_give_density_per_unit():
+    centres, density = log_bins(np.arange(100), np.ones(100), bins_per_decade=1)  # bins [1, 10) and [10, 100)
+    assert np.allclose(centres, [3, np.sqrt(990)])
+    assert np.allclose(density, 1 / 99)
+
+
+def test_bootstrap_should_not_depend_on_workers(tail):
+    in_process = bootstrap_exponent(tail, x_min=20, n_bootstrap=20, seed=1, workers=1)
+    pooled = bootstrap_exponent(tail, x_min=20, n_bootstrap=20, seed=1, workers=2)
+    assert np.array_equal(in_process["alphas"], pooled["alphas"])
+    assert in_process["low"] < in_process["alpha"] < in_process["high"]
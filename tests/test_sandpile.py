@@ -2,8 +2,17 @@ import numpy as np
 import pytest
 from pytest import fixture
 from unittest.mock import MagicMock, Mock
-from sandpile import Table
-from sandpile_gui import Window
+from sandpile import Table, TiledTable, GraphTable, ReplicaTable
+from avalanche_stats import AVALANCHE_DTYPE
+from lattice import Lattice
+from PyQt5.QtCore import Qt, QPoint
+from PyQt5.QtGui import QColor
+from PyQt5.QtTest import QTest
+from PyQt5.QtWidgets import QApplication
+from sandpile_gui import Window, RasterGrid
+from instrumentation import Instruments
+from activity import ActivityMaps
+import jit_kernels
 
 
 @fixture
@@ -88,6 +97,12 @@ def gui_window(sand_pile_parameters, empty_sand_pile):
     return gui_window
 
 
+@fixture
+def qt_app(monkeypatch):
+    monkeypatch.setenv("QT_QPA_PLATFORM", "offscreen")  # no display needed
+    return QApplication.instance() or QApplication([])
+
+
 @fixture
 def sand_pile_before_avalanche_with_supercritical_site(sand_pile_parameters):
     m, n, k = sand_pile_parameters
@@ -217,3 +232,406 @@ def test_should_avalanche_with_supercritical_site(gui_window, sand_pile_before_a
     total_mass_f = np.sum(gui_window.sandPile.grid)
     assert gui_window.sandPile.grid.all() == expected_table_after_avalanche_with_supercritical_site2.all()
     assert total_mass_f == total_mass_i
+
+
+@fixture
+def vectorised_sand_pile_before_avalanche(sand_pile_before_avalanche):
+    sand_pile_before_avalanche.engine = "vectorised"
+    return sand_pile_before_avalanche
+
+
+def test_should_reject_unknown_engine(sand_pile_parameters):
+    m, n, k = sand_pile_parameters
+    with pytest.raises(ValueError):
+        Table(m, n, k, engine="quantum")
+
+
+def test_should_execute_timestep_vectorised(vectorised_sand_pile_before_avalanche,
+                                            expected_table_after_avalanche_timestep):
+    new_critical = vectorised_sand_pile_before_avalanche.execute_timestep({(3, 3)})
+    assert new_critical == {(3, 2)}
+    assert np.array_equal(vectorised_sand_pile_before_avalanche.grid, expected_table_after_avalanche_timestep)
+
+
+def test_should_topple_into_supercritical_site_vectorised(sand_pile_before_avalanche_with_supercritical_site,
+                                                          expected_table_after_topple_timestep_into_supercritical_site):
+    sand_pile_before_avalanche_with_supercritical_site.engine = "vectorised"
+    input_set = {(3, 2), (2, 3), (3, 4), (4, 3)}
+    new_critical = sand_pile_before_avalanche_with_supercritical_site.execute_timestep(input_set)
+    assert new_critical == {(3, 3)}
+    assert np.array_equal(sand_pile_before_avalanche_with_supercritical_site.grid,
+                          expected_table_after_topple_timestep_into_supercritical_site)
+
+
+def test_vectorised_avalanche_should_match_scalar_avalanche():
+    rng = np.random.default_rng(1)
+    scalar, vectorised = Table(9, 7, 4), Table(9, 7, 4, engine="vectorised")
+    for _ in range(1000):
+        i, j = rng.integers(1, 10), rng.integers(1, 8)
+        scalar.add_grain(i, j)
+        vectorised.add_grain(i, j)
+        if scalar.is_critical_site(i, j):
+            assert scalar.execute_avalanche_with_stats(i, j) == vectorised.execute_avalanche_with_stats(i, j)
+        assert np.array_equal(scalar.grid, vectorised.grid)
+    assert scalar.grid.min() >= 0
+
+
+def test_should_stabilise_critical_table(sand_pile_before_avalanche_with_supercritical_site2,
+                                         expected_table_after_avalanche_with_supercritical_site2):
+    table = sand_pile_before_avalanche_with_supercritical_site2
+    total_mass_i = np.sum(table.grid)
+    assert table.stabilise() == 6
+    assert np.array_equal(table.grid, expected_table_after_avalanche_with_supercritical_site2)
+    assert np.sum(table.grid) == total_mass_i
+
+
+def test_add_pile_should_match_single_grain_drops(sand_pile_parameters):
+    m, n, k = sand_pile_parameters
+    single_grains, pile = Table(m, n, k), Table(m, n, k)
+    a_size = 0
+    for _ in range(60):
+        single_grains.add_grain(2, 4)
+        if single_grains.is_critical_site(2, 4):
+            a_size += single_grains.execute_avalanche_with_stats(2, 4)['size']
+    topples = pile.add_pile(60, 2, 4)
+    assert np.array_equal(single_grains.grid, pile.grid)
+    assert 4 * topples == a_size
+
+
+def test_should_add_grains_to_center(empty_sand_pile, expected_table_grain_added):
+    assert empty_sand_pile.add_grains(1) == 0
+    assert np.array_equal(empty_sand_pile.grid, expected_table_grain_added)
+
+
+def test_should_reject_unknown_drop_policy(empty_sand_pile):
+    with pytest.raises(ValueError):
+        empty_sand_pile.add_grains(10, policy="edge")
+
+
+def test_add_grains_should_match_single_grain_drops(sand_pile_parameters):
+    m, n, k = sand_pile_parameters
+    single_grains, batched, batched_with_stats = Table(m, n, k), Table(m, n, k), Table(m, n, k)
+    sites = single_grains.drop_sites(200, "random", 0)
+    avalanches = []
+    for grain, (i, j) in enumerate(sites):
+        single_grains.add_grain(i, j)
+        if single_grains.is_critical_site(i, j):
+            avalanches.append((grain, single_grains.execute_avalanche_with_stats(i, j)))
+    batched.add_grains(sites)
+    assert np.array_equal(batched.grid, single_grains.grid)
+    assert batched_with_stats.add_grains_with_stats(200, "random", 0) == avalanches
+    assert np.array_equal(batched_with_stats.grid, single_grains.grid)
+
+
+def test_avalanche_should_clear_tracer_buffers(sand_pile_before_avalanche_with_supercritical_site2,
+                                               expected_table_after_avalanche_with_supercritical_site2):
+    table = sand_pile_before_avalanche_with_supercritical_site2
+    stats = table.execute_avalanche_with_stats(3, 2)
+    assert stats == {'size': 24, 'lifetime': 4, 'area': 6, 'radius': 2}
+    assert np.array_equal(table.grid, expected_table_after_avalanche_with_supercritical_site2)
+    assert not any(table.tracer_buffers()[1])  # no site left marked as visited
+
+
+def test_should_resume_from_checkpoint(tmp_path):
+    table = Table(6, 5, 4, seed=3)
+    table.add_grains_with_stats(150, "random")
+    table.save_checkpoint(tmp_path)
+    table.add_grains(10)  # next snapshot goes to the other slot
+    table.save_checkpoint(tmp_path)
+    expected_avalanches = table.add_grains_with_stats(150, "random")
+
+    resumed, stats = Table.load_checkpoint(tmp_path)
+    assert stats is None
+    assert resumed.grains == 160
+    assert resumed.add_grains_with_stats(150, "random") == expected_avalanches
+    assert np.array_equal(resumed.grid, table.grid)
+
+
+def test_least_action_should_not_change_stabilised_grid():
+    plain, least_action = Table(12, 9, 4), Table(12, 9, 4)
+    heights = np.random.default_rng(2).integers(0, 20, [12, 9])
+    plain.grid[1:13, 1:10] = heights
+    least_action.grid[1:13, 1:10] = heights
+    assert plain.stabilise() == least_action.stabilise(least_action=True)
+    assert np.array_equal(plain.grid, least_action.grid)
+
+
+def test_identity_should_be_neutral_and_recurrent(sand_pile_parameters):
+    m, n, k = sand_pile_parameters
+    identity = Table.identity(m, n, k)
+    assert np.array_equal(identity.grid[1:m + 1, 1:n + 1], np.array([[2, 3, 2, 3, 2],
+                                                                     [3, 2, 1, 2, 3],
+                                                                     [2, 1, 0, 1, 2],
+                                                                     [3, 2, 1, 2, 3],
+                                                                     [2, 3, 2, 3, 2]]))
+    assert identity.is_recurrent()
+    recurrent = Table.random_recurrent(m, n, k, seed=4)
+    assert recurrent.is_recurrent()
+    heights = recurrent.grid[1:m + 1, 1:n + 1].copy()
+    recurrent.add_configuration(identity.grid[1:m + 1, 1:n + 1])
+    assert np.array_equal(recurrent.grid[1:m + 1, 1:n + 1], heights)
+    assert not Table(m, n, k).is_recurrent()
+
+
+@pytest.mark.parametrize("engine, workers", [("jit", 1), ("scalar", 2)])
+def test_group_tables_should_use_engine_and_workers(engine, workers):
+    identity = Table.identity(20, 17, 4, engine=engine, workers=workers)
+    assert (identity.engine, identity.workers) == (engine if jit_kernels.COMPILED else "scalar", workers)
+    assert np.array_equal(identity.grid, Table.identity(20, 17, 4).grid)
+    recurrent = Table.random_recurrent(20, 17, 4, seed=6, engine=engine, workers=workers)
+    assert np.array_equal(recurrent.grid, Table.random_recurrent(20, 17, 4, seed=6).grid)
+
+
+@pytest.mark.parametrize("engine", ["scalar", "vectorised", "jit"])
+def test_tiled_table_should_match_large_table(monkeypatch, engine):
+    monkeypatch.setattr(jit_kernels, "COMPILED", True)
+    table, tiled_table = Table(41, 41, 4), TiledTable(4, tile_size=8, engine=engine)
+    i_c, j_c = table.centre()
+    assert table.add_pile(1000) == tiled_table.add_pile(1000)
+    heights, (i_min, j_min) = tiled_table.to_array()
+    assert np.array_equal(table.grid[i_c + i_min:i_c + i_min + heights.shape[0],
+                                     j_c + j_min:j_c + j_min + heights.shape[1]], heights)
+    assert len(tiled_table.tiles) < 41 * 41 / 8 ** 2  # only tiles the pile reached
+
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        i, j = rng.integers(-10, 11, 2)
+        table.add_grain(i + i_c, j + j_c)
+        tiled_table.add_grain(i, j)
+        assert table.is_critical_site(i + i_c, j + j_c) == tiled_table.is_critical_site(i, j)
+        if tiled_table.is_critical_site(i, j):
+            assert table.execute_avalanche_with_stats(i + i_c, j + j_c) == \
+                   tiled_table.execute_avalanche_with_stats(i, j)
+    assert len(tiled_table.blocks) == 2  # the single tile window, and the last bigger one avalanches needed
+    assert all(block.engine == engine for block in tiled_table.blocks.values())
+
+
+def test_raster_grid_should_colour_sites_and_map_clicks(qt_app):
+    colours = {0: "white", 1: "lightblue", 2: "#619bcc", 3: "#316a9a"}
+    clicked = []
+    raster = RasterGrid(3, 4, colours, lambda i, j: clicked.append((i, j)))
+    heights = np.array([[0, 1, 2, 3], [3, 2, 1, 0], [5, 0, 0, 1]])
+
+    def pixel_colours():
+        return [[raster.image.pixelColor(j, i).name() for j in range(4)] for i in range(3)]
+    raster.refresh(heights)
+    assert pixel_colours() == [[QColor(colours[min(height, 3)]).name() for height in row] for row in heights]
+    heights[1, 2] = 3
+    heights[0, 0] = 2  # not refreshed
+    raster.refresh(heights, np.array([1]), np.array([2]))
+    assert pixel_colours()[1][2] == QColor(colours[3]).name()
+    assert pixel_colours()[0][0] == QColor(colours[0]).name()
+
+    raster.resize(40, 30)  # 10 by 10 pixels per site
+    QTest.mouseClick(raster, Qt.LeftButton, pos=QPoint(25, 15))
+    QTest.mouseClick(raster, Qt.LeftButton, pos=QPoint(39, 29))
+    assert clicked == [(1, 2), (2, 3)]
+
+
+def test_should_track_changed_sites(sand_pile_before_avalanche_with_supercritical_site2):
+    table = sand_pile_before_avalanche_with_supercritical_site2
+    assert not table.track_changes and table.changed is None  # nothing is tracked until asked for
+    assert len(table.pop_changed_sites()[0]) == 25  # so the first call gives every site
+    before = table.grid.copy()
+    table.execute_avalanche_with_stats(3, 2)
+    rows, cols = table.pop_changed_sites()
+    changed = set(zip(*np.nonzero(before != table.grid)))
+    assert changed <= set(zip(rows, cols))
+    assert all(1 <= i <= 5 and 1 <= j <= 5 for i, j in zip(rows, cols))  # only sites on the table
+    assert len(table.pop_changed_sites()[0]) == 0  # forgotten once read
+    table.add_grain(1, 5)
+    assert [list(sites) for sites in table.pop_changed_sites()] == [[1], [5]]
+
+
+@pytest.mark.parametrize("engine", ["scalar", "vectorised"])
+def test_instruments_should_count_avalanches(engine):
+    avalanches = []
+    instruments = Instruments(on_avalanche=lambda table, stats: avalanches.append(stats))
+    sand_pile = Table(6, 6, 4, engine=engine, seed=1)
+    sand_pile.instruments = instruments
+    returned = []
+    for i, j in sand_pile.drop_sites(300, "random"):
+        sand_pile.add_grain(i, j)
+        if sand_pile.is_critical_site(i, j):
+            returned.append(sand_pile.execute_avalanche_with_stats(i, j))
+    assert avalanches == returned
+    counters = instruments.to_dict()
+    assert counters["avalanches"] == len(returned)
+    assert counters["topples"] == sum(stats['size'] for stats in returned) // 4
+    assert counters["timesteps"] == sum(stats['lifetime'] for stats in returned)
+    assert sum(counters["frontier_sizes"].values()) == counters["timesteps"]
+    assert counters["peak_frontier"] == max(counters["frontier_sizes"])
+    assert "sandpile_topples_total %d\n" % counters["topples"] in instruments.to_prometheus()
+
+
+@pytest.mark.parametrize("engine", ["scalar", "vectorised"])
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16])
+def test_compact_table_should_match_int_table(engine, dtype):
+    tables = [Table(9, 7, 4, engine=engine, seed=3), Table(9, 7, 4, engine=engine, seed=3, dtype=dtype)]
+    avalanches = [[], []]
+    for sand_pile, table_avalanches in zip(tables, avalanches):
+        for i, j in sand_pile.drop_sites(2000, "random"):
+            sand_pile.add_grain(i, j)
+            if sand_pile.is_critical_site(i, j):
+                table_avalanches.append(sand_pile.execute_avalanche_with_stats(i, j))
+        sand_pile.add_pile(200)
+    wide, compact = tables
+    assert compact.grid.dtype == dtype
+    assert avalanches[1] == avalanches[0]
+    assert np.array_equal(compact.interior, wide.interior)
+    assert compact.lost == wide.grid.sum() - wide.interior.sum()
+    assert not (compact.grid.sum() - compact.interior.sum())  # the edges were emptied
+
+
+def test_compact_table_should_detect_overflow(sand_pile_parameters):
+    m, n, k = sand_pile_parameters
+    with pytest.raises(ValueError):
+        Table(m, n, 254, dtype=np.uint8)
+    sand_pile = Table(m, n, k, dtype=np.uint8)
+    with pytest.raises(OverflowError):
+        sand_pile.add_pile(256)
+    sand_pile.grid[3, 3] = 255
+    with pytest.raises(OverflowError):
+        sand_pile.add_grain(3, 3)
+    with pytest.raises(OverflowError):
+        sand_pile.add_configuration(np.full((m, n), 100))
+
+
+def test_checkpoint_should_keep_compact_dtype(tmp_path, sand_pile_parameters):
+    m, n, k = sand_pile_parameters
+    sand_pile = Table(m, n, k, dtype=np.int16)
+    sand_pile.add_pile(100)
+    sand_pile.save_checkpoint(tmp_path)
+    resumed, _ = Table.load_checkpoint(tmp_path)
+    assert resumed.grid.dtype == np.int16 and resumed.lost == sand_pile.lost > 0
+    assert np.array_equal(resumed.interior, sand_pile.interior)
+
+
+def test_graph_table_should_match_table_on_square_lattice():
+    sand_pile, graph = Table(9, 7, 4, seed=3), GraphTable(Lattice.square(9, 7), seed=3)
+    for i, j in sand_pile.drop_sites(2000, "random").tolist():
+        node = i * 9 + j
+        sand_pile.add_grain(i, j)
+        graph.add_grain(node)
+        expected = sand_pile.execute_avalanche_with_stats(i, j) if sand_pile.is_critical_site(i, j) else None
+        assert (graph.execute_avalanche_with_stats(node) if graph.is_critical_site(node) else None) == expected
+    assert np.array_equal(graph.grid[1:-1, 1:-1], sand_pile.interior)
+    assert graph.lost == sand_pile.grid.sum() - sand_pile.interior.sum()
+
+
+@pytest.mark.parametrize("lattice", [Lattice.triangular(8, 9), Lattice.hexagonal(8, 9), Lattice.cubic(4, 5, 6),
+                                     Lattice.square(6, 6, "periodic").with_sinks([0]),
+                                     Lattice.from_edges(4, [(0, 1), (1, 2), (2, 3), (3, 0), (0, 2)], sinks=[3])])
+def test_graph_table_avalanches_should_match_add_grains(lattice):
+    avalanching, bulk = GraphTable(lattice, seed=1), GraphTable(lattice, seed=1)
+    nodes = avalanching.drop_sites(1000, "random")
+    for node in nodes.tolist():
+        avalanching.add_grain(node)
+        if avalanching.is_critical_site(node):
+            avalanching.execute_avalanche_with_stats(node)
+    bulk.add_grains(nodes)
+    assert np.array_equal(avalanching.heights, bulk.heights) and avalanching.lost == bulk.lost
+    assert avalanching.heights[lattice.sinks].sum() == 0
+    assert avalanching.heights.sum() + avalanching.lost == 1000
+
+
+def test_lattice_should_have_symmetric_neighbours():
+    assert Lattice.square(3, 4).offsets == (6, -6, 1, -1)
+    for lattice, degree in [(Lattice.triangular(4, 5, "periodic"), 6), (Lattice.cubic(3, 3, 3, "periodic"), 6)]:
+        indptr, indices, degrees = lattice.csr()
+        assert (degrees == degree).all()
+        edges = np.column_stack((np.repeat(np.arange(lattice.size), degrees), indices))
+        assert sorted(map(tuple, edges)) == sorted(map(tuple, edges[:, ::-1]))
+    with pytest.raises(ValueError):
+        GraphTable(Lattice.square(4, 4, "closed"))  # sand could never leave
+
+
+@pytest.mark.parametrize("dtype", [int, np.int16])
+def test_strip_stabilise_should_match_serial_stabilise(dtype):
+    serial, strips = Table(23, 17, 4, dtype=dtype), Table(23, 17, 4, dtype=dtype)
+    strips.workers = 3
+    topples = []
+    for sand_pile in serial, strips:
+        topples.append([sand_pile.add_pile(3000), sand_pile.add_grains(2000, "random", 1)])
+    assert topples[1] == topples[0]
+    assert np.array_equal(strips.grid, serial.grid) and strips.lost == serial.lost
+
+
+@pytest.mark.parametrize("dtype", [int, np.uint8])
+def test_run_should_match_grain_by_grain_driver(dtype):
+    driven, sand_pile = Table(9, 7, 4, dtype=dtype), Table(9, 7, 4, dtype=dtype)
+    expected = []
+    rng = np.random.default_rng(2)
+    sites = np.concatenate([driven.drop_sites(grains, "random", rng) for grains in (5000, 5000, 2000)])
+    for i, j in sites.tolist():
+        grain = driven.grains
+        driven.add_grain(i, j)
+        if driven.is_critical_site(i, j):
+            stats = driven.execute_avalanche_with_stats(i, j)
+            expected.append((grain, stats['size'], stats['lifetime'], stats['area'], stats['radius'],
+                             np.average(driven.interior)))
+    avalanches = sand_pile.run(12000, "random", 2, chunk=4000)  # drawn in other chunks than sites
+    assert avalanches.dtype == AVALANCHE_DTYPE and len(avalanches) == len(expected) > 4000  # grown past a chunk
+    assert avalanches[["grain", "size", "lifetime", "area", "radius"]].tolist() == [row[:5] for row in expected]
+    assert np.allclose(avalanches["density"], [row[5] for row in expected])
+    assert np.array_equal(sand_pile.grid, driven.grid)
+
+
+@pytest.mark.parametrize("chunk", [1, 300, 1024])
+def test_run_should_not_depend_on_chunk(chunk):
+    whole, chunked = Table(9, 7, 4, seed=3), Table(9, 7, 4, seed=3)
+    assert np.array_equal(chunked.run(3000, "random", chunk=chunk), whole.run(3000, "random", chunk=3000))
+    assert np.array_equal(chunked.grid, whole.grid)
+    replicas = ReplicaTable(3, 9, 7, 4, seed=5)
+    for expected, avalanches in zip(ReplicaTable(3, 9, 7, 4, seed=5).run(3000, "random", chunk=3000),
+                                    replicas.run(3000, "random", chunk=chunk)):
+        assert np.array_equal(avalanches, expected)
+
+
+def test_replica_table_should_match_separate_tables():
+    replicas = ReplicaTable(6, 9, 7, 4, seed=4)
+    all_avalanches = replicas.run(3000, "random", chunk=1000)
+    for replica, seed in enumerate(np.random.SeedSequence(4).spawn(6)):
+        sand_pile = Table(9, 7, 4, seed=seed)
+        assert np.array_equal(all_avalanches[replica], sand_pile.run(3000, "random", chunk=1000))
+        assert np.array_equal(replicas.grid[replica], sand_pile.grid)
+
+
+@pytest.mark.parametrize("dtype", [int, np.int16])
+def test_jit_engine_should_match_scalar_engine(monkeypatch, dtype):
+    monkeypatch.setattr(jit_kernels, "COMPILED", True)  # the kernels run as plain Python without Numba
+    scalar, jit = Table(9, 7, 4, seed=1, dtype=dtype), Table(9, 7, 4, seed=1, engine="jit", dtype=dtype)
+    assert jit.engine == "jit"
+    assert np.array_equal(jit.run(2000, "random"), scalar.run(2000, "random"))
+    assert jit.add_pile(2000) == scalar.add_pile(2000)
+    assert jit.add_grains(300, "random") == scalar.add_grains(300, "random")
+    assert np.array_equal(jit.grid, scalar.grid) and jit.lost == scalar.lost
+
+
+def test_jit_stabiliser_should_follow_lattice_offsets():
+    lattice = Lattice.triangular(9, 8)  # 6 neighbours, so each topple gives away 6 grains
+    heights = np.where(lattice.sinks, 0, np.random.default_rng(3).integers(0, 20, lattice.size))
+    graph = GraphTable(lattice)
+    graph.heights[...] = heights
+    topples = graph.stabilise()
+    size = lattice.size
+    assert jit_kernels.stabilise_grid(heights, lattice.sinks, np.array(lattice.offsets), np.zeros(size, np.int64),
+                                      np.zeros(size, np.uint8), 6, True, 2 ** 62, np.zeros(0, np.int64),
+                                      False)[:2] == (topples, graph.lost)
+    assert np.array_equal(heights, graph.heights)
+
+
+@pytest.mark.parametrize("dtype", [int, np.int16, np.uint8])
+def test_compiled_jit_engine_should_match_scalar_engine(dtype):
+    pytest.importorskip("numba")
+    assert jit_kernels.COMPILED and hasattr(jit_kernels.trace_avalanche, "py_func")  # Numba dispatchers
+    scalar, jit = Table(40, 33, 4, seed=2, dtype=dtype), Table(40, 33, 4, seed=2, engine="jit", dtype=dtype)
+    for sand_pile in scalar, jit:
+        sand_pile.activity = ActivityMaps(40, 33)
+    assert np.array_equal(jit.run(6000, "random"), scalar.run(6000, "random"))
+    assert jit.add_grains(250, "centre") == scalar.add_grains(250, "centre")
+    assert np.array_equal(jit.grid, scalar.grid) and jit.lost == scalar.lost
+    assert np.array_equal(jit.activity.odometer, scalar.activity.odometer)
+    jit.activity = None  # the kernels are given an empty odometer
+    assert jit.add_grains(250, "random", 3) == scalar.add_grains(250, "random", 3)
+    assert np.array_equal(jit.grid, scalar.grid) and jit.lost == scalar.lost
@@ -0,0 +1,45 @@
+import numpy as np
+from sandpile import Table
+from simulation import Simulation
+
+
+def dropped(grains):
+    """The table after dropping grains one at a time in the centre, without a simulation thread"""
+    sand_pile = Table(7, 6, 4)
+    for i, j in sand_pile.drop_sites(grains):
+        sand_pile.add_grain(i, j)
+        if sand_pile.is_critical_site(i, j):
+            sand_pile.execute_avalanche_with_stats(i, j)
+    return sand_pile.grid[1:8, 1:7]
+
+
+def test_simulation_should_match_dropping_grains_directly():
+    simulation = Simulation(Table(7, 6, 4))
+    simulation.start(1000)
+    assert simulation.wait(10)
+    heights = np.zeros([7, 6], dtype=int)
+    assert simulation.snapshot(heights) > 0
+    assert np.array_equal(heights, dropped(1000))
+    simulation.close()
+
+
+def test_simulation_should_only_step_while_paused():
+    simulation = Simulation(Table(7, 6, 4))
+    simulation.pause()
+    simulation.start(100)
+    simulation.pause()
+    simulation.step(10)
+    simulation.drop(1, 1)
+    assert simulation.wait(10)
+    heights = np.zeros([7, 6], dtype=int)
+    simulation.snapshot(heights)
+    assert simulation.sandPile.grains == 11 and simulation.remaining == 90
+    assert heights[0, 0] == 1
+    simulation.resume()
+    assert simulation.wait(10)
+    assert simulation.sandPile.grains == 101
+    simulation.clear()
+    assert simulation.wait(10)
+    simulation.snapshot(heights)
+    assert not heights.any()
+    simulation.close()